@@ -0,0 +1,238 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, io, json, shutil, logging, tarfile
+from collections import OrderedDict
+
+from tqdm import tqdm
+
+from photokeeper.target import TargetBase
+
+BLOCK = tarfile.BLOCKSIZE
+EOF_MARKER = b'\0' * (2*BLOCK)
+
+try:
+    import fcntl
+except ImportError:   # Windows
+    fcntl = None
+
+
+class IndexEntry(object):
+    def __init__(self, name, offset, size, mtime):
+        self.name = name
+        self.offset = offset    # Where the member's data starts in the tar
+        self.size = size
+        self.mtime = mtime
+
+    @property
+    def end(self):
+        """ Where the next member's header goes: data is padded out to a whole block """
+        return self.offset + (self.size + BLOCK - 1) // BLOCK * BLOCK
+
+    def as_dict(self):
+        return OrderedDict([('name', self.name), ('offset', self.offset), ('size', self.size), ('mtime', self.mtime)])
+
+
+class PackedDay(object):
+    """ One day's append-only tar (stored, uncompressed) plus its sidecar index.
+
+        The index (<day>.tar.idx, one JSON line per member) is the source of truth: a member is
+        only added to it once its data and the tar end-of-archive marker are on disk, so a crash
+        mid-append just leaves junk past the last indexed member that the next append overwrites.
+
+        Other runs (or a long-lived serve/watch next to a one-off run) may append to the same
+        day: appends hold an flock on the tar, and re-read the index first if it has changed.
+    """
+
+    def __init__(self, tar_path):
+        self.tar_path = tar_path
+        self.index_path = tar_path + '.idx'
+        self.entries = OrderedDict()
+        self.index_sig = None   # (size, mtime) of the index when it was last read or written
+        self.refresh()
+
+    def _index_sig(self):
+        try:
+            st = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    def refresh(self):
+        """ Re-read the index if someone else has appended since we last looked """
+        sig = self._index_sig()
+        if sig is not None and sig == self.index_sig:
+            return
+        self.entries = OrderedDict()
+        if sig is not None:
+            self._load_index()
+        elif os.path.exists(self.tar_path) and os.path.getsize(self.tar_path):
+            self._rebuild_index()
+        self.index_sig = self._index_sig()
+
+    def _load_index(self):
+        with open(self.index_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    d = json.loads(line)
+                except ValueError:
+                    logging.warning('Ignoring torn line at end of {}'.format(self.index_path))
+                    break
+                self.entries[d['name']] = IndexEntry(d['name'], d['offset'], d['size'], d['mtime'])
+
+    def _rebuild_index(self):
+        """ For a tar without an index (made by hand, or the index was lost) """
+        logging.info('Rebuilding index for {}'.format(self.tar_path))
+        with tarfile.open(self.tar_path, 'r') as tar:
+            for member in tar:
+                if member.isfile():
+                    self.entries[member.name] = IndexEntry(member.name, member.offset_data, member.size, member.mtime)
+        with open(self.index_path, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry.as_dict()) + '\n')
+
+    @property
+    def end(self):
+        return max([e.end for e in self.entries.values()] or [0])
+
+    def unique_name(self, filename, taken=()):
+        """ Same scheme as FileCopy: add _1, _2... until the name is not used (in the archive
+            or in taken, the names of a batch that hasn't been written yet)
+        """
+        fn, ext = os.path.splitext(filename)
+        name, suffix = filename, 1
+        while name in self.entries or name in taken:
+            name = fn + '_' + str(suffix) + ext
+            suffix += 1
+        return name
+
+    def append(self, files):
+        """ Append (name, source path) pairs in one sequential write.  Names already in the
+            archive get a suffix (see unique_name)
+
+            :returns: List of the IndexEntry objects written
+        """
+        written = []
+        fd = os.open(self.tar_path, os.O_RDWR | os.O_CREAT, 0o644)
+        with open(fd, 'r+b', buffering=1024*1024) as tar:
+            if fcntl:
+                fcntl.flock(tar.fileno(), fcntl.LOCK_EX)   # Released when the tar is closed
+            self.refresh()
+            tar.seek(self.end)
+            for name, srcpath in files:
+                name = self.unique_name(name, set(e.name for e in written))
+                st = os.stat(srcpath)
+                info = tarfile.TarInfo(name)
+                info.size = st.st_size
+                info.mtime = int(st.st_mtime)
+                info.mode = 0o644
+                header = info.tobuf(format=tarfile.PAX_FORMAT)
+                tar.write(header)
+                offset = tar.tell()
+                with open(srcpath, 'rb') as src:
+                    shutil.copyfileobj(src, tar, 1024*1024)
+                copied = tar.tell() - offset
+                if copied != st.st_size:
+                    raise IOError('{} changed size while being packed'.format(srcpath))
+                tar.write(b'\0' * (-copied % BLOCK))
+                written.append(IndexEntry(name, offset, st.st_size, info.mtime))
+            tar.write(EOF_MARKER)
+            tar.truncate()
+            tar.flush()
+            os.fsync(tar.fileno())
+
+            with open(self.index_path, 'a') as f:
+                for entry in written:
+                    f.write(json.dumps(entry.as_dict()) + '\n')
+                    self.entries[entry.name] = entry
+                f.flush()
+                os.fsync(f.fileno())
+            self.index_sig = self._index_sig()
+        return written
+
+    def open_member(self, name):
+        """ Random access to one member's data, without reading the rest of the tar """
+        entry = self.entries[name]
+        with open(self.tar_path, 'rb') as f:
+            f.seek(entry.offset)
+            return io.BytesIO(f.read(entry.size))
+
+
+class DayArchive(TargetBase):
+    """ Pack the files for each day into TARGET_DIR/<YYYY-MM-DD>.tar instead of a directory of
+        small files.  On network shares, per-file metadata round trips dominate small-file
+        copies; here each day is one file opened once per run and written sequentially.
+    """
+
+    def __init__(self, batch_bytes=256*1024*1024):
+        """
+            :param batch_bytes: Sync the archive and its index after about this much data
+        """
+        self.batch_bytes = batch_bytes
+        self.days = {}
+
+    def day(self, tgtbasedir, tgtdatedir):
+        path = os.path.join(tgtbasedir, tgtdatedir + '.tar')
+        if path not in self.days:
+            self.days[path] = PackedDay(path)
+        return self.days[path]
+
+    def _is_duplicate(self, img):
+        entry = self.day(img.tgtbasedir, img.tgtdatedir).entries.get(img.filename)
+        return entry is not None and entry.size == os.path.getsize(img.srcpath)
+
+    def refresh(self):
+        """ Catch up with appends made by other runs since the last check or copy """
+        for day in self.days.values():
+            day.refresh()
+
+    def check_duplicates(self, images):
+        print("Checking for duplicates in the day archives")
+        self.refresh()
+        images = list(images)
+        for img in images:
+            if self._is_duplicate(img):
+                img.archive_dup = True
+        n_dups = [i for i in images if i.archive_dup]
+        print('Found {} duplicates out of {} images'.format(len(n_dups), len(images)))
+
+    def execute_copy(self, images):
+        self.refresh()
+        by_day = OrderedDict()
+        skip_count = 0
+        for img in images:
+            if img.archive_dup:
+                skip_count += 1
+                continue
+            by_day.setdefault((img.tgtbasedir, img.tgtdatedir), []).append(img)
+
+        print("Packing files into day archives")
+        packed = 0
+        for (tgtbasedir, tgtdatedir), day_images in tqdm(by_day.items(), ncols=80, unit='day'):
+            day = self.day(tgtbasedir, tgtdatedir)
+            batch, batch_size = [], 0
+            for img in day_images:
+                batch.append((img.filename, img.srcpath))
+                batch_size += os.path.getsize(img.srcpath)
+                if batch_size >= self.batch_bytes:
+                    packed += len(day.append(batch))
+                    batch, batch_size = [], 0
+            if batch:
+                packed += len(day.append(batch))
+            logging.info("Packed {} files into {}".format(len(day_images), day.tar_path))
+        self.metrics.count('archive.packed', packed)
+        print("Skipped {} duplicate files".format(skip_count))
+        print("Packed {} files".format(packed))
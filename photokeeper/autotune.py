@@ -0,0 +1,226 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Work out how many copies (or uploads) to run at once while they are running.
+
+    A local SSD keeps getting faster up to a dozen or more parallel copies, a NAS stops
+    getting faster at two or three, and Flickr starts refusing uploads above a few.  The
+    AIMDController watches throughput and per-operation latency over windows of completed
+    operations and adjusts the limit the way TCP adjusts its window:
+
+    * one more in flight after every window that was clearly faster than the last one
+      (additive increase);
+    * one fewer when operations are just queueing: by Little's law the target is working on
+      (operations per second x the best latency seen) of them at a time, and any more than
+      that in flight only wait;
+    * half as many after an error (multiplicative decrease).
+"""
+
+import time, logging, threading, datetime, email.utils
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from photokeeper.utils import ContextPool
+
+
+class AIMDController(object):
+
+    def __init__(self, name, initial=2, minimum=1, maximum=16, window=8, gain=0.05, queue_limit=2, probe_every=4,
+                 clock=time.perf_counter):
+        """
+            :param window: Completed operations per measurement (at least twice the limit)
+            :param gain: A window must be this much faster than the last to count as faster
+            :param queue_limit: Back off once more than this many operations seem to be queueing
+            :param probe_every: After this many steady windows, try one more anyway, in case
+                                things have changed
+            :param clock: Where the time comes from (for tests)
+        """
+        self.name = name
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.gain = gain
+        self.queue_limit = queue_limit
+        self.probe_every = probe_every
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.base_latency = None
+        self.last_throughput = None
+        self.peak = (0.0, self.limit)   # (throughput, limit)
+        self.steady = 0
+        self.errors = 0
+        self.history = [self.limit]
+        self._new_window()
+
+    def _new_window(self):
+        self.window_start = self.clock()
+        self.window_bytes = 0
+        self.window_latencies = []
+
+    def _set_limit(self, limit, why):
+        limit = max(self.minimum, min(limit, self.maximum))
+        if limit != self.limit:
+            logging.debug('{}: {} in flight -> {} ({})'.format(self.name, self.limit, limit, why))
+            self.limit = limit
+            self.history.append(limit)
+
+    def success(self, nbytes, seconds):
+        with self.lock:
+            self.window_bytes += nbytes
+            self.window_latencies.append(seconds)
+            if len(self.window_latencies) >= max(self.window, 2*self.limit):
+                self._end_window()
+
+    def failure(self):
+        with self.lock:
+            self.errors += 1
+            self._set_limit(self.limit // 2, 'error')
+            self.last_throughput = None
+            self._new_window()
+
+    def _end_window(self):
+        elapsed = self.clock() - self.window_start
+        elapsed = max(elapsed, 1e-9)
+        latencies = sorted(self.window_latencies)
+        latency = latencies[len(latencies)//2]
+        # Bytes per second, or operations per second when nothing is being measured in bytes
+        throughput = (self.window_bytes or len(latencies)) / elapsed
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        if throughput > self.peak[0]:
+            self.peak = (throughput, self.limit)
+        queued = self.limit - len(latencies) / elapsed * self.base_latency
+
+        if queued > self.queue_limit:
+            self.steady = 0
+            self._set_limit(self.limit - 1, 'queueing')
+        elif self.last_throughput is None or throughput > self.last_throughput * (1 + self.gain):
+            self.steady = 0
+            self._set_limit(self.limit + 1, 'faster')
+        else:
+            self.steady += 1
+            if self.steady >= self.probe_every:
+                self.steady = 0
+                self._set_limit(self.limit + 1, 'probe')
+        self.last_throughput = throughput
+        self._new_window()
+
+    def summary(self):
+        throughput, limit = self.peak
+        return '{}: finished at {} in flight (best {:.1f}/s at {}, {} errors)'.format(
+            self.name, self.limit, throughput, limit, self.errors)
+
+
+class _Job(object):
+    def __init__(self, item, future):
+        self.item = item
+        self.future = future
+        self.attempts = 1
+        self.measured = False
+
+
+def retry_after_seconds(value):
+    """ How long a Retry-After header (seconds, or an HTTP date) says to wait, or None """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((when - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+
+
+def _retry_delay(e, attempt, backoff, max_backoff):
+    """ Exponential backoff for the attempt'th retry, or longer if the error says how long
+        to wait (a retry_after attribute, in seconds)
+    """
+    delay = min(backoff * 2**(attempt-1), max_backoff)
+    return max(delay, getattr(e, 'retry_after', None) or 0.0)
+
+
+def _timed(work, item, delay=0.0):
+    if delay:
+        time.sleep(delay)   # Holds the slot, so nothing else is started while backing off
+    t0 = time.perf_counter()
+    nbytes, result = work(item)
+    return time.perf_counter() - t0, nbytes, result
+
+
+def run_adaptive(items, work, controller, done=None, retryable=lambda e: False, retries=2, backoff=1.0, max_backoff=60.0):
+    """ Call work(item) for every item, keeping controller.limit calls in flight.
+
+        :param work: Runs in a worker thread and returns (bytes moved, result)
+        :param done: Called as done(item, result) in this thread, in the order of items
+        :param retryable: Says whether an exception is worth trying again (at lower concurrency)
+        :param backoff: Seconds to wait before the first retry of an item, doubled for each
+                        retry after that (up to max_backoff), or as long as the error's
+                        retry_after says if that is longer
+        :raises: The first error that wasn't retried, once everything already started has
+                 finished (and been passed to done)
+    """
+    items = iter(items)
+    pending = deque()
+    error = None
+    exhausted = False
+    with ContextPool(max_workers=controller.maximum) as pool:
+        while True:
+            in_flight = sum(1 for job in pending if not job.future.done())
+            while not exhausted and error is None and in_flight < controller.limit:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append(_Job(item, pool.submit(_timed, work, item)))
+                in_flight += 1
+            if not pending:
+                break
+            running = [job.future for job in pending if not job.future.done()]
+            if running:
+                wait(running, return_when=FIRST_COMPLETED)
+
+            # Feed every finished operation to the controller straight away...
+            for job in pending:
+                if job.measured or not job.future.done():
+                    continue
+                job.measured = True
+                e = job.future.exception()
+                if e is None:
+                    seconds, nbytes, result = job.future.result()
+                    controller.success(nbytes, seconds)
+                else:
+                    controller.failure()
+                    if error is None and retryable(e) and job.attempts <= retries:
+                        delay = _retry_delay(e, job.attempts, backoff, max_backoff)
+                        logging.info('{}: retrying in {:.1f}s after {}'.format(controller.name, delay, e))
+                        job.attempts += 1
+                        job.measured = False
+                        job.future = pool.submit(_timed, work, job.item, delay)
+
+            # ...but hand the results over in order
+            while pending and pending[0].measured:
+                job = pending.popleft()
+                e = job.future.exception()
+                if e is not None:
+                    error = error or e
+                elif done:
+                    done(job.item, job.future.result()[2])
+    if error is not None:
+        raise error
@@ -0,0 +1,172 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    A persistent catalog (SQLite) of every file examined and where it was copied to, so that
+    questions about the library can be answered without scanning anything again.
+"""
+
+import os, time, sqlite3, logging
+from collections import OrderedDict
+
+# The totals tables are kept up to date by triggers, so that the queries only ever read a few
+# thousand rows (one per day, album or duplicate), however many files are in the catalog
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path     TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    size     INTEGER NOT NULL,
+    mtime    REAL,
+    taken    TEXT,
+    day      TEXT NOT NULL,
+    no_exif  INTEGER NOT NULL DEFAULT 0,
+    sha1     TEXT,
+    scanned  REAL,
+    -- Same photo: same contents if we know them, otherwise (like the file dedupe) same name and size
+    dupkey   TEXT GENERATED ALWAYS AS (COALESCE(sha1, filename || ':' || size)) VIRTUAL
+);
+CREATE INDEX IF NOT EXISTS files_dupkey ON files (dupkey);
+CREATE INDEX IF NOT EXISTS files_no_exif ON files (path) WHERE no_exif = 1;
+
+CREATE TABLE IF NOT EXISTS copies (
+    path     TEXT NOT NULL,
+    target   TEXT NOT NULL,
+    copied   REAL,
+    PRIMARY KEY (path, target)
+);
+
+CREATE TABLE IF NOT EXISTS day_totals (
+    day TEXT PRIMARY KEY, files INTEGER NOT NULL, bytes INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS dupkey_totals (
+    dupkey TEXT PRIMARY KEY, files INTEGER NOT NULL, bytes INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS dupkey_totals_dupes ON dupkey_totals (bytes) WHERE files > 1;
+CREATE TABLE IF NOT EXISTS album_totals (
+    target TEXT NOT NULL, day TEXT NOT NULL, files INTEGER NOT NULL, bytes INTEGER NOT NULL,
+    PRIMARY KEY (target, day)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS files_insert AFTER INSERT ON files BEGIN
+    INSERT INTO day_totals VALUES (new.day, 1, new.size)
+        ON CONFLICT (day) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+    INSERT INTO dupkey_totals VALUES (new.dupkey, 1, new.size)
+        ON CONFLICT (dupkey) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+END;
+
+CREATE TRIGGER IF NOT EXISTS files_update AFTER UPDATE OF filename, size, day, sha1 ON files
+WHEN old.day IS NOT new.day OR old.size IS NOT new.size OR old.dupkey IS NOT new.dupkey BEGIN
+    UPDATE day_totals SET files = files - 1, bytes = bytes - old.size WHERE day = old.day;
+    INSERT INTO day_totals VALUES (new.day, 1, new.size)
+        ON CONFLICT (day) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+    UPDATE dupkey_totals SET files = files - 1, bytes = bytes - old.size WHERE dupkey = old.dupkey;
+    INSERT INTO dupkey_totals VALUES (new.dupkey, 1, new.size)
+        ON CONFLICT (dupkey) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+    UPDATE album_totals SET files = files - 1, bytes = bytes - old.size
+        WHERE day = old.day AND target IN (SELECT target FROM copies WHERE path = old.path);
+    INSERT INTO album_totals SELECT target, new.day, 1, new.size FROM copies WHERE path = new.path
+        ON CONFLICT (target, day) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+END;
+
+CREATE TRIGGER IF NOT EXISTS copies_insert AFTER INSERT ON copies BEGIN
+    INSERT INTO album_totals SELECT new.target, day, 1, size FROM files WHERE path = new.path
+        ON CONFLICT (target, day) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+END;
+"""
+
+# name: (description, column headings, SQL)
+QUERIES = OrderedDict([
+    ('days', ('Files and bytes per day', ('day', 'files', 'bytes'),
+              "SELECT day, files, bytes FROM day_totals WHERE files > 0 ORDER BY day")),
+    ('months', ('Files and bytes per month', ('month', 'files', 'bytes'),
+                "SELECT substr(day, 1, 7) AS month, SUM(files), SUM(bytes) FROM day_totals WHERE files > 0 "
+                "GROUP BY month ORDER BY month")),
+    ('noexif', ('Files not dated by EXIF (but by their name or modification time)', ('path', 'day'),
+                "SELECT path, day FROM files WHERE no_exif = 1 ORDER BY path")),
+    ('dupes', ('Files stored more than once (same SHA-1, or same name and size if not hashed)', ('copies', 'bytes', 'paths'),
+               "SELECT t.files, t.bytes, (SELECT group_concat(path, ' ') FROM files f WHERE f.dupkey = t.dupkey) "
+               "FROM dupkey_totals t WHERE t.files > 1 ORDER BY t.bytes DESC")),
+    ('albums', ('Files and bytes in each target, per album (day)', ('target', 'album', 'files', 'bytes'),
+                "SELECT target, day, files, bytes FROM album_totals WHERE files > 0 ORDER BY target, day")),
+])
+
+
+class Catalog(object):
+
+    def __init__(self, filename):
+        filename = os.path.expanduser(filename)
+        dirname = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(dirname, exist_ok=True)
+        # Watch mode records from its own thread; there is still only one writer
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def record_scan(self, images):
+        """ Add (or update) examined files """
+        now = time.time()
+        rows = []
+        for img in images:
+            path = os.path.abspath(img.srcpath)
+            try:
+                st = img.stat()
+            except OSError:
+                continue
+            rows.append((path, img.filename, st.st_size, st.st_mtime, img.datetime_taken.isoformat(),
+                         img.tgtdatedir, int(img.exif_timestamp_missing), img._sha1, now))
+        with self.db:
+            # Keep a hash from an earlier run if this one didn't compute it
+            self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                                "ON CONFLICT(path) DO UPDATE SET filename=excluded.filename, size=excluded.size, "
+                                "mtime=excluded.mtime, taken=excluded.taken, day=excluded.day, no_exif=excluded.no_exif, "
+                                "sha1=CASE WHEN excluded.sha1 IS NOT NULL THEN excluded.sha1 "
+                                "          WHEN files.size = excluded.size AND files.mtime = excluded.mtime THEN files.sha1 END, "
+                                "scanned=excluded.scanned", rows)
+        logging.debug('Cataloged {} files'.format(len(rows)))
+        return len(rows)
+
+    def record_copies(self, target, images):
+        """ Note that images are now in target (copied this time, or found there as duplicates) """
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT INTO copies VALUES (?, ?, ?) "
+                                "ON CONFLICT(path, target) DO UPDATE SET copied=excluded.copied",
+                                [(os.path.abspath(img.srcpath), target, now) for img in images])
+
+    def query(self, name):
+        """ Run one of the QUERIES
+
+            :returns: (column headings, list of rows)
+        """
+        description, headings, sql = QUERIES[name]
+        return headings, self.db.execute(sql).fetchall()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def print_table(headings, rows):
+    rows = [[('' if v is None else str(v)) for v in row] for row in rows]
+    widths = [max([len(h)] + [len(r[i]) for r in rows]) for i, h in enumerate(headings)]
+    fmt = '  '.join('{:%d}' % w for w in widths[:-1]) + ('  {}' if len(widths) > 1 else '{}')
+    print(fmt.format(*headings))
+    for row in rows:
+        print(fmt.format(*row))
@@ -0,0 +1,351 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    A long-running photokeeper (``photokeeper serve``) that runs jobs sent to it over a Unix
+    socket, so that imports, Flickr authentication, the photoset list and anything else a
+    target sets up are only paid for once.
+
+    A job is a photokeeper command line.  The client sends one JSON line::
+
+        {"argv": ["/media/card", "/mnt/photos", "dedupe", "file"], "cwd": "/home/me"}
+
+    and gets the job's output back as it runs, then how it ended::
+
+        {"out": "Examining files in /media/card\\n"}
+        {"exit": 0}
+
+    Several jobs run at once (``--jobs``), and more wait their turn.  Jobs share the targets,
+    but each target is only used by one job at a time.  A job's output is told apart from
+    the others' by a context variable (JOB_STREAM), which photokeeper's thread pools pass on
+    to the work they run (see photokeeper.utils.ContextPool).
+
+    Only the standard library is imported here at first, so that the client
+    (``photokeeper-submit``) starts quickly.
+"""
+
+import os, sys, json, socket, logging, threading, traceback, contextlib, contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_SOCKET = '~/.photokeeper.sock'
+
+# Options that take a value, which may also be given as the next argument
+VALUE_OPTIONS = ('--conf', '--debounce', '--poll', '--metrics', '--save-manifest', '--remap', '--catalog',
+                 '--readers', '--io-order', '--date-policy', '--date-patterns', '--spool', '--spool-size',
+                 '--s3-conf', '--socket', '--jobs')
+# Options whose values are paths, made absolute against the client's directory
+PATH_OPTIONS = ('--conf', '--metrics', '--save-manifest', '--catalog', '--s3-conf', '--date-patterns', '--spool')
+
+# Where the output of the job running in this context goes
+JOB_STREAM = contextvars.ContextVar('JOB_STREAM', default=None)
+
+
+class TargetPool(object):
+    """ Targets kept between jobs, one per target type and options """
+
+    def __init__(self):
+        self.targets = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, name, options, make):
+        """ The target for these options, set up with make() the first time it is asked for """
+        key = (name, tuple(sorted(options.items())))
+        with self.lock:
+            if key not in self.targets:
+                self.targets[key] = make()
+                self.locks[id(self.targets[key])] = threading.Lock()
+            return self.targets[key]
+
+    @contextlib.contextmanager
+    def hold(self, targets):
+        """ Use the targets (list of (name, target)) without other jobs, taking the locks in
+            the same order everywhere
+        """
+        with contextlib.ExitStack() as stack:
+            for name, target in sorted(targets, key=lambda t: t[0]):
+                stack.enter_context(self.locks[id(target)])
+            yield
+
+
+class _ThreadOutput(object):
+    """ Stands in for sys.stdout/sys.stderr, sending what each job's threads write to its client """
+
+    def __init__(self, default):
+        self.default = default
+
+    def _stream(self):
+        return JOB_STREAM.get() or self.default
+
+    def write(self, s):
+        return self._stream().write(s)
+
+    def flush(self):
+        self._stream().flush()
+
+    def isatty(self):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+
+@contextlib.contextmanager
+def _redirect_output():
+    """ Swap sys.stdout/sys.stderr (and the logging handlers writing to them) for _ThreadOutputs """
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _ThreadOutput(stdout), _ThreadOutput(stderr)
+    handlers = [h for h in logging.getLogger().handlers
+                if isinstance(h, logging.StreamHandler) and h.stream in (stdout, stderr)]
+    for h in handlers:
+        h.stream = sys.stdout if h.stream is stdout else sys.stderr
+    try:
+        yield
+    finally:
+        for h in handlers:
+            h.stream = h.stream.default
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+class _ClientStream(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.gone = False
+
+    def send(self, message):
+        with self.lock:
+            if self.gone:
+                return
+            try:
+                self.conn.sendall((json.dumps(message) + '\n').encode('utf8'))
+            except OSError:
+                self.gone = True   # The job goes on; nobody is reading its output any more
+
+    def write(self, s):
+        if s:
+            self.send({'out': s})
+        return len(s)
+
+    def flush(self):
+        pass
+
+
+class Daemon(object):
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, jobs=2):
+        self.socket_path = os.path.expanduser(socket_path)
+        self.jobs = jobs
+        self.targets = TargetPool()
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.active = 0   # Jobs running or waiting to
+        self.lock = threading.Lock()
+        self.sock = None
+
+    def _listen(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                os.remove(self.socket_path)   # Left by a daemon that didn't shut down cleanly
+            else:
+                raise SystemExit('A photokeeper daemon is already listening on {}'.format(self.socket_path))
+            finally:
+                probe.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)   # Only this user may connect, from the moment the socket exists
+        try:
+            self.sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(16)
+        self.sock.settimeout(0.5)
+
+    def serve_forever(self, stop=None):
+        """ :param stop: threading.Event to stop serving (after the running jobs) """
+        self._listen()
+        print('Listening on {} ({} jobs at once)'.format(self.socket_path, self.jobs))
+        try:
+            with _redirect_output():
+                try:
+                    while stop is None or not stop.is_set():
+                        try:
+                            conn, addr = self.sock.accept()
+                        except socket.timeout:
+                            continue
+                        threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+                finally:
+                    self.pool.shutdown()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.sock.close()
+            os.remove(self.socket_path)
+
+    def _handle(self, conn):
+        stream = _ClientStream(conn)
+        try:
+            with conn, conn.makefile('r', encoding='utf8') as f:
+                try:
+                    request = json.loads(f.readline())
+                    argv = absolute_args(request['argv'], request.get('cwd', '/'))
+                except (ValueError, KeyError, TypeError) as e:
+                    stream.send({'exit': 2, 'error': 'Bad request: {}'.format(e)})
+                    return
+                if 'watch' in argv or 'serve' in argv:
+                    stream.send({'exit': 2, 'error': 'watch and serve cannot run as jobs; run them directly'})
+                    return
+                if '--profile' in argv:
+                    # The profiler would take in whatever the other jobs are doing as well
+                    stream.send({'exit': 2, 'error': '--profile cannot be used for jobs; run photokeeper directly'})
+                    return
+                with self.lock:
+                    ahead = self.active
+                    self.active += 1
+                if ahead >= self.jobs:
+                    stream.write('Waiting for {} jobs ahead of this one\n'.format(ahead - self.jobs + 1))
+                try:
+                    code = self.pool.submit(self.run_job, argv, stream).result()
+                finally:
+                    with self.lock:
+                        self.active -= 1
+                stream.send({'exit': code})
+        except Exception:
+            logging.exception('Connection failed')
+
+    def run_job(self, argv, stream):
+        """ Run one photokeeper command line, with its output going to stream
+
+            :returns: Exit code
+        """
+        from photokeeper.photokeeper import PhotoKeeper
+        token = JOB_STREAM.set(stream)
+        logging.info('Job: {}'.format(' '.join(argv)))
+        try:
+            keeper = PhotoKeeper()
+            keeper.target_pool = self.targets
+            keeper.go(argv)
+            return 0
+        except SystemExit as e:   # Bad options (docopt, schema), or a clean exit() with a message
+            if isinstance(e.code, int) or e.code is None:
+                return e.code or 0
+            stream.write(str(e.code) + '\n')
+            return 1
+        except Exception:
+            stream.write(traceback.format_exc())
+            return 1
+        finally:
+            JOB_STREAM.reset(token)
+
+
+def _option_name(name):
+    """ The full name of a long option, also if it is abbreviated (as docopt allows) """
+    if name in VALUE_OPTIONS:
+        return name
+    matches = [o for o in VALUE_OPTIONS if o.startswith(name)]
+    return matches[0] if len(matches) == 1 else name
+
+
+def _map_args(argv, positional, option_value):
+    """ Rewrite a command line: positional(arg) for every positional argument, and
+        option_value(name, value) for the value of every option that takes one, whether it
+        is given as --name=value or as --name value
+    """
+    result = []
+    value_of = None
+    for arg in argv:
+        if value_of:
+            arg, value_of = option_value(value_of, arg), None
+        elif arg.startswith('--'):
+            name, sep, value = arg.partition('=')
+            full_name = _option_name(name)
+            if full_name in VALUE_OPTIONS:
+                if sep:
+                    arg = name + '=' + option_value(full_name, value)
+                else:
+                    value_of = full_name
+        elif not arg.startswith('-'):
+            arg = positional(arg)
+        result.append(arg)
+    return result
+
+
+def absolute_args(argv, cwd):
+    """ The daemon's working directory isn't the client's, so make the paths in a command line
+        absolute: the values of PATH_OPTIONS, and every positional argument that isn't a
+        command (those are SOURCE_DIR and TARGET_DIR).  ~ has been expanded by the client
+        already (see expand_user), since the daemon's home may not be the client's
+    """
+    from photokeeper.photokeeper import PhotoKeeper
+    from photokeeper.catalog import QUERIES
+    commands = set(PhotoKeeper().flow) | {'all', 'watch', 'query', 'serve'} | set(QUERIES)
+
+    def absolute(value):
+        return os.pathsep.join(os.path.join(cwd, p) for p in value.split(os.pathsep))
+
+    return _map_args(argv, lambda arg: arg if arg in commands else absolute(arg),
+                     lambda name, value: absolute(value) if name in PATH_OPTIONS else value)
+
+
+def expand_user(argv):
+    """ Expand ~ in the paths on a command line (positional arguments, each path of a
+        SOURCE_DIR list, and the values of PATH_OPTIONS) that the shell left alone
+    """
+    def expand(value):
+        return os.pathsep.join(os.path.expanduser(p) for p in value.split(os.pathsep))
+
+    return _map_args(argv, expand, lambda name, value: expand(value) if name in PATH_OPTIONS else value)
+
+
+def submit(argv, socket_path=DEFAULT_SOCKET, out=None):
+    """ Send a job to the daemon, and copy its output to out as it comes
+
+        :returns: The job's exit code
+    """
+    out = out or sys.stdout
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(os.path.expanduser(socket_path))
+    with sock, sock.makefile('rw', encoding='utf8') as f:
+        f.write(json.dumps({'argv': expand_user(argv), 'cwd': os.getcwd()}) + '\n')
+        f.flush()
+        for line in f:
+            message = json.loads(line)
+            if 'out' in message:
+                out.write(message['out'])
+                out.flush()
+            if 'exit' in message:
+                if message.get('error'):
+                    out.write(message['error'] + '\n')
+                return message['exit']
+    out.write('The daemon went away before the job finished\n')
+    return 1
+
+
+def main():
+    """ photokeeper-submit [--socket=FILE] <photokeeper arguments> """
+    argv = sys.argv[1:]
+    socket_path = DEFAULT_SOCKET
+    if argv and argv[0].startswith('--socket='):
+        socket_path = argv.pop(0).partition('=')[2]
+    try:
+        code = submit(argv, socket_path)
+    except OSError as e:
+        sys.exit('Cannot reach the photokeeper daemon on {} ({}); start one with: photokeeper serve'.format(socket_path, e))
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Find files that are in the source more than once (e.g. from overlapping card dumps), so
+    that each is only copied once.
+
+    Files are grouped by size first, which costs nothing but a stat.  Only files whose size
+    matches another's are read at all: first just their first HEAD_BYTES (for photos this
+    covers the EXIF block, with its timestamps, so almost every false match stops here), and
+    only the files still matching after that are hashed whole.
+"""
+
+import os, hashlib, logging
+from collections import OrderedDict
+
+from photokeeper.ingest import DeviceScheduler
+from photokeeper.metrics import NO_METRICS
+from photokeeper.utils import file_hash
+
+HEAD_BYTES = 64*1024
+
+
+def head_hash(filename, nbytes=None):
+    """ Hex SHA-1 of the first nbytes (HEAD_BYTES) of a file, which is its file_hash if it is
+        no bigger
+    """
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read(nbytes or HEAD_BYTES)).hexdigest()
+
+
+def _regroup(groups, keys):
+    """ Split each group by key, keeping only the parts with more than one file """
+    result = []
+    for group in groups:
+        by_key = OrderedDict()
+        for img in group:
+            by_key.setdefault(keys[id(img)], []).append(img)
+        result.extend(g for g in by_key.values() if len(g) > 1)
+    return result
+
+
+def find_duplicates(images, readers=2, metrics=NO_METRICS):
+    """ Group images whose files have identical contents.  The hashes are computed in
+        parallel, readers at a time per device (see ingest.DeviceScheduler), and any full hash
+        is kept in the ImageFile so later steps don't need to compute it again
+
+        :returns: List of groups (lists of two or more images, in their original order)
+    """
+    by_size = OrderedDict()
+    for img in images:
+        try:
+            size = img.stat().st_size
+        except OSError as e:
+            logging.warning('Cannot check {} for duplicates: {}'.format(img.srcpath, e))
+            continue
+        by_size.setdefault(size, []).append((img, size))
+    groups = [g for g in by_size.values() if len(g) > 1]
+    if not groups:
+        return []
+
+    with DeviceScheduler(readers) as scheduler:
+        def timed(fn, path):
+            with metrics.timer('hash'):
+                return fn(path)
+
+        def hash_all(jobs):
+            futures = [(img, scheduler.submit(scheduler.device(img.srcdir), timed, fn, img.srcpath)) for img, fn in jobs]
+            return {id(img): future.result() for img, future in futures}
+
+        # Stage 1: the start of each file (the whole file, if it is small)
+        jobs = []
+        for group in groups:
+            if all(img._sha1 for img, size in group):   # Hashed already, e.g. by the preview step
+                continue
+            jobs.extend((img, head_hash) for img, size in group)
+        keys = hash_all(jobs)
+        for group in groups:
+            for img, size in group:
+                if id(img) not in keys:
+                    keys[id(img)] = img._sha1
+                elif size <= HEAD_BYTES:
+                    img._sha1 = keys[id(img)]
+        groups = _regroup([[img for img, size in g] for g in groups], keys)
+
+        # Stage 2: whole files, for what still matches
+        keys = hash_all([(img, file_hash) for group in groups for img in group if img._sha1 is None])
+        for group in groups:
+            for img in group:
+                if id(img) in keys:
+                    img._sha1 = keys[id(img)]
+                keys[id(img)] = img._sha1
+        groups = _regroup(groups, keys)
+    metrics.count('dedupe.source_duplicates', sum(len(g) - 1 for g in groups))
+    return groups
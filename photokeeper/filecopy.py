@@ -12,61 +12,139 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import itertools
 import os, shutil, logging
 
 from photokeeper.target import TargetBase
+from photokeeper.autotune import AIMDController, run_adaptive
+from photokeeper.shots import shot_key
+from photokeeper.spool import Spool
 
 class FileCopy(TargetBase):
 
-    def __init__(self):
-        pass
+    max_workers = 16   # Upper limit for the autotuner; a local SSD can use this many
+
+    def __init__(self, spool_dir=None, spool_size=4096*1024*1024):
+        """
+            :param spool_dir: Stage the copies here first (see photokeeper.spool), and write
+                              them to the target in the background
+            :param spool_size: Bytes the spool may hold at once
+        """
+        # Kept for the life of the target, so watch mode starts each burst where the last one ended
+        self.controller = AIMDController('file', maximum=self.max_workers)
+        self.spool = None
+        if spool_dir:
+            self.spool = Spool(spool_dir, spool_size, self.controller, self._get_unique_filename_suffix)
+            self.spool.recover()   # Before any dedupe, which needs those files in the target
 
     def check_duplicates(self, images):
         """ This is easy, since all the functionality is built into the source image file
             object
         """
         print("Checking for duplicates")
-        images_1, images_2 = itertools.tee(images)
-        for total,img in enumerate(images_1):
+        images = list(images)
+        for img in images:
             if img.is_duplicate():
                 img.dup = True
 
-        n_dups = [i for i in images_2 if i.dup]
-        print('Found {} duplicates out of {} images'.format(len(n_dups), total+1))
+        n_dups = [i for i in images if i.dup]
+        print('Found {} duplicates out of {} images'.format(len(n_dups), len(images)))
 
 
-    def _get_unique_filename_suffix(self, filename):
+    def _get_unique_filename_suffix(self, filename, reserved=()):
+        """ reserved: names already handed out to copies that may not have been made yet """
         dirname = os.path.dirname(filename)
         fn_with_ext = os.path.basename(filename)
         fn, ext = os.path.splitext(fn_with_ext)
-        
+
+        def taken(name):
+            return name in reserved or os.path.exists(name)
+
         suffix = 1
-        if not os.path.exists(filename):  # Unique, no target filename conflict
+        if not taken(filename):  # Unique, no target filename conflict
             return filename
         else:
-            while os.path.exists(os.path.join(dirname, fn+'_'+str(suffix)+ext)):
+            while taken(os.path.join(dirname, fn+'_'+str(suffix)+ext)):
                 suffix += 1
             return (os.path.join(dirname, fn+'_'+str(suffix)+ext))
 
-    def execute_copy(self, images):
+    def _get_shot_filenames(self, shot, reserved=()):
+        """ Target names for the files of a shot (see photokeeper.shots) that are to be copied,
+            all with the same _N suffix if one is needed, so that they still go together
+            (DSC_0001_1.NEF, DSC_0001_1.JPG, DSC_0001_1.NEF.xmp)
 
-        skip_count = 0
-        print("Copying and sorting files")
-        for total, img in enumerate(images):
-            if img.dup: 
-                skip_count+=1
+            :returns: dict of id(ImageFile) to target name
+        """
+        members = [img for img in shot if not img.dup and img.same_as is None]
+        suffix = 0
+        while True:
+            names = {}
+            for img in members:
+                n = len(shot_key(img.filename)[1])   # Keep the extension(s) after the suffix
+                fn = img.filename[:n] + ('_'+str(suffix) if suffix else '') + img.filename[n:]
+                names[id(img)] = os.path.join(os.path.dirname(img.tgtpath), fn)
+            if not any(name in reserved or os.path.exists(name) for name in names.values()):
+                return names
+            suffix += 1
+
+    def _copy_jobs(self, images, counts):
+        """ Pick the target name of each copy here, in one thread, so that two copies running
+            at the same time can never be given the same name
+        """
+        reserved = set()
+        shot_names = {}
+        for img in images:
+            counts['total'] += 1
+            if img.dup:
+                counts['skipped'] += 1
                 continue
-            srcfn = img.srcpath
-            tgtfn = img.tgtpath
-            tgtdir = os.path.dirname(tgtfn)
-            tgtfn = self._get_unique_filename_suffix(tgtfn)
-            logging.info("Copying %s to %s" % (srcfn, tgtfn))
-            if not os.path.exists(tgtdir):
-                logging.info("Creating directory {}".format(tgtdir))
-                os.makedirs(tgtdir)
+            if img.shot:
+                if id(img.shot) not in shot_names:
+                    shot_names[id(img.shot)] = self._get_shot_filenames(img.shot, reserved)
+                    reserved.update(shot_names[id(img.shot)].values())
+                tgtfn = shot_names[id(img.shot)][id(img)]
+            else:
+                tgtfn = self._get_unique_filename_suffix(img.tgtpath, reserved)
+                reserved.add(tgtfn)
+            yield img.srcpath, tgtfn
 
+    def _copy_file(self, job):
+        srcfn, tgtfn = job
+        logging.info("Copying %s to %s" % (srcfn, tgtfn))
+        os.makedirs(os.path.dirname(tgtfn), exist_ok=True)
+        with self.metrics.timer('copy'):
             shutil.copyfile(srcfn, tgtfn)
+        size = os.path.getsize(tgtfn)
+        self.metrics.count('file.bytes_copied', size)
+        return size, tgtfn
+
+    def execute_copy(self, images):
+        """ Copy with as many files in flight as the target keeps getting faster with
+            (see photokeeper.autotune)
+        """
+        counts = {'total': 0, 'skipped': 0}
+        print("Copying and sorting files")
+        if self.spool:
+            self.spool.metrics = self.metrics
+            for srcfn, tgtfn in self._copy_jobs(images, counts):
+                logging.info("Staging %s for %s" % (srcfn, tgtfn))
+                self.spool.stage(srcfn, tgtfn)
+        else:
+            run_adaptive(self._copy_jobs(images, counts), self._copy_file, self.controller)
+            logging.info(self.controller.summary())
+        skip_count = counts['skipped']
+        copied = counts['total'] - skip_count
+        self.metrics.count('file.copied', copied)
+        self.metrics.count('file.skipped', skip_count)
         print ("Skipped {} duplicate files".format(skip_count))
-        print ("Copied {} files".format(total+1-skip_count))
+        if self.spool:
+            print ("Staged {} files in {}, writing them to the target in the background".format(copied, self.spool.spool_dir))
+        else:
+            print ("Copied {} files ({} at once)".format(copied, self.controller.limit))
 
+    def finish(self):
+        """ Wait for the spool to be written out """
+        if self.spool and self.spool.flusher:
+            print("Waiting for the spool to be written to the target")
+            with self.metrics.stage('file:spool'):
+                self.spool.finish()
+            print ("Copied {} files from the spool ({} at once)".format(self.spool.written, self.controller.limit))
@@ -0,0 +1,96 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Dates taken from file names, so that phone photos can be filed without being opened.
+
+    Phones (and a few apps) name their files after the time they were taken::
+
+        IMG_20160624_101202.jpg          Android
+        PXL_20160624_101202123.jpg       Pixel (with milliseconds)
+        20160624_101202.jpg              Samsung
+        Screenshot_20160624-101202.png
+        2016-06-24 10.12.02.jpg          Dropbox camera uploads
+        signal-2016-06-24-101202.jpg
+        IMG-20160624-WA0001.jpg          WhatsApp (date only)
+
+    More patterns can be given in a file, one regular expression per line, with named groups
+    Y, m, d and optionally H, M, S; they are tried before the built-in ones.
+
+    How the file name and EXIF are used together is up to the date policy:
+
+    * ``exif``: EXIF date first, then the file name, then the modification time.
+    * ``name``: the file name date if there is one, without opening the file; EXIF (then the
+      modification time) only for files whose names have no date.
+    * ``verify``: like exif, but note (and count) the files whose name says another day.
+"""
+
+import re, datetime
+
+DATE_POLICIES = ('exif', 'name', 'verify')
+
+BUILTIN_PATTERNS = [
+    r'(?<!\d)(?P<Y>(?:19|20)\d\d)(?P<m>\d\d)(?P<d>\d\d)[_-](?P<H>\d\d)(?P<M>\d\d)(?P<S>\d\d)',
+    r'(?<!\d)(?P<Y>(?:19|20)\d\d)-(?P<m>\d\d)-(?P<d>\d\d)[ _-](?P<H>\d\d)[.:-]?(?P<M>\d\d)[.:-]?(?P<S>\d\d)',
+    r'^(?:IMG|VID|AUD|PTT)-(?P<Y>(?:19|20)\d\d)(?P<m>\d\d)(?P<d>\d\d)-WA\d+',
+]
+
+
+def compile_pattern(pattern):
+    regex = re.compile(pattern)
+    missing = {'Y', 'm', 'd'} - set(regex.groupindex)
+    if missing:
+        raise ValueError('Date pattern {!r} has no group(s) {}'.format(pattern, ', '.join(sorted(missing))))
+    return regex
+
+
+def load_patterns(filename):
+    """ Read extra date patterns (one per line; blank lines and lines starting with # are skipped)
+
+        :raises: ValueError for a pattern that doesn't compile or lacks a group
+    """
+    patterns = []
+    with open(filename) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                patterns.append(compile_pattern(line))
+            except (re.error, ValueError) as e:
+                raise ValueError('{}:{}: {}'.format(filename, lineno, e))
+    return patterns
+
+
+class FilenameDater(object):
+    """ Get a datetime out of a file name with the first pattern that matches it """
+
+    def __init__(self, patterns=()):
+        """
+            :param patterns: compiled extra patterns, tried before BUILTIN_PATTERNS
+        """
+        self.patterns = list(patterns) + [compile_pattern(p) for p in BUILTIN_PATTERNS]
+
+    def date(self, filename):
+        """ :returns: datetime, or None if no pattern gives a valid date """
+        for regex in self.patterns:
+            m = regex.search(filename)
+            if not m:
+                continue
+            fields = m.groupdict()
+            try:
+                return datetime.datetime(*[int(fields.get(k) or 0) for k in ('Y', 'm', 'd', 'H', 'M', 'S')])
+            except ValueError:   # e.g. month 13: just a number that looked like a date
+                continue
+        return None
@@ -18,33 +18,65 @@ import logging
 import yaml, pprint
 import flickrapi
 import urllib.request
+import uuid
+import requests
 from xml.etree import ElementTree
 from tqdm import tqdm
 import itertools, dateparser, time
+from collections import OrderedDict
 
 from photokeeper.target import TargetBase
-
-
-
-
-class FileWithCallback(object):
-    def __init__(self, filename):
-        self.file = open(filename, 'rb')
-        # the following attributes and methods are required
-        self.len = os.path.getsize(filename)
-        self.fileno = self.file.fileno
-        self.tell = self.file.tell
-        self.tqdm = tqdm(total=self.len, ncols=60,unit_scale=True, unit='B')
-
-    def read(self, size):
-        self.tqdm.update(size)
-        return self.file.read(size)
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.tqdm.close()
+from photokeeper.utils import ContextPool
+from photokeeper.autotune import AIMDController, run_adaptive, retry_after_seconds
+from photokeeper.shots import is_sidecar
+
+
+
+
+class MultipartUpload(object):
+    """ A multipart/form-data request body that is generated while it is being sent.
+
+        The file is read through a fixed-size window, so neither the file nor the encoded body
+        is ever held in memory, no matter how big the video is.  requests sends any object with
+        __iter__ and __len__ as a streamed body with a Content-Length header.
+    """
+    window = 256*1024
+
+    def __init__(self, fields, file_field, filename, progress=None):
+        self.boundary = uuid.uuid4().hex
+        self.filename = filename
+        self.progress = progress
+        self.head = b''.join(self._part_header(name, extra='') + str(value).encode('utf8') + b'\r\n'
+                             for name, value in fields.items())
+        self.head += self._part_header(file_field, extra='; filename="%s"' % os.path.basename(filename).replace('"', ''),
+                                       content_type='application/octet-stream')
+        self.tail = ('\r\n--%s--\r\n' % self.boundary).encode('ascii')
+        self.file_size = os.path.getsize(filename)
+
+    def _part_header(self, name, extra, content_type=None):
+        header = '--%s\r\nContent-Disposition: form-data; name="%s"%s\r\n' % (self.boundary, name, extra)
+        if content_type:
+            header += 'Content-Type: %s\r\n' % content_type
+        return (header + '\r\n').encode('utf8')
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return len(self.head) + self.file_size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with open(self.filename, 'rb') as f:
+            while True:
+                block = f.read(self.window)
+                if not block:
+                    break
+                if self.progress:
+                    self.progress.update(len(block))
+                yield block
+        yield self.tail
 
 
 class FlickrMedia(object):
@@ -52,6 +84,7 @@ class FlickrMedia(object):
         self.json_dict = json_dict
         self.title = json_dict['title']
         self.photoid = json_dict['id']
+        self.machine_tags = json_dict.get('machine_tags', '').split()
 
         dt = json_dict['datetaken']
         self.datetime_taken = dateparser.parse(dt, date_formats=['%Y-%m-%d %H:%M:%S']) 
@@ -63,7 +96,9 @@ class PhotoSet(object):
         self.json_dict = json_dict
         self.title = json_dict['title']['_content']
         self.setid = json_dict['id']
-        self.photos = None
+        self.primary = json_dict.get('primary')
+        self.photos = None      # Photos without a hash tag, by title, once listed
+        self.photo_ids = None   # Ordered list of every photo id in the set, once listed
 
 class Photo(object):
     def __init__(self, photo_element):
@@ -88,11 +123,37 @@ class Photo(object):
         
 class Flickr(TargetBase):
 
-    def __init__(self):
-        self.set_keys(*self.read_keys())
-        self.get_auth2()
+    album_batch_size = 500   # Flush queued album additions after this many photos
+    hash_tag_namespace = 'photokeeper'
+    hash_query_batch_size = 8   # Flickr allows at most 8 machine tags in an 'any' search
+    hash_workers = 4
+    max_uploads = 8          # Upper limit for the autotuner; Flickr starts refusing uploads not far above this
+    upload_retries = 2       # Times to retry an upload that failed with a transient error
+    retry_backoff = 2.0      # Seconds before the first retry, doubled for each one after (or Retry-After)
+    transient_codes = (105, 106)   # Service currently unavailable, write operation failed
+
+    def __init__(self, flickr=None, title_dedupe=True):
+        """
+            :param flickr: An already authenticated flickrapi.FlickrAPI client to use instead of
+                           reading the keys from flickr_api.yaml and authenticating via the browser
+            :param title_dedupe: Treat photos whose hash isn't found, but that have the same title
+                                 and date as one in the album, as duplicates (for photos uploaded
+                                 before hash tags were added)
+        """
+        self.title_dedupe = title_dedupe
+        if flickr is None:
+            self.set_keys(*self.read_keys())
+            self.get_auth2()
+        else:
+            self.flickr = flickr
+            self.set_keys(flickr.flickr_oauth.key, None)
         # Might as well get all the photosets at this point as we'll need them
         self.photosets = self._get_photosets()
+        self.pending_album_adds = OrderedDict()
+        self.pending_dates = []
+        self.failed_album_adds = []   # From albums flushed during the run, reported by _flush_pending
+        # Kept for the life of the target, so watch mode starts each burst where the last one ended
+        self.controller = AIMDController('flickr', maximum=self.max_uploads)
 
 
     def read_keys(self):
@@ -188,44 +249,231 @@ class Flickr(TargetBase):
         return photosets
 
 
+    def _iter_album_photos(self, albumid, extras=None):
+        """ Yield the json dict of every photo in an album, going through all the pages
+        """
+        page, pages = 1, 1
+        while page <= pages:
+            resp = self.flickr.photosets.getPhotos(photoset_id=albumid, extras=extras, per_page=500, page=page, format='parsed-json')
+            pages = int(resp['photoset'].get('pages', 1))
+            for p in resp['photoset']['photo']:
+                yield p
+            page += 1
+
     def _get_photos_in_album(self, album_name, cached=False):
+        """ The photos in the album that have no hash tag (uploaded before there were any), by
+            title.  Photos with a hash tag are found by their hash, and never by title, so an
+            album without untagged photos is only listed once
+        """
         photoset = self.photosets[album_name]
         albumid = photoset.setid
-        if not photoset.photos or not cached:
-            resp = self.flickr.photosets.getPhotos(photoset_id=albumid, extras='date_taken', format='parsed-json')
+        if photoset.photos is None or not cached:
+            prefix = self.hash_tag_namespace + ':sha1='
             photos = {}
-            for p in resp['photoset']['photo']:
+            photo_ids = []
+            for p in self._iter_album_photos(albumid, extras='date_taken,machine_tags'):
                 myphoto = FlickrMedia(p)
-                photos[myphoto.title] = myphoto
+                if not any(tag.startswith(prefix) for tag in myphoto.machine_tags):
+                    photos[myphoto.title] = myphoto
+                photo_ids.append(myphoto.photoid)
             photoset.photos = photos
+            photoset.photo_ids = photo_ids
         return photoset.photos
 
-
-    def _upload_file(self, filename):
-        with FileWithCallback(filename) as f:
-            resp = self.flickr.upload(filename=filename, fileobj=f, is_public=0)
-            photoid = resp.find('photoid').text
-            return photoid
+    def _get_photo_ids_in_album(self, photoset):
+        if photoset.photo_ids is None:
+            photoset.photo_ids = [p['id'] for p in self._iter_album_photos(photoset.setid)]
+        return photoset.photo_ids
 
 
-    def _create_new_album(self, album_name, first_photo_filename):
-
-        # First, we need to upload a dummy photo
-        photoid = self._upload_file(first_photo_filename)
+    def _upload_file(self, filename, tags=None):
+        """ Upload a file with a streamed multipart body (see MultipartUpload), signed the
+            same way flickrapi signs its uploads: the OAuth signature covers every form field
+            except the photo itself.
+        """
+        params = {'api_key': self.flickr.flickr_oauth.key, 'is_public': '0',
+                  'title': os.path.basename(filename)}
+        if tags:
+            params['tags'] = tags
+        oauth = self.flickr.flickr_oauth
+        signed = requests.Request('POST', self.flickr.UPLOAD_URL, data=params, auth=oauth.oauth).prepare()
+
+        with tqdm(total=os.path.getsize(filename), ncols=60, unit_scale=True, unit='B') as progress, self.metrics.timer('upload'):
+            body = MultipartUpload(params, 'photo', filename, progress)
+            headers = {'Authorization': signed.headers.get('Authorization'), 'Content-Type': body.content_type}
+            resp = oauth.session.post(self.flickr.UPLOAD_URL, data=body, headers=headers, timeout=oauth.default_timeout)
+        if resp.status_code != 200:
+            e = flickrapi.FlickrError('Upload of {} failed with status code {}'.format(filename, resp.status_code))
+            e.http_status = resp.status_code
+            e.retry_after = retry_after_seconds(resp.headers.get('Retry-After'))
+            raise e
+        photoid = self.flickr.parse_etree(resp.content).find('photoid').text
+        self.metrics.count('flickr.uploaded')
+        return photoid
+
+
+    def _is_transient(self, e):
+        """ Errors worth retrying (after a pause, see run_adaptive): Flickr being busy,
+            throttling (HTTP 429), server errors and dropped connections
+        """
+        if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+            return True
+        if not isinstance(e, flickrapi.FlickrError):
+            return False
+        status = getattr(e, 'http_status', None)
+        return e.code in self.transient_codes or status == 429 or (status or 0) >= 500
 
-        resp = self.flickr.photosets.create(title=album_name, primary_photo_id=photoid, format='parsed-json')
+    def _create_new_album(self, album_name, primary_photoid):
+        """ Albums can't be empty, so one is made with an already uploaded photo as its primary
+        """
+        resp = self.flickr.photosets.create(title=album_name, primary_photo_id=primary_photoid, format='parsed-json')
          
         albumid = resp['photoset']['id']
         resp = self.flickr.photosets.getInfo(photoset_id=albumid, format='parsed-json')
-
-        return (photoid, resp['photoset'])
+        p = PhotoSet(resp['photoset'])
+        p.photo_ids = [primary_photoid]
+        p.photos = {}   # Everything we upload has a hash tag
+        self.photosets[p.title] = p
+        return p
 
         
     def _add_photo_to_album(self, photoid, albumid):
         #tqdm.write("Adding {} to {} ".format(photoid, albumid))
         self.flickr.photosets.addPhoto(photoset_id=albumid, photo_id=photoid)
 
+    def _queue_photo_for_album(self, photoid, album_name):
+        """ Album membership is batched up; see _flush_album
+        """
+        queue = self.pending_album_adds.setdefault(album_name, [])
+        queue.append(photoid)
+        if len(queue) >= self.album_batch_size and album_name in self.photosets:
+            self.failed_album_adds.extend(self._flush_album(album_name))
+
+    def _flush_album(self, album_name):
+        """ Add all the queued photos to the album in one photosets.editPhotos call.
+
+            editPhotos replaces the whole membership list, so the current photos of the
+            album (in their current order) go first, followed by the new ones in upload order.
+            If the bulk call fails, fall back to adding the photos one at a time, so that
+            one bad id can't keep the rest out of the album.
+
+            :returns: List of photo ids that could not be added
+        """
+        queue = self.pending_album_adds.pop(album_name, [])
+        if not queue:
+            return []
+        if album_name not in self.photosets:
+            # The upload that was to create the album failed, but later ones made it
+            try:
+                self._create_new_album(album_name, queue[0])
+            except flickrapi.FlickrError as e:
+                logging.error("Could not create album {}: {}".format(album_name, e))
+                return queue
+        photoset = self.photosets[album_name]
+        try:
+            existing = self._get_photo_ids_in_album(photoset)
+            present = set(existing)
+            photo_ids = existing + [p for p in queue if p not in present]
+            primary = photoset.primary or photo_ids[0]
+            logging.info("Adding {} photos to album {} in one batch".format(len(queue), album_name))
+            self.flickr.photosets.editPhotos(photoset_id=photoset.setid, primary_photo_id=primary,
+                                             photo_ids=','.join(photo_ids))
+            photoset.photo_ids = photo_ids
+            return []
+        except flickrapi.FlickrError as e:
+            tqdm.write("Batch update of album {} failed ({}), adding photos one at a time".format(album_name, e))
+            photoset.photo_ids = None  # Don't trust our view of the album any more
+
+        failed = []
+        for photoid in queue:
+            try:
+                self._add_photo_to_album(photoid, photoset.setid)
+            except flickrapi.FlickrError as e:
+                if str(e.code) == '3':  # Photo already in set, so the batch call got partway
+                    continue
+                logging.error("Could not add photo {} to album {}: {}".format(photoid, album_name, e))
+                failed.append(photoid)
+        return failed
+
+    def _set_dates(self, photoid, date_taken):
+        self.flickr.photos.setDates(photo_id=photoid, date_taken=date_taken)
+
+    def _flush_pending(self):
+        """ Push out all the queued album memberships and date changes.
+            Membership goes first, so a failing date update can't leave photos out of albums
+        """
+        failed, self.failed_album_adds = self.failed_album_adds, []
+        for album_name in list(self.pending_album_adds):
+            failed.extend(self._flush_album(album_name))
+        pending_dates, self.pending_dates = self.pending_dates, []
+        for photoid, date_taken in pending_dates:
+            try:
+                self._set_dates(photoid, date_taken)
+            except flickrapi.FlickrError as e:
+                logging.error("Could not set date of photo {} to {}: {}".format(photoid, date_taken, e))
+                failed.append(photoid)
+        if failed:
+            raise flickrapi.FlickrError("Uploaded photos could not be added to albums or dated: {}".format(','.join(failed)))
+
+    def _hash_tag(self, sha1):
+        return '{}:sha1={}'.format(self.hash_tag_namespace, sha1)
+
+    def _find_hashes(self, hashes):
+        """ Look up which of the content hashes are already on Flickr, by searching for their
+            machine tags a batch at a time.
+
+            :returns: Dict of hash to Flickr photo id for the hashes that were found
+        """
+        found = {}
+        prefix = self.hash_tag_namespace + ':sha1='
+        hashes = sorted(set(hashes))
+        for i in range(0, len(hashes), self.hash_query_batch_size):
+            batch = hashes[i:i+self.hash_query_batch_size]
+            resp = self.flickr.photos.search(user_id='me', machine_tags=','.join(self._hash_tag(h) for h in batch),
+                                             machine_tag_mode='any', extras='machine_tags', per_page=500,
+                                             format='parsed-json')
+            for p in resp['photos']['photo']:
+                for tag in p.get('machine_tags', '').split():
+                    if tag.startswith(prefix):
+                        found[tag[len(prefix):]] = p['id']
+        return found
+
+    def _get_photos_not_in_albums(self):
+        """ Ids of all the photos that aren't in any album """
+        ids = set()
+        page, pages = 1, 1
+        while page <= pages:
+            resp = self.flickr.photos.getNotInSet(per_page=500, page=page, format='parsed-json')
+            pages = int(resp['photos'].get('pages', 1))
+            ids.update(p['id'] for p in resp['photos']['photo'])
+            page += 1
+        return ids
+
+    def _requeue_orphans(self, images, on_flickr):
+        """ Photos that made it to Flickr, but not into an album (the run that uploaded them
+            was stopped before its album additions were flushed), are queued for their album
+            (and date) again, to be flushed by execute_copy.  Photos that are in some other
+            album were put there by the user, and are left alone.
+        """
+        orphans = self._get_photos_not_in_albums() & set(on_flickr.values())
+        for img in images:
+            photoid = on_flickr.get(img.sha1)
+            if photoid not in orphans:
+                continue
+            orphans.discard(photoid)   # Once, even if the file is in the source more than once
+            tqdm.write("{} is on Flickr but not in an album, adding it to {}".format(img.filename, img.tgtdatedir))
+            self.pending_album_adds.setdefault(img.tgtdatedir, []).append(photoid)
+            if img.exif_timestamp_missing:
+                self.pending_dates.append((photoid, img.datetime_taken.strftime('%Y-%m-%d %H:%M:%S')))
+
+    def _hash_image(self, img):
+        with self.metrics.timer('hash'):
+            return img.sha1
+
     def _is_duplicate(self, image):
+        """ Legacy check for photos uploaded without a hash tag: same title and date as an
+            untagged photo in the album
+        """
         album_name = image.tgtdatedir
 
         if not album_name in self.photosets:
@@ -245,38 +493,82 @@ class Flickr(TargetBase):
 
 
     def check_duplicates(self, images):
+        """ Mark images whose contents are already on Flickr, whichever album they are in.
+
+            Every upload carries a photokeeper:sha1=<hash> machine tag, so this takes one
+            photos.search call per batch of hashes.  Only the albums of images that weren't
+            found that way are listed (once), to look for them by title and date among the
+            photos that have no hash tag (see _is_duplicate).
+        """
         print("Checking for duplicates in Flickr")
-        images_1, images_2 = itertools.tee(images)
-        for total,img in enumerate(images_1):
-            if self._is_duplicate(img):
+        images = list(images)
+        with ContextPool(max_workers=self.hash_workers) as pool:
+            hashes = list(pool.map(self._hash_image, images))
+        on_flickr = self._find_hashes(hashes)
+        if on_flickr:
+            self._requeue_orphans(images, on_flickr)
+
+        for img in images:
+            if img.sha1 in on_flickr:
+                img.flickr_dup = True
+            elif self.title_dedupe and self._is_duplicate(img):
                 img.flickr_dup = True
 
-        n_dups = [i for i in images_2 if i.flickr_dup]
-        print('Found {} duplicates out of {} images'.format(len(n_dups), total+1))
+        n_dups = [i for i in images if i.flickr_dup]
+        print('Found {} duplicates out of {} images'.format(len(n_dups), len(images)))
 
 
     def execute_copy(self, images):
-
-        for img in images:
-            if img.flickr_dup: continue
-            album_name = img.tgtdatedir
-            if album_name not in self.photosets:
-                # Need to create album
-                tqdm.write('Creating new album %s' % album_name)
-                photoid, album_dict = self._create_new_album(album_name, img.srcpath)
-                p = PhotoSet(album_dict)
-                self.photosets[p.title] = p
-            else:
-                photoid = self._upload_file(img.srcpath)
-                self._add_photo_to_album(photoid, self.photosets[album_name].setid)
-
-            tqdm.write("Adding {} to {} ".format(img.filename, album_name))
-            # Now, make sure we set the date-taken manually if no exif information
-            if img.exif_timestamp_missing:
-                dt = img.datetime_taken.strftime('%Y-%m-%d %H:%M:%S')
-                tqdm.write('Manually setting date on video {} to {}'.format(img.filename, dt))
-                self.flickr.photos.setDates(photo_id=photoid, date_taken=dt)
-
+        """ Upload the images.  Only the upload itself happens per photo; adding to albums and
+            setting dates is queued (check_duplicates may have queued some already) and flushed
+            in bulk, also if an upload fails partway through
+        """
+        try:
+            self._upload_images(images)
+        except Exception:
+            # Don't leave the photos we did manage to upload out of their albums
+            try:
+                self._flush_pending()
+            except flickrapi.FlickrError as e:
+                logging.error(e)
+            raise
+        self._flush_pending()
+
+    def _upload_image(self, img):
+        photoid = self._upload_file(img.srcpath, self._hash_tag(img.sha1))
+        return os.path.getsize(img.srcpath), photoid
+
+    def _uploaded(self, img, photoid):
+        """ Album and date bookkeeping for one upload.  Called in upload order, from the
+            thread running execute_copy, so none of this needs locking
+        """
+        album_name = img.tgtdatedir
+        if album_name not in self.photosets:
+            tqdm.write('Creating new album %s' % album_name)
+            self._create_new_album(album_name, photoid)
+        else:
+            self._queue_photo_for_album(photoid, album_name)
+
+        tqdm.write("Adding {} to {} ".format(img.filename, album_name))
+        # Now, make sure we set the date-taken manually if no exif information
+        if img.exif_timestamp_missing:
+            dt = img.datetime_taken.strftime('%Y-%m-%d %H:%M:%S')
+            tqdm.write('Manually setting date on video {} to {}'.format(img.filename, dt))
+            self.pending_dates.append((photoid, dt))
+
+    def _upload_images(self, images):
+        """ Upload with as many files in flight as Flickr keeps getting faster with (see
+            photokeeper.autotune), backing off and retrying when it says it is too busy
+        """
+        try:
+            # Sidecars (e.g. .xmp) only make sense next to their RAW file, and Flickr won't take them
+            run_adaptive((img for img in images if not img.flickr_dup and not is_sidecar(img.filename)),
+                         self._upload_image, self.controller,
+                         done=self._uploaded, retryable=self._is_transient, retries=self.upload_retries,
+                         backoff=self.retry_backoff)
+        finally:
+            logging.info(self.controller.summary())
+        print("Uploaded with {} at once".format(self.controller.limit))
 
 
 def main():
@@ -0,0 +1,76 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Read from several sources at once.
+
+    Each physical device (card reader, disk) gets its own small pool of reader threads, so
+    a slow card doesn't hold up the others, and no device is hit with more concurrent reads
+    than it can usefully serve.
+"""
+
+import os, logging, threading
+
+from photokeeper.utils import ContextPool
+
+
+def physical_device(path):
+    """ Identify the device path lives on.
+
+        On Linux, partitions of the same disk are mapped to the disk itself (through
+        /sys/dev/block), since they share its bandwidth.  Elsewhere this is just st_dev.
+    """
+    dev = os.stat(path).st_dev
+    sysfs = os.path.realpath('/sys/dev/block/%d:%d' % (os.major(dev), os.minor(dev)))
+    if os.path.exists(os.path.join(sysfs, 'partition')):
+        return os.path.basename(os.path.dirname(sysfs))
+    elif os.path.exists(sysfs):
+        return os.path.basename(sysfs)
+    return dev
+
+
+class DeviceScheduler(object):
+    """ Run file jobs with at most readers of them at a time per device """
+
+    def __init__(self, readers=2):
+        self.readers = readers
+        self.pools = {}
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def device(self, path):
+        """ Device of a source directory (looked up once per directory) """
+        with self.lock:
+            if path not in self.devices:
+                self.devices[path] = physical_device(path)
+                logging.debug('{} is on device {}'.format(path, self.devices[path]))
+            return self.devices[path]
+
+    def submit(self, device, fn, *args):
+        with self.lock:
+            if device not in self.pools:
+                self.pools[device] = ContextPool(max_workers=self.readers)
+            pool = self.pools[device]
+        return pool.submit(fn, *args)
+
+    def shutdown(self, cancel=False):
+        for pool in self.pools.values():
+            pool.shutdown(cancel_futures=cancel)
+        self.pools = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown(cancel=exc_type is not None)
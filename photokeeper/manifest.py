@@ -0,0 +1,126 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Scan manifests: the result of the examine step, saved so that the copy can run somewhere else.
+
+    A manifest is a JSON-lines file (gzipped if the name ends in .gz).  The first line is a
+    header, then there is one line per file::
+
+        {"photokeeper_manifest": 1, "version": "...", "created": "...", "sources": ["/media/card1"]}
+        {"path": "/media/card1/DCIM/IMG_0001.JPG", "size": 5123456, "mtime": 1466788320.0,
+         "taken": "2016-06-24T10:12:00", "day": "2016-06-24", "sha1": "..."}
+
+    "no_exif" is only written when the date didn't come from EXIF (but from the file name or
+    the file time), and "sha1" only when hashes were asked for.  Files are read back one line
+    at a time, so a manifest for a huge library doesn't have to fit in memory to be checked.
+"""
+
+import os, gzip, json, datetime, logging
+
+from photokeeper.version import __version__
+
+FORMAT_VERSION = 1
+
+
+class ManifestError(Exception):
+    pass
+
+
+def _open(filename, mode):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf8')
+    return open(filename, mode, encoding='utf8')
+
+
+def parse_remap(remap):
+    """ Turn 'OLD=NEW' (several separated by os.pathsep) into a list of (old, new) prefixes,
+        longest first so the most specific one wins
+    """
+    pairs = []
+    for item in (remap or '').split(os.pathsep):
+        if not item:
+            continue
+        old, sep, new = item.partition('=')
+        if not sep or not old:
+            raise ManifestError('Bad path remapping {!r}, expected OLD=NEW'.format(item))
+        pairs.append((old.rstrip('/') or '/', new.rstrip('/') or '/'))
+    return sorted(pairs, key=lambda p: len(p[0]), reverse=True)
+
+
+def remap_path(path, remaps):
+    for old, new in remaps:
+        if path == old:
+            return new
+        if path.startswith(old.rstrip('/') + '/'):
+            return os.path.join(new, path[len(old.rstrip('/'))+1:])
+    return path
+
+
+def write_manifest(filename, images, sources=(), hashes=False):
+    """ Save ImageFiles to a manifest
+
+        :param hashes: Also record each file's SHA-1 (hashing it now if need be)
+        :returns: Number of files written
+    """
+    n = 0
+    with _open(filename, 'w') as f:
+        header = {'photokeeper_manifest': FORMAT_VERSION,
+                  'version': __version__,
+                  'created': datetime.datetime.now().isoformat(),
+                  'sources': [os.path.abspath(s) for s in sources]}
+        f.write(json.dumps(header) + '\n')
+        for img in images:
+            st = img.stat()
+            record = {'path': os.path.abspath(img.srcpath),
+                      'size': st.st_size,
+                      'mtime': st.st_mtime,
+                      'taken': img.datetime_taken.isoformat(),
+                      'day': img.tgtdatedir}
+            if img.exif_timestamp_missing:
+                record['no_exif'] = True
+            if hashes or img._sha1:
+                record['sha1'] = img.sha1
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            n += 1
+    return n
+
+
+def read_manifest(filename, make_image, remaps=()):
+    """ Yield one ImageFile per manifest record
+
+        :param make_image: Called as make_image(srcdir, filename, tgtdatedir, datetime_taken, exif_timestamp_missing)
+        :param remaps: (old, new) source path prefixes from parse_remap
+    """
+    with _open(filename, 'r') as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            header = {}
+        if not isinstance(header, dict) or header.get('photokeeper_manifest') != FORMAT_VERSION:
+            raise ManifestError('{} is not a photokeeper manifest (or is from an incompatible version)'.format(filename))
+        logging.info('Manifest {} made by photokeeper {} at {} from {}'.format(
+            filename, header.get('version'), header.get('created'), ', '.join(header.get('sources', []))))
+        for line_no, line in enumerate(f, 2):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                path = remap_path(record['path'], remaps)
+                img = make_image(os.path.dirname(path), os.path.basename(path), record['day'],
+                                 datetime.datetime.fromisoformat(record['taken']), record.get('no_exif', False))
+            except (ValueError, KeyError) as e:
+                raise ManifestError('{} line {}: bad record ({})'.format(filename, line_no, e))
+            img._sha1 = record.get('sha1')
+            yield img
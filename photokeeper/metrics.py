@@ -0,0 +1,171 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, time, math, json, logging, threading, contextlib, cProfile, pstats, io
+from collections import OrderedDict, defaultdict, Counter
+
+# From 3.12 cProfile is built on sys.monitoring: a profiler sees every thread, and only one
+# can be enabled at a time in a process
+PROFILER_PER_THREAD = sys.version_info < (3, 12)
+
+
+class _ThreadProfiles(object):
+    """ Profile the threads started while a stage runs (the reader, copy and upload pools),
+        each with its own cProfile.Profile, since before 3.12 a profiler only sees its own thread
+    """
+
+    def __init__(self):
+        self.profilers = []
+        self.lock = threading.Lock()
+
+    def start_thread(self, frame, event, arg):
+        """ threading.setprofile hook: runs once, as each new thread starts """
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        with self.lock:
+            self.profilers.append(profiler)
+        profiler.enable()
+
+
+class Metrics(object):
+    """ Collects run metrics: wall time per flow stage, per-file latencies (parse, hash,
+        copy, upload...) and simple counters, and writes them out as a JSON report.
+
+        A disabled instance (the default everywhere) makes all the hooks no-ops, so
+        the instrumented code doesn't need to check whether metrics are wanted.
+    """
+
+    def __init__(self, enabled=True, profile=False):
+        self.enabled = enabled
+        self.profile = profile
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.samples = defaultdict(list)
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Time a flow stage, and run it (and the threads it starts) under cProfile if
+            profiling was asked for
+        """
+        if not self.enabled:
+            yield
+            return
+        profiler = cProfile.Profile() if self.profile else None
+        threads = _ThreadProfiles() if self.profile and PROFILER_PER_THREAD else None
+        t0 = time.perf_counter()
+        if profiler:
+            try:
+                profiler.enable()
+            except ValueError as e:   # 3.12+: another stage (or job in a daemon) is being profiled
+                logging.warning('Not profiling {}: {}'.format(name, e))
+                profiler = threads = None
+        if threads:
+            threading.setprofile(threads.start_thread)
+        try:
+            yield
+        finally:
+            if threads:
+                threading.setprofile(None)
+            if profiler:
+                profiler.disable()
+            stage = self.stages.setdefault(name, {'seconds': 0.0})
+            stage['seconds'] += time.perf_counter() - t0
+            if profiler:
+                stage['profilers'] = [profiler] + (threads.profilers if threads else [])
+
+    @contextlib.contextmanager
+    def timer(self, kind):
+        """ Record how long the body took as one latency sample of the given kind """
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(kind, time.perf_counter() - t0)
+
+    def record(self, kind, seconds):
+        if self.enabled:
+            with self.lock:
+                self.samples[kind].append(seconds)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += n
+
+    @staticmethod
+    def percentile(sorted_samples, pct):
+        """ Nearest-rank percentile of an already sorted list """
+        if not sorted_samples:
+            return None
+        k = max(math.ceil(pct / 100.0 * len(sorted_samples)) - 1, 0)
+        return sorted_samples[k]
+
+    def _latency_summary(self, samples):
+        s = sorted(samples)
+        return OrderedDict([('count', len(s)),
+                            ('total', sum(s)),
+                            ('mean', sum(s)/len(s) if s else None),
+                            ('p50', self.percentile(s, 50)),
+                            ('p90', self.percentile(s, 90)),
+                            ('p99', self.percentile(s, 99)),
+                            ('max', s[-1] if s else None)])
+
+    def _profile_summary(self, profilers, limit=25):
+        """ The functions with the most cumulative time, over all the threads of a stage """
+        stats = pstats.Stats(*profilers, stream=io.StringIO())
+        rows = []
+        for (filename, line, func), (cc, nc, tt, ct, callers) in stats.stats.items():
+            rows.append(OrderedDict([('function', '%s:%d(%s)' % (filename, line, func)),
+                                     ('ncalls', nc), ('tottime', tt), ('cumtime', ct)]))
+        rows.sort(key=lambda r: r['cumtime'], reverse=True)
+        return rows[:limit]
+
+    def report(self):
+        stages = []
+        for name, stage in self.stages.items():
+            s = OrderedDict([('name', name), ('seconds', stage['seconds'])])
+            if 'profilers' in stage:
+                s['profile'] = self._profile_summary(stage['profilers'])
+            stages.append(s)
+        return OrderedDict([('started', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))),
+                            ('wall_seconds', time.time() - self.started),
+                            ('stages', stages),
+                            ('latency', OrderedDict((k, self._latency_summary(v)) for k, v in sorted(self.samples.items()))),
+                            ('counters', dict(self.counters))])
+
+    def write(self, filename, **extra):
+        report = self.report()
+        report.update(extra)
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+    def print_summary(self):
+        """ Short human readable version of the report, for --profile without --metrics """
+        report = self.report()
+        print('Stage timings:')
+        for stage in report['stages']:
+            print('    {:20s} {:10.3f}s'.format(stage['name'], stage['seconds']))
+            for row in stage.get('profile', [])[:10]:
+                print('        {cumtime:9.3f}s {ncalls:8d}  {function}'.format(**row))
+        for kind, lat in report['latency'].items():
+            print('    {:10s} n={count} p50={p50:.4f}s p90={p90:.4f}s p99={p99:.4f}s max={max:.4f}s'.format(kind, **lat))
+
+
+NO_METRICS = Metrics(enabled=False)
@@ -20,13 +20,29 @@ Usage:
     photokeeper.py [options] SOURCE_DIR [dedupe] flickr
     photokeeper.py [options] SOURCE_DIR TARGET_DIR [dedupe] file flickr
     photokeeper.py [options] SOURCE_DIR TARGET_DIR all
+    photokeeper.py [options] SOURCE_DIR TARGET_DIR [dedupe] file [flickr] watch
+    photokeeper.py [options] SOURCE_DIR [dedupe] flickr watch
+    photokeeper.py [options] SOURCE_DIR [dedupe] [flickr] s3 [watch]
+    photokeeper.py [options] SOURCE_DIR TARGET_DIR [dedupe] file [flickr] s3 [watch]
+    photokeeper.py [options] SOURCE_DIR TARGET_DIR [dedupe] pack [flickr] [s3] [watch]
+    photokeeper.py [options] SOURCE_DIR TARGET_DIR preview [dedupe] [file] [pack] [flickr] [s3] [watch]
+    photokeeper.py [options] query (days|months|noexif|dupes|albums)
+    photokeeper.py [options] serve
     photokeeper.py --conf=FILE
     photokeeper.py -h
 
 Arguments:
-    SOURCE_DIR  Source directory of photos
+    SOURCE_DIR  Source directory of photos; separate several with the path separator
+                (':' on Linux and macOS) to read them all at once.  Can also be a manifest
+                saved with --save-manifest, to copy without scanning again
     TARGET_DIR  Where to copy the image files
     all         Run all steps in the flow (%s)
+    watch       Keep running, and push new files through the steps as they arrive
+    query       Answer a question from the --catalog, without looking at any files:
+                days/months: files and bytes per day/month, noexif: files without an EXIF
+                date, dupes: files stored more than once, albums: files and bytes per target album
+    serve       Keep running, and run the command lines sent with photokeeper-submit over
+                the --socket, keeping the targets (and e.g. Flickr logins) between them
 %s
 
 Options:
@@ -34,12 +50,43 @@ Options:
     -v --verbose     show more information
     -d --debug       show even more information
     --conf=FILE      load options from file
+    --debounce=SECS  in watch mode, wait until no new files have arrived for this
+                     long before processing them [default: 2]
+    --poll=SECS      in watch mode, poll for new files every SECS seconds instead of using inotify
+    --profile        run each flow step (and the threads it starts) under cProfile and print
+                     where the time went
+    --metrics=FILE   write step timings, per-file latency percentiles and counters
+                     to FILE as JSON
+    --save-manifest=FILE  save what examine found (paths, sizes, dates) to FILE, gzipped
+                     if FILE ends in .gz
+    --manifest-hashes  also hash every file into the saved manifest
+    --remap=OLD=NEW  when reading a manifest, replace the OLD source path prefix with NEW
+                     (separate several with the path separator)
+    --catalog=FILE   keep a catalog (SQLite) of everything examined and copied in FILE
+    --readers=N      files to read at once from each source device [default: 2]
+    --io-order=ORDER  read and copy files in walk (directory), inode or disk (physical
+                     block) order; inode or disk order avoids seeking on spinning disks [default: walk]
+    --date-policy=POLICY  date files by exif (EXIF, else the file name, else the modification
+                     time), name (the date in the file name, without opening the file, if
+                     there is one) or verify (like exif, and report files whose name says
+                     another day) [default: exif]
+    --date-patterns=FILE  more file name date patterns, one regular expression per line with
+                     named groups Y, m, d and optionally H, M, S
+    --spool=DIR      copy files into DIR (on a fast local disk) first, and from there to a
+                     slow TARGET_DIR in the background, so the source can be ejected sooner
+    --spool-size=MB  most the spool holds at once [default: 4096]
+    --s3-conf=FILE   S3 endpoint, bucket and credentials [default: s3.yaml]
+    --socket=FILE    Unix socket for serve and photokeeper-submit [default: ~/.photokeeper.sock]
+    --jobs=N         command lines serve runs at once [default: 2]
+    --flickr-no-title-dedupe  only find duplicates on Flickr by their hash tag, not also by
+                     title and date in the album (which finds photos uploaded without a
+                     hash tag, but lists the albums)
 
 """
 
 from docopt import docopt
 import yaml
-import sys, os, logging, shutil, datetime, pprint, filecmp
+import sys, os, logging, shutil, datetime, pprint, filecmp, contextlib, queue, threading
 from collections import OrderedDict, defaultdict
 from schema import Schema, And, Optional, Or, Use, SchemaError
 import piexif, dateparser
@@ -47,9 +94,23 @@ import piexif, dateparser
 from tqdm import tqdm
 from photokeeper.flickr import Flickr
 from photokeeper.filecopy import FileCopy
+from photokeeper.s3 import S3
+from photokeeper.archive import DayArchive
+from photokeeper.metrics import Metrics, NO_METRICS
+from photokeeper.watch import make_watcher, watch
+from photokeeper.ingest import DeviceScheduler
+from photokeeper.preview import PreviewCache, make_previews
+from photokeeper.ioorder import physical_order, ORDERS
+from photokeeper.walk import walk_files
+from photokeeper.duplicates import find_duplicates
+from photokeeper.filedate import FilenameDater, DATE_POLICIES, load_patterns
+from photokeeper.shots import group_shots, exif_candidates, primary_member
+from photokeeper.catalog import Catalog, QUERIES, print_table
+from photokeeper.daemon import Daemon
+from photokeeper.manifest import write_manifest, read_manifest, parse_remap, ManifestError
 
 from photokeeper.version import __version__
-from photokeeper.utils import ordered_load, merge_args
+from photokeeper.utils import ordered_load, merge_args, file_hash, context_thread
 
 """
    
@@ -65,10 +126,29 @@ class ImageFile(object):
         self.datetime_taken = datetime_taken
         self.dup = False
         self.flickr_dup = False
+        self.s3_dup = False
+        self.archive_dup = False
         self.exif_timestamp_missing = exif_timestamp_missing
+        self._sha1 = None
+        self._stat = None
+        self.same_as = None   # The first ImageFile with the same contents, if this one is a copy of it
+        self.shot = None      # All the ImageFiles of the shot (RAW, JPEG, sidecars), if there is more than one
         #print("adding {} with datetime {}".format(filename, datetime_taken.strftime('%Y-%m-%d %H:%M:%S')))
         pass
 
+    @property
+    def sha1(self):
+        """ Hex SHA-1 of the file contents.  Only computed (once) when somebody asks for it """
+        if self._sha1 is None:
+            self._sha1 = file_hash(self.srcpath)
+        return self._sha1
+
+    def stat(self):
+        """ os.stat() of the source file, as the directory walk found it if it did """
+        if self._stat is None:
+            self._stat = os.stat(self.srcpath)
+        return self._stat
+
     @property
     def srcpath(self):
         return os.path.join(self.srcdir, self.filename)
@@ -99,11 +179,24 @@ class PhotoKeeper(object):
         """
         self.args = None
         self.flow = OrderedDict([ ('examine', 'Examine EXIF tags'),
-                                  ('dedupe', 'Only select files not already present in target directory'),
+                                  ('preview', 'Save the embedded EXIF thumbnails to TARGET_DIR/.previews'),
+                                  ('dedupe', 'Only select files not already present in target directory (or earlier in the source)'),
                                   ('flickr', 'Upload to flickr'),
                                   ('file',    'Copy files'),
+                                  ('s3',      'Upload to S3-compatible object storage'),
+                                  ('pack',    'Pack files into one tar archive per day (with an index) in TARGET_DIR'),
                       ])
+        self.extra_steps = ['preview', 's3', 'pack']   # Only run when asked for by name, not as part of 'all'
         self.images = []
+        self.metrics = NO_METRICS
+        self.catalog = None
+        self.manifest = None
+        self.remaps = []
+        self.readers = 2
+        self.io_order = 'walk'
+        self.date_policy = 'exif'
+        self.dater = FilenameDater()
+        self.target_pool = None   # daemon.TargetPool, to keep the targets between runs
 
 
 
@@ -122,9 +215,9 @@ class PhotoKeeper(object):
         """
         padding = max([len(x) for x in self.flow.keys()]) # Find max length of flow step names for padding with white space
         docstring = __doc__ % (#'|'.join(self.flow), 
-                              ','.join(self.flow.keys()),
+                              ','.join(k for k in self.flow.keys() if k not in self.extra_steps),
                               '\n'.join(['    '+k+' '*(padding+4-len(k))+v for k,v  in self.flow.items()]))
-        args = docopt(docstring, version=__version__)
+        args = docopt(docstring, argv=argv, version=__version__)
 
         # Load in default conf values from file if specified
         if args['--conf']:
@@ -135,8 +228,15 @@ class PhotoKeeper(object):
         args = merge_args(conf_args, args)
         logging.debug (args)
         schema = Schema({
-            'SOURCE_DIR': Or(os.path.isdir, error='Source directory does not exist'),
+            'SOURCE_DIR': Or(lambda x: x is None, os.path.isfile, lambda x: all(os.path.isdir(d) for d in x.split(os.pathsep)), error='Source directory does not exist'),
             'TARGET_DIR': Or(lambda x: x is None, os.path.isdir, error='Destination directory does not exist'),
+            '--io-order': Or(*ORDERS, error='--io-order must be one of {}'.format(', '.join(ORDERS))),
+            '--date-policy': Or(*DATE_POLICIES, error='--date-policy must be one of {}'.format(', '.join(DATE_POLICIES))),
+            '--readers': And(Use(int), lambda n: n > 0, error='--readers must be a whole number above 0'),
+            '--jobs': And(Use(int), lambda n: n > 0, error='--jobs must be a whole number above 0'),
+            '--spool-size': And(Use(int), lambda n: n > 0, error='--spool-size must be a whole number of MB above 0'),
+            '--debounce': And(Use(float), lambda x: x > 0, error='--debounce must be a number of seconds above 0'),
+            '--poll': Or(None, And(Use(float), lambda x: x > 0), error='--poll must be a number of seconds above 0'),
             object: object
             })
         try:
@@ -149,59 +249,265 @@ class PhotoKeeper(object):
             for f in list(self.flow):
                 if args[f] == 0: del self.flow[f]
             logging.info("Doing flow steps: %s" % (','.join(self.flow.keys())))
-
-        self.src_dir = args['SOURCE_DIR']
+        else:
+            for f in self.extra_steps:
+                del self.flow[f]
+
+        if args['query'] or args['serve']:
+            self.manifest = None
+            self.src_dirs = []
+            if args['query'] and not args['--catalog']:
+                exit('query needs --catalog')
+        elif os.path.isfile(args['SOURCE_DIR']):
+            self.manifest = args['SOURCE_DIR']
+            self.src_dirs = []
+            if args['watch']:
+                exit('Cannot watch a manifest, give a source directory instead')
+        else:
+            self.manifest = None
+            self.src_dirs = args['SOURCE_DIR'].split(os.pathsep)
+        try:
+            self.remaps = parse_remap(args['--remap'])
+        except ManifestError as e:
+            exit(e)
         self.tgt_dir = args['TARGET_DIR']
         if self.tgt_dir:
-            assert os.path.abspath(self.src_dir) != os.path.abspath(self.tgt_dir), 'Target and source directories cannot be the same'
+            for src_dir in self.src_dirs:
+                assert os.path.abspath(src_dir) != os.path.abspath(self.tgt_dir), 'Target and source directories cannot be the same'
+        self.readers = args['--readers']
+        self.io_order = args['--io-order']
+        self.date_policy = args['--date-policy']
+        if args['--date-patterns']:
+            try:
+                self.dater = FilenameDater(load_patterns(args['--date-patterns']))
+            except (OSError, ValueError) as e:
+                exit(e)
 
         if args['--debug']:
             logging.basicConfig(level=logging.DEBUG, format='%(message)s')
         elif args['--verbose']:
             logging.basicConfig(level=logging.INFO, format='%(message)s')   
 
+        if args['--profile'] or args['--metrics']:
+            self.metrics = Metrics(profile=args['--profile'])
+
+        if args['--catalog']:
+            self.catalog = Catalog(args['--catalog'])
+
         self.args = args # Just save this for posterity
 
 
     def get_file_count(self, _dir):
-        cnt = 0
-        for root, dirs, files in os.walk(_dir):
-            cnt += len(files)
-        return cnt
+        return sum(len(files) for root, files in walk_files(_dir))
 
 
-    def examine_files(self, img_dir):
-        counts = defaultdict(int)
+    def list_files(self, _dir):
+        """ All the (non-hidden) files under _dir, in the order they should be read (see --io-order) """
+        return [entry.path for batch in self.list_entries(_dir) for entry in batch]
+
+
+    def list_entries(self, _dir):
+        """ Yield lists of os.DirEntry for the (non-hidden) files under _dir (hidden directories,
+            e.g. .previews in an old target dir, are skipped).  In walk order that is one list per
+            directory, as soon as it has been listed; the other orders need the whole tree first,
+            so then it is a single list.
+        """
+        if self.io_order == 'walk':
+            for root, files in walk_files(_dir):
+                yield files
+        else:
+            entries = [entry for root, files in walk_files(_dir) for entry in files]
+            yield physical_order(entries, self.io_order, path=lambda e: e.path, inode=lambda e: e.inode())
+
+
+    def exif_date(self, filename):
+        """ :returns: The EXIF DateTime, or None if the file has none """
+        try:
+            tags_dict = piexif.load(filename)
+            image_date = tags_dict['0th'][piexif.ImageIFD.DateTime]
+            # Why am I even using dateparser if it can't parse this??
+            return dateparser.parse(image_date.decode('utf8'), date_formats=['%Y:%m:%d %H:%M:%S']) 
+        except (KeyError, ValueError) as e:
+            logging.info('IGNORED: %s is not a JPG or TIFF' % (filename))
+            return None
+
+
+    def date_taken(self, filename, exif_files=None, st=None):
+        """ Work out when the photo was taken, from EXIF and/or the file name depending on
+            the --date-policy, falling back to the file modification time
+
+            :param exif_files: Files to read EXIF from, in turn (default: just filename)
+            :param st: os.stat() of filename, if the caller has it already
+            :returns: (datetime, True if it came from EXIF)
+        """
+        name_date = self.dater.date(os.path.basename(filename))
+        if name_date and self.date_policy == 'name':
+            self.metrics.count('examine.name_date')
+            return name_date, False
+
+        image_datetime = None
+        for exif_file in (exif_files if exif_files is not None else [filename]):
+            image_datetime = self.exif_date(exif_file)
+            if image_datetime is not None:
+                break
+        if image_datetime is not None:
+            if self.date_policy == 'verify' and name_date and name_date.date() != image_datetime.date():
+                logging.warning('{} was taken on {} according to EXIF, not {}'.format(filename, image_datetime.date(), name_date.date()))
+                self.metrics.count('examine.name_mismatch')
+            return image_datetime, True
+
+        self.metrics.count('examine.exif_missing')
+        if name_date:
+            logging.info('Using %s from the file name' % (name_date))
+            self.metrics.count('examine.name_date')
+            return name_date, False
+        file_mod_time = st.st_mtime if st else os.path.getmtime(filename)
+        image_datetime = datetime.datetime.fromtimestamp(file_mod_time)
+        logging.info('Using %s ' % (image_datetime))
+        return image_datetime, False
+
+
+    def examine_file(self, filename, st=None):
+        """ Work out when the photo was taken (see date_taken)
+
+            :returns: ImageFile filed under the date it was taken
+        """
         dt_format = '%Y-%m-%d'
+        with self.metrics.timer('parse'):
+            image_datetime, from_exif = self.date_taken(filename, st=st)
+        # Need to mark this since we don't have EXIF and Flickr doesn't honor file date for date-taken
+        exif_timestamp_missing = not from_exif
+
+        image_datetime_text = image_datetime.strftime(dt_format)
+        img = ImageFile(os.path.dirname(filename), os.path.basename(filename), self.tgt_dir, image_datetime_text, image_datetime, exif_timestamp_missing)
+        img._stat = st
+        return img
+
+
+    def examine_shot(self, filenames, stats=None):
+        """ Date the files of one shot (see photokeeper.shots) together, reading only the
+            cheapest of them, so that they all end up on the same day
+
+            :param stats: os.stat() of the files (by path) that the directory walk found
+            :returns: List of ImageFiles, one per file
+        """
+        stats = stats or {}
+        if len(filenames) == 1:
+            return [self.examine_file(filenames[0], stats.get(filenames[0]))]
+        candidates = exif_candidates(filenames)
+        primary = primary_member(filenames)
+        with self.metrics.timer('parse'):
+            image_datetime, from_exif = self.date_taken(primary, candidates, stats.get(primary))
+        self.metrics.count('examine.shot_members', len(filenames) - 1)
+        images = [ImageFile(os.path.dirname(fn), os.path.basename(fn), self.tgt_dir, image_datetime.strftime('%Y-%m-%d'),
+                            image_datetime, not from_exif) for fn in filenames]
+        for img in images:
+            img.shot = images
+            img._stat = stats.get(img.srcpath)
+        return images
+
+
+    def examine_files(self, img_dirs):
+        """ Examine every file in one or more source directories.
+
+            The directories are read concurrently, with at most self.readers files being read
+            at a time from each device.  Images are kept in the order of img_dirs, so the
+            result doesn't depend on which device was fastest.
+        """
+        if isinstance(img_dirs, str):
+            img_dirs = [img_dirs]
+        images = []
+        print("Examining files in {}".format(', '.join(img_dirs)))
+        with DeviceScheduler(self.readers) as scheduler, tqdm(total=0, ncols=80, unit='file') as progress:
+            feeds = [queue.Queue() for d in img_dirs]
+            for d, feed in zip(img_dirs, feeds):
+                context_thread(self._feed_shots, args=(scheduler, d, feed, progress), daemon=True).start()
+            for feed in feeds:
+                for future in iter(feed.get, None):
+                    if isinstance(future, Exception):
+                        raise future
+                    shot = future.result()
+                    images.extend(shot)
+                    progress.update(len(shot))
+        self.images.extend(images)
+        self.print_day_counts(images)
+
+
+    def _feed_shots(self, scheduler, src_dir, feed, progress):
+        """ Walk src_dir, and submit each shot to be examined as soon as its directory has been
+            listed.  The futures are put on the feed queue, followed by None
+        """
+        try:
+            device = scheduler.device(src_dir)
+            for entries in self.list_entries(src_dir):
+                stats = {entry.path: entry.stat() for entry in entries}   # Cached by the walk
+                for shot in group_shots([entry.path for entry in entries]):
+                    feed.put(scheduler.submit(device, self.examine_shot, shot, stats))
+                progress.total += len(entries)
+                progress.refresh()
+        except Exception as e:
+            feed.put(e)
+        finally:
+            feed.put(None)
+
+
+    def load_manifest(self, filename):
+        """ Instead of examining the files, read what an earlier examine step saved """
+        print("Reading manifest {}".format(filename))
+        make_image = lambda srcdir, fn, day, dt, no_exif: ImageFile(srcdir, fn, self.tgt_dir, day, dt, no_exif)
+        try:
+            images = list(read_manifest(filename, make_image, self.remaps))
+        except ManifestError as e:
+            exit(e)
+        images = physical_order(images, self.io_order, path=lambda img: img.srcpath)
+        shots = group_shots(images, path=lambda img: img.srcpath)
+        for shot in shots:
+            if len(shot) > 1:
+                for img in shot:
+                    img.shot = shot
+        images = [img for shot in shots for img in shot]
+        self.images.extend(images)
+        self.print_day_counts(images)
+
+
+    def save_manifest(self, filename):
+        print("Saving manifest {}".format(filename))
+        n = write_manifest(filename, self.all_images(), self.src_dirs, self.args['--manifest-hashes'])
+        print("Saved {} files".format(n))
+
+
+    def extract_previews(self):
+        print("Extracting embedded thumbnails into {}".format(PreviewCache(self.tgt_dir).cache_dir))
+        missing = make_previews(self.images, self.tgt_dir, metrics=self.metrics)
+        print("{} files have no embedded thumbnail; their previews will be made when first needed".format(len(missing)))
+
+
+    def group_duplicates(self):
+        """ Mark the images that are copies of an earlier one in the source, so that only the
+            first of each is copied
+        """
+        print("Checking for files that are in the source more than once")
+        groups = find_duplicates(self.images, self.readers, self.metrics)
+        wasted = 0
+        for group in groups:
+            logging.info('Same file: {}'.format(', '.join(img.srcpath for img in group)))
+            for img in group[1:]:
+                img.same_as = group[0]
+                wasted += img.stat().st_size
+        print('Found {} files that are copies of others ({} groups, {:.1f} MB), copying each once'.format(
+            sum(len(g) - 1 for g in groups), len(groups), wasted/1e6))
+        return groups
+
+
+    def print_day_counts(self, images):
+        counts = defaultdict(int)
         pp = pprint.PrettyPrinter(indent=4)
-        raw_count = self.get_file_count(img_dir)
-        print("Examining {} files in {}".format(raw_count, img_dir))
-        with tqdm(total=raw_count, ncols=80, unit='file') as progress:
-            for root, dirs, files in os.walk(img_dir):
-                for fn in files:
-                    if fn.startswith('.'): continue
-                    filename = os.path.join(root, fn)
-                    progress.update(1)
-                    try:
-                        exif_timestamp_missing = False
-                        tags_dict = piexif.load(filename)
-                        image_date = tags_dict['0th'][piexif.ImageIFD.DateTime]
-                        # Why am I even using dateparser if it can't parse this??
-                        image_datetime = dateparser.parse(image_date.decode('utf8'), date_formats=['%Y:%m:%d %H:%M:%S']) 
-                    except (KeyError, ValueError) as e:
-
-                        logging.info('IGNORED: %s is not a JPG or TIFF' % (filename))
-                        file_mod_time = os.path.getmtime(filename)
-                        image_datetime = datetime.datetime.fromtimestamp(file_mod_time)
-                        logging.info('Using %s ' % (image_datetime))
-                        exif_timestamp_missing = True  # Need to mark this since we don't have EXIF and Flickr doesn't honor file date for date-taken
-                    
-                    image_datetime_text = image_datetime.strftime(dt_format)
-                    counts[image_datetime_text] += 1
-                    self.images.append(ImageFile(os.path.dirname(filename), os.path.basename(filename), self.tgt_dir, image_datetime_text, image_datetime, exif_timestamp_missing))
+        for img in images:
+            counts[img.tgtdatedir] += 1
 
         counts = dict(counts)
         total = sum(counts.values())
+        self.metrics.count('examine.files', total)
         print('Found images from {} days'.format(len(counts)))
         pp.pprint (counts)
         
@@ -223,10 +529,12 @@ class PhotoKeeper(object):
             
 
 
-    def all_images(self):
-        n = len(self.images)
+    def all_images(self, unique=False):
+        """ :param unique: skip the images that are copies of an earlier one (see group_duplicates) """
+        images = [img for img in self.images if img.same_as is None] if unique else self.images
+        n = len(images)
         with tqdm(total=n, ncols=80, unit='file') as progress:
-            for i, img in enumerate(self.images):
+            for i, img in enumerate(images):
                 yield img
                 progress.update(1)
 
@@ -239,13 +547,150 @@ class PhotoKeeper(object):
         """
         # Read the command line options
         self.get_options(argv)
-        self.examine_files(self.src_dir)
-        for photo_target, TargetClass in [('file', FileCopy), ('flickr', Flickr)]:
+        if self.args['serve']:
+            Daemon(self.args['--socket'], self.args['--jobs']).serve_forever()
+            return
+        try:
+            if self.args['query']:
+                self.run_query()
+                return
+            try:
+                if self.args['watch']:
+                    self.run_watch()
+                else:
+                    self.run_flow()
+            finally:
+                self.report_metrics(argv)
+        finally:
+            if self.catalog:
+                self.catalog.close()
+
+    def make_targets(self):
+        """ Set up (and log in to) each target in the flow
+
+            :returns: List of (target name, target object)
+        """
+        target_options = {'file': {'spool_dir': self.args['--spool'], 'spool_size': self.args['--spool-size']*1024*1024},
+                          'flickr': {'title_dedupe': not self.args['--flickr-no-title-dedupe']},
+                          's3': {'conf_file': self.args['--s3-conf']},
+                          'pack': {},
+                         }
+        targets = []
+        for photo_target, TargetClass in [('file', FileCopy), ('flickr', Flickr), ('s3', S3), ('pack', DayArchive)]:
             if photo_target in self.flow:
-                f = TargetClass()
+                options = target_options[photo_target]
+                make = lambda: self._make_target(photo_target, TargetClass, options)
+                if self.target_pool:
+                    f = self.target_pool.get(photo_target, options, make)
+                else:
+                    f = make()
+                targets.append((photo_target, f))
+        return targets
+
+    def _make_target(self, photo_target, TargetClass, options):
+        with self.metrics.stage(photo_target+':setup'):
+            return TargetClass(**options)
+
+    def hold_targets(self, targets):
+        """ Keep other runs in the same daemon off these targets while copying """
+        if self.target_pool:
+            return self.target_pool.hold(targets)
+        return contextlib.nullcontext()
+
+    def copy_to_targets(self, targets):
+        with self.hold_targets(targets):
+            self._copy_to_targets(targets)
+        # Copies of another file in the source are in the target now too
+        if self.catalog:
+            for photo_target, f in targets:
+                self.catalog.record_copies(photo_target, self.images)
+
+    def _copy_to_targets(self, targets):
+        for photo_target, f in targets:
+            f.metrics = self.metrics
+        try:
+            for photo_target, f in targets:
                 if 'dedupe' in self.flow:
-                    f.check_duplicates(self.all_images())
-                f.execute_copy(self.all_images())
+                    with self.metrics.stage(photo_target+':dedupe'):
+                        f.check_duplicates(self.all_images(unique=True))
+                with self.metrics.stage(photo_target):
+                    f.execute_copy(self.all_images(unique=True))
+            if any(getattr(f, 'spool', None) for photo_target, f in targets):
+                print("Everything has been read from the source: it can be ejected now")
+        finally:
+            for photo_target, f in targets:
+                f.finish()
+
+    def run_flow(self):
+        with self.metrics.stage('examine'):
+            if self.manifest:
+                self.load_manifest(self.manifest)
+            else:
+                self.examine_files(self.src_dirs)
+        if 'preview' in self.flow:
+            with self.metrics.stage('preview'):
+                self.extract_previews()
+        if 'dedupe' in self.flow:
+            with self.metrics.stage('dedupe:source'):
+                self.group_duplicates()
+        if self.catalog:
+            self.catalog.record_scan(self.images)
+        if self.args['--save-manifest']:
+            with self.metrics.stage('manifest'):
+                self.save_manifest(self.args['--save-manifest'])
+        self.copy_to_targets(self.make_targets())
+
+    def run_watch(self, stop=None):
+        """ Watch the source directory and push each burst of new files through the flow.
+            The targets are only set up once, so e.g. Flickr authentication happens just at startup
+
+            :param stop: threading.Event to stop watching
+        """
+        targets = self.make_targets()
+        poll = self.args['--poll']
+        watcher = make_watcher(self.src_dirs, poll)
+
+        def ingest(paths):
+            self.images = []
+            with self.metrics.stage('examine'):
+                for shot in group_shots(paths):
+                    try:
+                        self.images.extend(self.examine_shot(shot))
+                    except OSError as e:
+                        logging.warning('Skipping {}: {}'.format(', '.join(shot), e))
+            self.print_day_counts(self.images)
+            try:
+                if 'preview' in self.flow:
+                    with self.metrics.stage('preview'):
+                        self.extract_previews()
+                if 'dedupe' in self.flow:
+                    with self.metrics.stage('dedupe:source'):
+                        self.group_duplicates()
+                if self.catalog:
+                    self.catalog.record_scan(self.images)
+                self.copy_to_targets(targets)
+            except Exception:
+                # Keep watching; the files will be found again by the next full run
+                logging.exception('Could not process {} new files'.format(len(paths)))
+
+        print('Watching {} for new files (Ctrl-C to stop)'.format(', '.join(self.src_dirs)))
+        try:
+            watch(watcher, ingest, self.args['--debounce'], stop)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+    def run_query(self):
+        name = [q for q in QUERIES if self.args[q]][0]
+        headings, rows = self.catalog.query(name)
+        print_table(headings, rows)
+
+    def report_metrics(self, argv):
+        if self.args['--metrics']:
+            self.metrics.write(self.args['--metrics'], version=__version__, argv=list(argv), flow=list(self.flow))
+        if self.args['--profile']:
+            self.metrics.print_summary()
 
 def main():
     script = PhotoKeeper()
@@ -0,0 +1,160 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Browse previews, taken from the thumbnail most cameras already embed in the EXIF data.
+
+    Previews are stored by the SHA-1 of the original file, so the same photo is only ever
+    stored once, wherever (and however many times) it was copied::
+
+        TARGET_DIR/.previews/3f/3f786850e387550fdab836ed7e6dc881de23001b.jpg
+
+    Getting the embedded thumbnail only needs the start of the file (EXIF_HEAD_BYTES) to be
+    read and parsed, which is about what the examine step costs anyway; the hash is computed
+    a block at a time.  Videos and other files that can't have an EXIF thumbnail are skipped.
+    Photos without one are not decoded up front: PreviewCache.get() makes their preview (with
+    Pillow, if it is installed) the first time it is asked for.
+"""
+
+import os, io, logging, tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import piexif
+from tqdm import tqdm
+
+from photokeeper.utils import file_hash
+from photokeeper.metrics import NO_METRICS
+from photokeeper.shots import EXIF_COST
+
+PREVIEW_DIR = '.previews'
+PREVIEW_SIZE = (160, 160)   # About what cameras embed
+
+# Only these can carry EXIF thumbnails; anything else is skipped
+PREVIEW_EXTS = set(EXIF_COST)
+_EXIF_MAGIC = (b'\xff\xd8', b'II*\x00', b'MM\x00*')
+
+# The EXIF segment of a JPEG is at most 64k, and comes first; TIFF-based RAW files have
+# their thumbnail near the start too, or it is treated as missing
+EXIF_HEAD_BYTES = 256*1024
+
+
+class PreviewCache(object):
+    """ Content-addressed preview files under <base_dir>/.previews """
+
+    def __init__(self, base_dir):
+        self.cache_dir = os.path.join(base_dir, PREVIEW_DIR)
+
+    def path(self, sha1):
+        return os.path.join(self.cache_dir, sha1[:2], sha1 + '.jpg')
+
+    def __contains__(self, sha1):
+        return os.path.exists(self.path(sha1))
+
+    def put(self, sha1, data):
+        """ Store a preview (atomically, so readers never see half a file) """
+        path = self.path(sha1)
+        if os.path.exists(path):
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return path
+
+    def get(self, sha1, srcpath):
+        """ Path of the preview for a file, decoding the full image to make one if there was
+            no embedded thumbnail
+
+            :returns: None if no preview can be made (e.g. for videos, or without Pillow)
+        """
+        if sha1 in self:
+            return self.path(sha1)
+        data = decode_preview(srcpath)
+        if data is None:
+            return None
+        return self.put(sha1, data)
+
+
+def decode_preview(srcpath):
+    """ The slow path: decode the whole image and scale it down """
+    try:
+        from PIL import Image
+    except ImportError:
+        logging.warning('Install Pillow to make previews of images without an EXIF thumbnail')
+        return None
+    try:
+        with Image.open(srcpath) as im:
+            im.draft('RGB', PREVIEW_SIZE)   # Lets the JPEG decoder skip most of the work
+            im = im.convert('RGB')
+            im.thumbnail(PREVIEW_SIZE)
+            out = io.BytesIO()
+            im.save(out, 'JPEG', quality=85)
+    except (OSError, ValueError) as e:
+        logging.info('Cannot make a preview of {}: {}'.format(srcpath, e))
+        return None
+    return out.getvalue()
+
+
+def extract_preview(srcpath, base_dir):
+    """ Hash a photo and save its embedded EXIF thumbnail in the cache.  Runs in a worker process
+
+        :returns: (sha1, one of 'extracted', 'cached' or 'missing'), or (None, 'skipped') for
+                  files that can't have a thumbnail and (None, 'failed') for ones that couldn't be read
+    """
+    if os.path.splitext(srcpath)[1].lower() not in PREVIEW_EXTS:
+        return None, 'skipped'
+    try:
+        return _extract_preview(srcpath, PreviewCache(base_dir))
+    except Exception as e:   # One bad file mustn't end the whole step
+        logging.warning('No preview for {}: {}'.format(srcpath, e))
+        return None, 'failed'
+
+
+def _extract_preview(srcpath, cache):
+    with open(srcpath, 'rb') as f:
+        head = f.read(EXIF_HEAD_BYTES)
+    if not head.startswith(_EXIF_MAGIC):
+        return None, 'skipped'
+    sha1 = file_hash(srcpath)
+    if sha1 in cache:
+        return sha1, 'cached'
+    try:
+        thumbnail = piexif.load(head).get('thumbnail')
+    except Exception as e:   # Broken, or its EXIF doesn't fit in the head
+        logging.info('Cannot read EXIF from {}: {}'.format(srcpath, e))
+        thumbnail = None
+    if not thumbnail:
+        return sha1, 'missing'
+    cache.put(sha1, thumbnail)
+    return sha1, 'extracted'
+
+
+def make_previews(images, base_dir, workers=None, metrics=NO_METRICS):
+    """ Extract the embedded thumbnails of images in a process pool.  Each ImageFile's sha1
+        is filled in on the way, so later steps don't have to hash the file again
+
+        :returns: List of the photos without an embedded thumbnail
+    """
+    images = list(images)
+    missing = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(extract_preview, [img.srcpath for img in images], [base_dir]*len(images), chunksize=16)
+        for img, (sha1, status) in tqdm(zip(images, results), total=len(images), ncols=80, unit='file'):
+            if sha1:
+                img._sha1 = sha1
+            if status == 'missing':
+                missing.append(img)
+            metrics.count('preview.' + status)
+    return missing
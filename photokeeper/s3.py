@@ -0,0 +1,271 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, hmac, hashlib, datetime, logging, threading
+import urllib.parse
+from xml.etree import ElementTree
+
+import yaml
+import requests
+from tqdm import tqdm
+
+from photokeeper.target import TargetBase
+from photokeeper.utils import ContextPool
+
+
+class S3Error(Exception):
+    pass
+
+
+class S3Object(object):
+    def __init__(self, key, size, etag):
+        self.key = key
+        self.size = size
+        self.etag = etag.strip('"')
+
+
+class S3Client(object):
+    """ Just enough of the S3 REST API (path-style requests, AWS signature v4) to list,
+        upload and multipart-upload objects, on one pooled HTTP session.
+
+        Works against AWS and S3-compatible stores like MinIO or Ceph.
+    """
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1', pool_size=10):
+        self.endpoint = endpoint.rstrip('/')
+        self.host = urllib.parse.urlparse(self.endpoint).netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _signing_key(self, datestamp):
+        key = ('AWS4' + self.secret_key).encode('utf8')
+        for msg in (datestamp, self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, msg.encode('utf8'), hashlib.sha256).digest()
+        return key
+
+    def _sign(self, method, path, query, headers, payload_hash='UNSIGNED-PAYLOAD', now=None):
+        """ Add the AWS signature v4 headers.  By default the payload is sent unsigned so that
+            large bodies don't have to be read twice
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        datestamp = now.strftime('%Y%m%d')
+        headers['host'] = self.host
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = payload_hash
+
+        canonical_query = '&'.join('%s=%s' % (urllib.parse.quote(k, safe='-_.~'), urllib.parse.quote(str(v), safe='-_.~'))
+                                   for k, v in sorted(query.items()))
+        signed_headers = ';'.join(sorted(k.lower() for k in headers))
+        canonical_headers = ''.join('%s:%s\n' % (k.lower(), str(headers[k]).strip()) for k in sorted(headers, key=str.lower))
+        canonical_request = '\n'.join([method, path, canonical_query, canonical_headers, signed_headers, payload_hash])
+        scope = '%s/%s/s3/aws4_request' % (datestamp, self.region)
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode('utf8')).hexdigest()])
+        signature = hmac.new(self._signing_key(datestamp), string_to_sign.encode('utf8'), hashlib.sha256).hexdigest()
+        headers['Authorization'] = 'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (
+            self.access_key, scope, signed_headers, signature)
+        return headers
+
+    def request(self, method, key='', query=None, data=None, headers=None, ok=(200,)):
+        query = query or {}
+        path = '/' + self.bucket + ('/' + urllib.parse.quote(key, safe='/-_.~') if key else '/')
+        headers = self._sign(method, path, query, dict(headers or {}))
+        del headers['host']  # requests adds it
+        url = self.endpoint + path
+        if query:
+            url += '?' + urllib.parse.urlencode(sorted(query.items()), quote_via=urllib.parse.quote)
+        resp = self.session.request(method, url, data=data, headers=headers)
+        if resp.status_code not in ok:
+            raise S3Error('{} {} failed with status {}: {}'.format(method, key, resp.status_code, resp.text[:200]))
+        return resp
+
+    @staticmethod
+    def _xml(resp):
+        root = ElementTree.fromstring(resp.content)
+        # Drop the namespace so we can look things up by plain tag name
+        for el in root.iter():
+            el.tag = el.tag.rpartition('}')[2]
+        return root
+
+    def list(self, prefix):
+        """ Yield every object under prefix, following continuation tokens """
+        query = {'list-type': '2', 'prefix': prefix}
+        while True:
+            root = self._xml(self.request('GET', query=query))
+            for c in root.findall('Contents'):
+                yield S3Object(c.findtext('Key'), int(c.findtext('Size')), c.findtext('ETag'))
+            if root.findtext('IsTruncated') != 'true':
+                break
+            query['continuation-token'] = root.findtext('NextContinuationToken')
+
+    def head(self, key):
+        resp = self.request('HEAD', key, ok=(200, 404))
+        if resp.status_code == 404:
+            return None
+        return S3Object(key, int(resp.headers['Content-Length']), resp.headers['ETag'])
+
+    def put(self, key, data, size):
+        resp = self.request('PUT', key, data=data, headers={'Content-Length': str(size)})
+        return resp.headers.get('ETag', '').strip('"')
+
+    def create_multipart_upload(self, key):
+        return self._xml(self.request('POST', key, query={'uploads': ''})).findtext('UploadId')
+
+    def upload_part(self, key, upload_id, part_number, data):
+        resp = self.request('PUT', key, query={'partNumber': part_number, 'uploadId': upload_id}, data=data,
+                            headers={'Content-Length': str(len(data))})
+        return resp.headers['ETag'].strip('"')
+
+    def complete_multipart_upload(self, key, upload_id, etags):
+        body = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % ''.join(
+            '<Part><PartNumber>%d</PartNumber><ETag>"%s"</ETag></Part>' % (i+1, etag) for i, etag in enumerate(etags))
+        root = self._xml(self.request('POST', key, query={'uploadId': upload_id}, data=body.encode('utf8')))
+        if root.tag == 'Error':  # S3 can report a failed completion with a 200
+            raise S3Error('Completing upload of {} failed: {}'.format(key, root.findtext('Message')))
+        return root.findtext('ETag', '').strip('"')
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.request('DELETE', key, query={'uploadId': upload_id}, ok=(200, 204, 404))
+
+
+def expected_etag(filename, part_size):
+    """ The ETag S3 will report for this file: the MD5 of the contents for a plain upload, or
+        the MD5 of the part MD5s plus '-<number of parts>' for a multipart upload
+    """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        if size <= part_size:
+            return hashlib.md5(f.read()).hexdigest()
+        digests = []
+        for block in iter(lambda: f.read(part_size), b''):
+            digests.append(hashlib.md5(block).digest())
+    return '%s-%d' % (hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+class S3(TargetBase):
+    """ Upload to an S3-compatible bucket, under the same date prefixes FileCopy uses for
+        directories (<prefix><YYYY-MM-DD>/<filename>).
+
+        Files bigger than part_size go up as parallel multipart uploads.  Dedupe lists each
+        date prefix once (cached) and compares size, then ETag, instead of a HEAD per file.
+    """
+
+    def __init__(self, conf_file='s3.yaml', client=None, prefix='', part_size=16*1024*1024, workers=4):
+        """
+            :param conf_file: YAML file with endpoint, bucket, access_key, secret_key and
+                              optionally region, prefix, part_size and workers
+            :param client: An S3Client to use instead of one made from conf_file
+        """
+        if client is None:
+            with open(conf_file) as f:
+                conf = yaml.safe_load(f)
+            prefix = conf.get('prefix', prefix)
+            part_size = int(conf.get('part_size', part_size))
+            workers = int(conf.get('workers', workers))
+            client = S3Client(conf['endpoint'], conf['bucket'], conf['access_key'], conf['secret_key'],
+                              conf.get('region', 'us-east-1'), pool_size=2*workers)
+        self.client = client
+        self.prefix = prefix
+        self.part_size = max(part_size, 5*1024*1024)  # S3's minimum part size
+        self.workers = workers
+        self.listings = {}
+        self.lock = threading.Lock()
+
+    def _key(self, tgtdatedir, filename):
+        return '{}{}/{}'.format(self.prefix, tgtdatedir, filename)
+
+    def _listing(self, tgtdatedir):
+        """ All the objects under one date prefix, keyed by key.  Listed once per run """
+        with self.lock:
+            if tgtdatedir not in self.listings:
+                prefix = self._key(tgtdatedir, '')
+                self.listings[tgtdatedir] = dict((o.key, o) for o in self.client.list(prefix))
+            return self.listings[tgtdatedir]
+
+    def _is_duplicate(self, img):
+        obj = self._listing(img.tgtdatedir).get(self._key(img.tgtdatedir, img.filename))
+        if obj is None or obj.size != os.path.getsize(img.srcpath):
+            return False
+        return obj.etag == expected_etag(img.srcpath, self.part_size)
+
+    def check_duplicates(self, images):
+        print("Checking for duplicates in S3")
+        images = list(images)
+        with ContextPool(max_workers=self.workers) as pool:
+            dups = list(pool.map(self._is_duplicate, images))
+        for img, dup in zip(images, dups):
+            if dup:
+                img.s3_dup = True
+        print('Found {} duplicates out of {} images'.format(sum(dups), len(images)))
+
+    def _unique_key(self, tgtdatedir, filename):
+        """ Like FileCopy._get_unique_filename_suffix: add _1, _2... until the key is free,
+            and reserve it so parallel uploads can't pick the same one
+        """
+        listing = self._listing(tgtdatedir)
+        fn, ext = os.path.splitext(filename)
+        with self.lock:
+            key = self._key(tgtdatedir, filename)
+            suffix = 1
+            while key in listing:
+                key = self._key(tgtdatedir, fn+'_'+str(suffix)+ext)
+                suffix += 1
+            listing[key] = S3Object(key, -1, '')
+            return key
+
+    def _read_part(self, filename, part_number):
+        with open(filename, 'rb') as f:
+            f.seek(part_number * self.part_size)
+            return f.read(self.part_size)
+
+    def _upload(self, img, part_pool):
+        key = self._unique_key(img.tgtdatedir, img.filename)
+        size = os.path.getsize(img.srcpath)
+        with self.metrics.timer('upload'):
+            if size <= self.part_size:
+                with open(img.srcpath, 'rb') as f:
+                    etag = self.client.put(key, f, size)
+            else:
+                n_parts = (size + self.part_size - 1) // self.part_size
+                upload_id = self.client.create_multipart_upload(key)
+                try:
+                    etags = list(part_pool.map(
+                        lambda i: self.client.upload_part(key, upload_id, i+1, self._read_part(img.srcpath, i)),
+                        range(n_parts)))
+                    etag = self.client.complete_multipart_upload(key, upload_id, etags)
+                except Exception:
+                    self.client.abort_multipart_upload(key, upload_id)
+                    raise
+        with self.lock:
+            self.listings[img.tgtdatedir][key] = S3Object(key, size, etag)
+        self.metrics.count('s3.bytes_uploaded', size)
+        logging.info("Uploaded {} to {}".format(img.srcpath, key))
+        return key
+
+    def execute_copy(self, images):
+        print("Uploading files to S3")
+        todo = [img for img in images if not img.s3_dup]
+        with ContextPool(max_workers=self.workers) as part_pool, \
+             ContextPool(max_workers=self.workers) as file_pool:
+            futures = [file_pool.submit(self._upload, img, part_pool) for img in todo]
+            for future in tqdm(futures, ncols=80, unit='file'):
+                future.result()
+        print("Uploaded {} files".format(len(todo)))
@@ -0,0 +1,85 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Files that belong to the same shot: a camera's RAW and JPEG (``DSC_0001.NEF`` and
+    ``DSC_0001.JPG``), an editor's sidecar (``DSC_0001.xmp`` or ``DSC_0001.NEF.xmp``), a video
+    and its thumbnail (``MVI_0001.MOV`` and ``MVI_0001.THM``).  They are in the same directory
+    and have the same name apart from the extension.
+
+    A shot is dated once, from the member that is cheapest to read the date from, and all its
+    files are filed (and named) together.
+"""
+
+import os
+from collections import OrderedDict
+
+SIDECAR_EXTS = {'.xmp', '.aae', '.pp3', '.dop', '.on1'}
+
+# How cheap it is to get the EXIF date out of a file; lower is cheaper.  Files with
+# extensions that aren't listed can't be read by piexif at all
+EXIF_COST = {'.jpg': 0, '.jpeg': 0, '.thm': 0,
+             '.tif': 1, '.tiff': 1, '.dng': 1, '.nef': 1, '.nrw': 1, '.cr2': 1, '.arw': 1,
+             '.orf': 1, '.pef': 1, '.srw': 1}
+
+# Other extensions a sidecar can be named after (DSC_0001.RAF.xmp)
+MEDIA_EXTS = set(EXIF_COST) | {'.cr3', '.raf', '.rw2', '.heic', '.mov', '.mp4', '.avi', '.mts'}
+
+RAW_EXTS = {'.dng', '.nef', '.nrw', '.cr2', '.cr3', '.arw', '.orf', '.pef', '.srw', '.raf', '.rw2'}
+
+
+def is_sidecar(filename):
+    return os.path.splitext(filename)[1].lower() in SIDECAR_EXTS
+
+
+def shot_key(filename):
+    """ (directory, lower-case name without its extension(s)) """
+    dirname, base = os.path.split(filename)
+    name, ext = os.path.splitext(base)
+    if ext.lower() in SIDECAR_EXTS:
+        inner, inner_ext = os.path.splitext(name)
+        if inner_ext.lower() in MEDIA_EXTS:
+            name = inner   # DSC_0001.NEF.xmp
+    return dirname, name.lower()
+
+
+def group_shots(items, path=lambda x: x):
+    """ Group items (file paths, or anything path() turns into one) by shot
+
+        :returns: List of lists of items, in the order their first item came in
+    """
+    shots = OrderedDict()
+    for x in items:
+        shots.setdefault(shot_key(path(x)), []).append(x)
+    return list(shots.values())
+
+
+def primary_member(filenames):
+    """ The file a shot is named and dated by when there is no EXIF date: the RAW, else the
+        JPEG, else any other file that isn't a sidecar (whose modification time is when it
+        was last edited, not when the shot was taken).  Doesn't depend on the order of filenames
+    """
+    def rank(fn):
+        ext = os.path.splitext(fn)[1].lower()
+        if ext in SIDECAR_EXTS:
+            return 3
+        return 0 if ext in RAW_EXTS else 1 if ext in ('.jpg', '.jpeg') else 2
+    return min(filenames, key=lambda fn: (rank(fn), fn))
+
+
+def exif_candidates(filenames):
+    """ The files of a shot that may have an EXIF date, cheapest first """
+    costs = [(EXIF_COST[os.path.splitext(fn)[1].lower()], i, fn) for i, fn in enumerate(filenames)
+             if os.path.splitext(fn)[1].lower() in EXIF_COST]
+    return [fn for cost, i, fn in sorted(costs)]
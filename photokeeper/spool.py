@@ -0,0 +1,234 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Write-behind spool: copy files off the card at full speed into a local staging directory,
+    and write them out to the (slow) target in the background.
+
+    The spool lives in its own subdirectory (SUBDIR) of the directory it is given, and only
+    ever removes files it named itself there.  It holds the staged files and a journal (JSON
+    lines)::
+
+        {"op": "staged", "id": 7, "tgt": "/mnt/nas/photos/2016-06-24/IMG_0001.JPG", "size": 5123456}
+        {"op": "done", "id": 7}
+
+    A file is only journaled as staged once its spool copy is on disk (fsynced), and only as
+    done once its target copy is, so after a crash every file is either still in the spool or
+    already in the target.  Opening the spool again writes out whatever an earlier run left.
+"""
+
+import os, re, json, queue, shutil, logging, threading
+
+from photokeeper.autotune import AIMDController, run_adaptive
+from photokeeper.metrics import NO_METRICS
+from photokeeper.utils import context_thread
+
+JOURNAL = 'journal.jsonl'
+SUBDIR = 'photokeeper-spool'
+_STAGED_NAME = re.compile(r'^(\d{8})(\.tmp)?$')   # The names _path() gives, and their partial copies
+
+
+class SpoolError(Exception):
+    pass
+
+
+def _fsync_copy(src, dst):
+    shutil.copyfile(src, dst)
+    with open(dst, 'rb+') as f:
+        os.fsync(f.fileno())
+
+
+class Spool(object):
+
+    retry_backoff = 1.0   # Seconds before retrying a failed write to the target, doubled each time
+
+    def __init__(self, spool_dir, capacity, controller=None, unique=lambda path: path, metrics=NO_METRICS):
+        """
+            :param capacity: Bytes of staged files to hold at most; staging waits for room
+                             (a single bigger file is let through when the spool is empty)
+            :param controller: autotune.AIMDController for the writes to the target
+            :param unique: Gives a free target name, should the journaled one be taken by
+                           another file by the time the spool gets to it
+        """
+        self.spool_dir = os.path.join(os.path.expanduser(spool_dir), SUBDIR)
+        self.capacity = capacity
+        self.controller = controller or AIMDController('spool')
+        self.unique = unique
+        self.metrics = metrics
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.journal_path = os.path.join(self.spool_dir, JOURNAL)
+        self.lock = threading.Condition()   # For the space used
+        self.journal_lock = threading.Lock()
+        self.used = 0
+        self.next_id = 0
+        self.queue = None
+        self.flusher = None
+        self.error = None
+        self.written = 0
+        self.journal = None
+
+    def _path(self, entry_id):
+        return os.path.join(self.spool_dir, '%08d' % entry_id)
+
+    def _log(self, record):
+        """ Append to the journal, and make sure it is on disk before going on """
+        with self.journal_lock:
+            self.journal.write(json.dumps(record) + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def recover(self):
+        """ Read the journal, and write out the files an earlier run staged but didn't finish
+
+            :returns: Number of files written out
+        """
+        staged = {}
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding='utf8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:   # Torn last line: it was never acknowledged
+                        continue
+                    if record['op'] == 'staged':
+                        staged[record['id']] = record
+                    else:
+                        staged.pop(record['id'], None)
+        for fn in os.listdir(self.spool_dir):   # Half-staged files
+            m = _STAGED_NAME.match(fn)
+            if m and (m.group(2) or int(m.group(1)) not in staged):
+                os.remove(os.path.join(self.spool_dir, fn))
+        self.next_id = max(staged, default=-1) + 1
+        self.journal = open(self.journal_path, 'a', encoding='utf8')
+        if staged:
+            print("Writing out {} files left in the spool by an earlier run".format(len(staged)))
+            self.start()
+            for entry in staged.values():
+                with self.lock:
+                    self.used += entry['size']
+                self.queue.put(entry)
+            self.finish()
+        self._compact()
+        return len(staged)
+
+    def _compact(self):
+        """ Start a new journal once everything in it is done """
+        with self.lock, self.journal_lock:
+            if self.used == 0:
+                self.journal.truncate(0)
+
+    def start(self):
+        if self.flusher is None:
+            self.queue = queue.Queue()
+            self.ended = False
+            self.written = 0
+            self.flusher = context_thread(self._flush_all, daemon=True)
+            self.flusher.start()
+
+    def stage(self, srcpath, tgtpath):
+        """ Copy a file into the spool (waiting for room if it is full), to be written to
+            tgtpath in the background
+        """
+        size = os.path.getsize(srcpath)
+        with self.lock:
+            while self.used and self.used + size > self.capacity and self.error is None:
+                self.lock.wait()
+            if self.error is not None:
+                raise SpoolError('Writing out the spool failed: {}'.format(self.error))
+            self.used += size
+            entry_id = self.next_id
+            self.next_id += 1
+        self.start()
+        path = self._path(entry_id)
+        try:
+            with self.metrics.timer('stage'):
+                _fsync_copy(srcpath, path + '.tmp')
+                os.replace(path + '.tmp', path)
+        except OSError:
+            with self.lock:
+                self.used -= size
+                self.lock.notify_all()
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
+            raise
+        entry = {'op': 'staged', 'id': entry_id, 'tgt': tgtpath, 'size': size}
+        self._log(entry)
+        self.queue.put(entry)
+
+    def _queued(self):
+        """ Staged entries, until finish() says there will be no more """
+        while not self.ended:
+            entry = self.queue.get()
+            if entry is None:
+                self.ended = True
+            else:
+                yield entry
+
+    def _flush_all(self):
+        try:
+            run_adaptive(self._queued(), self._flush_one, self.controller,
+                         retryable=lambda e: isinstance(e, OSError), retries=2, backoff=self.retry_backoff)
+        except Exception as e:
+            logging.error('Could not write out the spool: {}'.format(e))
+            with self.lock:
+                self.error = e
+                self.lock.notify_all()
+            for _ in self._queued():   # Stays staged, for the next run
+                pass
+
+    def _flush_one(self, entry):
+        """ Write one staged file to its target.  Runs in a worker thread """
+        path, tgt = self._path(entry['id']), entry['tgt']
+        if os.path.exists(path):
+            if os.path.exists(tgt) and os.path.getsize(tgt) != entry['size']:
+                tgt = self.unique(tgt)
+            if not os.path.exists(tgt):
+                os.makedirs(os.path.dirname(tgt), exist_ok=True)
+                # A dot file until it is complete, so nothing takes a partial copy for the real thing
+                tmp = os.path.join(os.path.dirname(tgt), '.' + os.path.basename(tgt) + '.spool')
+                with self.metrics.timer('copy'):
+                    _fsync_copy(path, tmp)
+                    os.replace(tmp, tgt)
+                self.metrics.count('file.bytes_copied', entry['size'])
+        elif not os.path.exists(tgt):
+            logging.error('{} is missing from the spool, and was never written to {}'.format(path, tgt))
+        self._log({'op': 'done', 'id': entry['id']})
+        if os.path.exists(path):
+            os.remove(path)
+        with self.lock:
+            self.used -= entry['size']
+            self.written += 1
+            self.lock.notify_all()
+        return entry['size'], tgt
+
+    def finish(self):
+        """ Wait until everything staged has been written to the target
+
+            :raises: SpoolError if any of it couldn't be (it is then still in the spool)
+        """
+        if self.flusher is None:
+            return
+        self.queue.put(None)
+        self.flusher.join()
+        self.flusher = None
+        logging.info(self.controller.summary())
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise SpoolError('Could not write out the spool (the rest is in {} for the next run): {}'.format(self.spool_dir, error))
+        self._compact()
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
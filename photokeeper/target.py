@@ -13,9 +13,12 @@
 # limitations under the License.
 
 import abc
+from photokeeper.metrics import NO_METRICS
 
 class TargetBase(abc.ABC):
 
+    metrics = NO_METRICS   # Replaced by the run's Metrics when --profile/--metrics is given
+
     @abc.abstractmethod
     def check_duplicates(self, images):
         """ Go through images and mark a property in each image if it's a duplicate in the target repository
@@ -26,3 +29,8 @@ class TargetBase(abc.ABC):
     def execute_copy(self, images):
         """ Take the source image files and copy/upload them to the target repository
         """
+
+    def finish(self):
+        """ Wait for anything execute_copy left running in the background.  Called once every
+            target has run, so that they can overlap
+        """
@@ -1,5 +1,7 @@
+import sys, hashlib, threading, contextvars
 import yaml
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
     """ Helper function to allow yaml load routine to use an OrderedDict instead of regular dict.
@@ -29,3 +31,27 @@ def merge_args(conf_args, orig_args):
     args.update(orig_args)
     args.update(conf_args)
     return args
+
+
+def file_hash(filename, algorithm='sha1', blocksize=1<<20):
+    """ Return the hex digest of a file's contents, reading it in blocksize chunks
+    """
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ContextPool(ThreadPoolExecutor):
+    """ A ThreadPoolExecutor that runs the work it is given in the context (contextvars) of
+        whoever submitted it, so e.g. a daemon job's output stream follows it into the pool
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def context_thread(target, args=(), **kwargs):
+    """ A threading.Thread that runs target in the context (contextvars) of the caller """
+    return threading.Thread(target=contextvars.copy_context().run, args=(target,) + tuple(args), **kwargs)
@@ -0,0 +1,89 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Walk a directory tree with several directories being listed at once.
+
+    os.walk lists one directory at a time, which on NFS or SMB means one network round trip
+    after another.  Here every subdirectory is handed to a thread pool as soon as its parent
+    has been listed, and the files are stat'ed in the same threads, so the round trips
+    overlap.  The directories still come out in the order os.walk would give them (top-down,
+    in listing order), so the result doesn't depend on which listing came back first.
+"""
+
+import os, logging, threading
+
+from photokeeper.utils import ContextPool
+
+WALKERS = 8
+
+
+def _scan_dir(path, hidden):
+    """ List one directory
+
+        :returns: (files, subdirectory paths), files being DirEntry objects with their stat cached
+    """
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if not hidden and entry.name.startswith('.'):   # Before any stat
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        entry.stat()
+                        files.append(entry)
+                except OSError:
+                    pass   # Gone already, or a dangling link
+    except OSError as e:
+        logging.warning('Cannot list {}: {}'.format(path, e))
+    return files, subdirs
+
+
+def walk_files(top, workers=WALKERS, hidden=False):
+    """ Yield (directory, [DirEntry of each file in it]) for top and every directory below it,
+        like os.walk (symbolic links to directories aren't followed, unreadable directories are
+        skipped), but listing up to workers directories at once.
+
+        :param hidden: Also go into, and list, files and directories whose names start with a dot
+    """
+    pool = ContextPool(max_workers=workers)
+    futures = {}
+    lock = threading.Lock()
+
+    def scan(path):
+        files, subdirs = _scan_dir(path, hidden)
+        with lock:
+            for subdir in subdirs:   # Start on the children before the caller gets to them
+                try:
+                    futures[subdir] = pool.submit(scan, subdir)
+                except RuntimeError:   # The caller stopped walking
+                    break
+        return files, subdirs
+
+    try:
+        with lock:
+            futures[top] = pool.submit(scan, top)
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            with lock:
+                future = futures.pop(path)
+            files, subdirs = future.result()
+            stack.extend(reversed(subdirs))
+            yield path, files
+    finally:
+        pool.shutdown(cancel_futures=True)
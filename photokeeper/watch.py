@@ -0,0 +1,246 @@
+# Copyright 2016 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Watch a source directory for new files.
+
+    On Linux the kernel's inotify interface is used (through ctypes, so there are no
+    extra dependencies), and a file is reported once it has been closed after writing or
+    moved into the tree.  Everywhere else, or if inotify can't be set up, the tree is polled
+    and a file is reported once its size and modification time stop changing.
+"""
+
+import os, sys, time, errno, select, struct, logging
+import ctypes, ctypes.util
+from collections import OrderedDict
+
+from photokeeper.walk import walk_files
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+_EVENT = struct.Struct('iIII')
+
+
+def _wanted(filename):
+    return not os.path.basename(filename).startswith('.')
+
+
+def _roots(root):
+    """ Watchers take one directory or a list of them """
+    return [root] if isinstance(root, str) else list(root)
+
+
+def _scan(roots):
+    """ Yield (path, stat) for every (non-hidden) file under the roots """
+    for root in roots:
+        for dirpath, files in walk_files(root):
+            for entry in files:
+                yield entry.path, entry.stat()   # Stat'ed by the walk, and cached
+
+
+class InotifyWatcher(object):
+    """ Recursively watch one or more trees with inotify.  Raises OSError if inotify isn't available """
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    settle = 1.0   # Seconds a file found by a scan must keep its size and mtime to count as written
+
+    def __init__(self, root):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.roots = _roots(root)
+        self.started = time.time()
+        self.dirs = {}
+        self.settling = {}   # Files found by scanning, that may still be being written: path -> (sig, since)
+        for top in self.roots:
+            self._add_tree(top)
+
+    def _add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        self.dirs[wd] = path
+
+    def _add_tree(self, top):
+        """ Watch top and everything below it.
+
+            :returns: Files already in there, since they may have been written before the watch was in place
+        """
+        found = []
+        for dirpath, dirs, files in os.walk(top):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            self._add_watch(dirpath)
+            found.extend(os.path.join(dirpath, fn) for fn in files if _wanted(fn))
+        return found
+
+    def fileno(self):
+        return self.fd
+
+    def poll(self, timeout):
+        """ Wait up to timeout seconds for files to be finished
+
+            :returns: List of file paths
+        """
+        if self.settling:
+            timeout = min(timeout, self.settle/2)
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return self._settled()
+        try:
+            data = os.read(self.fd, 64*1024)
+        except BlockingIOError:
+            return self._settled()
+        paths = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            name = data[offset+_EVENT.size:offset+_EVENT.size+length].rstrip(b'\0')
+            offset += _EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('inotify queue overflowed, rescanning {}'.format(', '.join(self.roots)))
+                self._settle(p for p, st in _scan(self.roots) if st.st_mtime >= self.started)
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            if wd not in self.dirs or not name:
+                continue
+            path = os.path.join(self.dirs[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and _wanted(path):
+                    # e.g. cp -r of a card: files in there may be half written still
+                    self._settle(self._add_tree(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and _wanted(path):
+                self.settling.pop(path, None)
+                paths.append(path)
+        return paths + self._settled()
+
+    def _settle(self, paths):
+        """ Report these files once they have stopped changing (or been closed after writing) """
+        now = time.time()
+        for path in paths:
+            if path not in self.settling:
+                self.settling[path] = (None, now)
+
+    def _settled(self):
+        """ Files from _settle that have kept their size and mtime for self.settle seconds """
+        now = time.time()
+        done = []
+        for path, (sig, since) in list(self.settling.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.settling[path]   # Gone already
+                continue
+            if (st.st_size, st.st_mtime) != sig:
+                self.settling[path] = ((st.st_size, st.st_mtime), now)
+            elif now - since >= self.settle:
+                del self.settling[path]
+                done.append(path)
+        return done
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """ Find new files by rescanning the tree(s) every interval seconds.  A file is only
+        reported once it looks the same (size and mtime) on two scans in a row
+    """
+
+    def __init__(self, root, interval=2.0):
+        self.roots = _roots(root)
+        self.interval = interval
+        self.seen = dict((p, (st.st_size, st.st_mtime)) for p, st in _scan(self.roots))
+        self.pending = {}
+        self.next_scan = time.time() + interval
+
+    def poll(self, timeout):
+        delay = self.next_scan - time.time()
+        if delay > timeout:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(delay, 0))
+        self.next_scan = time.time() + self.interval
+
+        paths = []
+        current = {}
+        for path, st in _scan(self.roots):
+            sig = (st.st_size, st.st_mtime)
+            current[path] = sig
+            if self.seen.get(path) == sig:
+                continue
+            if self.pending.get(path) == sig:
+                paths.append(path)
+                self.seen[path] = sig
+                del self.pending[path]
+            else:
+                self.pending[path] = sig
+        # Forget files that have gone away, so they are picked up again if they come back
+        for path in set(self.seen) - set(current):
+            del self.seen[path]
+        for path in set(self.pending) - set(current):
+            del self.pending[path]
+        return paths
+
+    def close(self):
+        pass
+
+
+def make_watcher(root, poll_interval=None):
+    """ inotify if we can, otherwise (or if a poll interval is forced) polling
+
+        :param root: Directory, or list of directories, to watch
+    """
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as e:
+            logging.warning('Cannot use inotify ({}), polling for new files instead'.format(e))
+            poll_interval = 2.0
+    return PollingWatcher(root, poll_interval)
+
+
+def watch(watcher, handle_batch, debounce=2.0, stop=None, max_batch=5000):
+    """ Feed new files to handle_batch in bursts.
+
+        Files are collected until nothing new has turned up for debounce seconds (or max_batch
+        files are waiting), so a card dump of hundreds of files is handled in one go.
+
+        :param stop: threading.Event that ends the loop when set
+    """
+    pending = OrderedDict()
+    last_event = None
+    while stop is None or not stop.is_set():
+        paths = watcher.poll(min(debounce, 1.0))
+        if paths:
+            pending.update((p, True) for p in paths)
+            last_event = time.time()
+        if pending and (time.time() - last_event >= debounce or len(pending) >= max_batch):
+            batch, pending, last_event = list(pending), OrderedDict(), None
+            batch = [p for p in batch if os.path.isfile(p)]
+            if batch:   # Not if all of it was deleted or moved away again
+                handle_batch(batch)
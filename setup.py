@@ -47,11 +47,12 @@ setup (
     author_email="virantha@gmail.com", # Removed.
     classifiers=[
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         ],
+    python_requires = '>=3.9',   # ThreadPoolExecutor.shutdown(cancel_futures=...)
     package_data = {'': ['*.xml']},
     zip_safe = True,
     include_package_data = True,
@@ -59,7 +60,8 @@ setup (
     install_requires = required,
     entry_points = {
             'console_scripts': [
-                    'photokeeper = photokeeper.photokeeper:main'
+                    'photokeeper = photokeeper.photokeeper:main',
+                    'photokeeper-submit = photokeeper.daemon:main',
                 ],
         },
     options = {
@@ -0,0 +1,85 @@
+""" Upload throughput benchmark for the Flickr target, run against the local Flickr stand-in.
+
+    Usage::
+
+        python test/bench_flickr.py --photos 500 --days 10 --latency 0.02 --output flickr.json
+
+    Reports photos/sec for the dedupe check and the upload (execute_copy) passes, plus the
+    number of API calls made per method, which is what usually dominates against the real service.
+"""
+import os, sys, time, json, argparse, datetime, tempfile, collections
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from photokeeper.flickr import Flickr
+from photokeeper.photokeeper import ImageFile
+from fake_flickr import FakeFlickrServer
+from synthlib import write_jpeg, write_video
+
+
+def make_library(srcdir, n_photos, n_videos, n_days):
+    images = []
+    start = datetime.datetime(2016, 6, 24, 9, 0, 0)
+    for i in range(n_photos + n_videos):
+        dt = start + datetime.timedelta(days=i % n_days, seconds=i)
+        if i < n_photos:
+            fn = write_jpeg(os.path.join(srcdir, 'IMG_%06d.jpg' % i), dt)
+        else:
+            fn = write_video(os.path.join(srcdir, 'MOV_%06d.mp4' % i), 64*1024, mtime=dt.timestamp())
+        images.append(ImageFile(srcdir, os.path.basename(fn), None, dt.strftime('%Y-%m-%d'), dt, i >= n_photos))
+    return images
+
+
+def timed(label, n, func, *args):
+    t0 = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - t0
+    return {'step': label, 'images': n, 'seconds': round(elapsed, 4), 'photos_per_sec': round(n/elapsed, 2) if elapsed else None}
+
+
+def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as srcdir:
+        images = make_library(srcdir, args.photos, args.videos, args.days)
+        n = len(images)
+        with FakeFlickrServer(latency=args.latency, error_rate=args.error_rate, seed=args.seed) as server:
+            target = Flickr(server.client())
+            results.append(timed('check_duplicates (empty account)', n, target.check_duplicates, iter(images)))
+            results.append(timed('execute_copy', n, target.execute_copy, iter(images)))
+            calls_upload = Counter(server.state.calls)
+
+            # Now everything is on the "server", so a fresh run should find only duplicates
+            del server.state.calls[:]
+            images = make_library(srcdir, args.photos, args.videos, args.days)
+            target = Flickr(server.client())
+            results.append(timed('check_duplicates (all present)', n, target.check_duplicates, iter(images)))
+            calls_dedupe = Counter(server.state.calls)
+
+    return {'config': vars(args), 'results': results,
+            'api_calls': {'upload_run': dict(calls_upload), 'dedupe_run': dict(calls_dedupe)}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--photos', type=int, default=200)
+    parser.add_argument('--videos', type=int, default=20)
+    parser.add_argument('--days', type=int, default=5, help='Number of distinct days (albums)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability any API call fails')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    report = run(args)
+    for r in report['results']:
+        print('{step:35s} {images:6d} images {seconds:9.3f}s {photos_per_sec} photos/sec'.format(**r))
+    for run_name, calls in report['api_calls'].items():
+        print('{}: {} API calls {}'.format(run_name, sum(calls.values()), calls))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+""" Benchmark reading a photo library in walk, inode and disk (FIEMAP) order.
+
+    Usage::
+
+        python test/bench_ioorder.py --files 3000
+        sudo python test/bench_ioorder.py --library /mnt/hdd/photos --cold --output hdd.json
+
+    Two numbers are reported for each order:
+
+    * modelled: the files' real on-disk positions (from FIEMAP) replayed through a simple
+      spinning-disk model (a seek plus half a rotation whenever the head has to move back or
+      far forward, then the transfer), so the difference shows up even when the library is on an SSD or in page cache.
+    * measured: the wall time to actually read every file.  Only meaningful with --cold
+      (drops the page cache before each pass; needs root) on a real rotational disk.
+
+    Without --library, a library is generated with files created in random order across
+    directories, so that directory order and disk order disagree like on a card that has
+    been filled and cleared many times.
+"""
+import os, sys, time, json, random, shutil, argparse, platform, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from photokeeper.photokeeper import PhotoKeeper
+from photokeeper.ioorder import ORDERS, first_extent
+from photokeeper.version import __version__
+from synthlib import jpeg_bytes
+
+
+def generate(libdir, n_files, seed):
+    rng = random.Random(seed)
+    names = [os.path.join(libdir, 'DCIM', '%03dCANON' % (i % 40), 'IMG_%05d.JPG' % i) for i in range(n_files)]
+    rng.shuffle(names)
+    for i, name in enumerate(names):
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, 'wb') as f:
+            f.write(jpeg_bytes(padding=1000, seed=i))
+            f.write(os.urandom(rng.randint(200, 4000)*1024))  # Decoders ignore data after the image
+    os.sync()
+
+
+def model_seconds(paths, seek_ms, rpm, mb_per_sec, read_through=1024*1024):
+    """ Time a spinning disk would take to read the files in this order.  A short skip
+        forward (less than read_through bytes) just costs the time to pass over it; anything
+        else is a seek plus on average half a rotation
+    """
+    rate = mb_per_sec*1024*1024
+    seconds, head = 0.0, None
+    for path in paths:
+        offset, size = first_extent(path), os.path.getsize(path)
+        if offset is None:
+            continue
+        if head is not None and 0 <= offset - head < read_through:
+            seconds += (offset - head) / rate
+        else:
+            seconds += seek_ms/1000.0 + 30.0/rpm
+        seconds += size / rate
+        head = offset + size
+    return seconds
+
+
+def drop_caches():
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+
+def read_all(paths):
+    n = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(1024*1024)
+                if not block:
+                    break
+                n += len(block)
+    return n
+
+
+def run(args, libdir):
+    if not args.library:
+        generate(libdir, args.files, args.seed)
+    pk = PhotoKeeper()
+    results = []
+    total_bytes = None
+    for order in ORDERS:
+        pk.io_order = order
+        t0 = time.perf_counter()
+        paths = pk.list_files(libdir)
+        sort_seconds = time.perf_counter() - t0
+        modelled = model_seconds(paths, args.seek_ms, args.rpm, args.mb_per_sec)
+        if args.cold:
+            drop_caches()
+        t0 = time.perf_counter()
+        total_bytes = read_all(paths)
+        measured = time.perf_counter() - t0
+        results.append({'order': order, 'files': len(paths), 'list_seconds': round(sort_seconds, 4),
+                        'modelled_seconds': round(modelled, 3), 'modelled_mb_per_sec': round(total_bytes/modelled/1e6, 1) if modelled else None,
+                        'measured_seconds': round(measured, 3), 'measured_mb_per_sec': round(total_bytes/measured/1e6, 1)})
+        print('{:6s} list+sort {:7.3f}s   modelled {:8.2f}s {:7.1f} MB/s   measured{} {:7.3f}s {:7.1f} MB/s'.format(
+            order, sort_seconds, modelled, total_bytes/modelled/1e6 if modelled else 0,
+            ' (cold)' if args.cold else ' (warm)', measured, total_bytes/measured/1e6))
+    return {'version': __version__, 'python': platform.python_version(), 'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'bytes': total_bytes,
+            'disk_model': {'seek_ms': args.seek_ms, 'rpm': args.rpm, 'mb_per_sec': args.mb_per_sec},
+            'cold': args.cold, 'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=3000, help='Files to generate')
+    parser.add_argument('--library', help='Read this existing library instead of generating one')
+    parser.add_argument('--cold', action='store_true', help='Drop the page cache before each pass (root only)')
+    parser.add_argument('--seek-ms', type=float, default=8.5)
+    parser.add_argument('--rpm', type=float, default=7200)
+    parser.add_argument('--mb-per-sec', type=float, default=150)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='pkbench')
+    try:
+        report = run(args, args.library or os.path.join(scratch, 'library'))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
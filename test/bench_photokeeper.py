@@ -0,0 +1,126 @@
+""" End-to-end benchmark of the examine/dedupe/copy flow on a synthetic photo library.
+
+    Usage::
+
+        python test/bench_photokeeper.py --scale 10k --output results-0.1.3.json
+        python test/bench_photokeeper.py --scale 100k --library /scratch/lib100k
+
+    --scale takes 10k, 100k, 1M (or any number of files).  The library is generated from
+    a fixed seed, so runs of different versions see exactly the same files; pass --library
+    (a new or empty directory the first time) to generate it once and reuse it.  Results are
+    written as JSON, with the version and git revision, for comparing across versions.
+
+    Only the temporary directory the script makes for itself is deleted afterwards (unless
+    --keep is given); --library and --target are never deleted.
+"""
+import os, sys, time, json, shutil, argparse, platform, subprocess, tempfile, contextlib, io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from photokeeper.photokeeper import PhotoKeeper
+from photokeeper.filecopy import FileCopy
+from photokeeper.version import __version__
+from synthlib import LibrarySpec, generate_library
+
+SCALES = {'10k': 10000, '100k': 100000, '1M': 1000000}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Bench(object):
+    def __init__(self, n_files):
+        self.n_files = n_files
+        self.results = []
+
+    @contextlib.contextmanager
+    def step(self, name, quiet=True):
+        """ Time a step; its stdout (day counts etc.) is swallowed unless quiet is False """
+        out = io.StringIO() if quiet else sys.stdout
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(out):
+            yield
+        elapsed = time.perf_counter() - t0
+        self.results.append({'step': name, 'seconds': round(elapsed, 4),
+                             'files_per_sec': round(self.n_files/elapsed, 1) if elapsed else None})
+        print('{:35s} {:10.3f}s {:12.1f} files/sec'.format(name, elapsed, self.n_files/elapsed if elapsed else 0))
+
+
+def is_empty(path):
+    return not os.path.exists(path) or not os.listdir(path)
+
+
+def run(args, libdir, tgtdir):
+    n_files = SCALES.get(args.scale) or int(args.scale)
+    spec = LibrarySpec(n_files, video_size=args.video_size, seed=args.seed)
+    bench = Bench(n_files)
+
+    marker = os.path.join(libdir, '.synthlib.json')
+    if os.path.exists(marker) and json.load(open(marker)) == vars(spec):
+        print('Reusing library in {}'.format(libdir))
+    elif not is_empty(libdir):
+        sys.exit('{} is not a library generated with these settings (--scale, --video-size, --seed); '
+                 'give a new or empty directory'.format(libdir))
+    else:
+        with bench.step('generate library'):
+            counts = generate_library(libdir, spec)
+        print('Generated {}'.format(counts))
+        with open(marker, 'w') as f:
+            json.dump(vars(spec), f)
+
+    pk = PhotoKeeper()
+    pk.tgt_dir = tgtdir
+    with bench.step('examine_files'):
+        pk.examine_files(libdir)
+    target = FileCopy()
+    with bench.step('check_duplicates (empty target)'):
+        target.check_duplicates(pk.all_images())
+    with bench.step('execute_copy'):
+        target.execute_copy(pk.all_images())
+    for img in pk.images:
+        img.dup = False
+    with bench.step('check_duplicates (full target)'):
+        target.check_duplicates(pk.all_images())
+
+    return {'version': __version__, 'git_revision': git_revision(),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'library': vars(spec), 'results': bench.results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', default='10k', help='10k, 100k, 1M or a number of files')
+    parser.add_argument('--library', help='Where to generate (or reuse) the source library')
+    parser.add_argument('--target', help='Target directory for the copy (default: a temp dir)')
+    parser.add_argument('--keep', action='store_true', help="Don't delete the temporary directory afterwards")
+    parser.add_argument('--video-size', type=int, default=64*1024*1024)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    if args.target and not is_empty(args.target):
+        sys.exit('--target {} is not empty; give a new or empty directory'.format(args.target))
+    scratch = tempfile.mkdtemp(prefix='pkbench')
+    libdir = args.library or os.path.join(scratch, 'library')
+    tgtdir = args.target or os.path.join(scratch, 'target')
+    try:
+        os.makedirs(tgtdir, exist_ok=True)
+        report = run(args, libdir, tgtdir)
+    finally:
+        if args.keep:
+            print('Kept {}'.format(scratch))
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,449 @@
+""" A local stand-in for the parts of the Flickr API that photokeeper uses.
+
+    Runs a real HTTP server on localhost, so the whole flickrapi client stack (OAuth signing,
+    multipart encoding, response parsing) is exercised.  Latency and errors can be injected
+    to benchmark and regression-test the Flickr target without the live service::
+
+        with FakeFlickrServer(latency=0.05) as server:
+            target = Flickr(server.client())
+            target.check_duplicates(images)
+            target.execute_copy(images)
+
+    Supported methods: upload, flickr.photosets.getList, flickr.photosets.getPhotos,
+    flickr.photosets.create, flickr.photosets.addPhoto, flickr.photosets.editPhotos,
+    flickr.photosets.getInfo, flickr.photos.search (by machine tag) and flickr.photos.setDates
+"""
+import datetime, hashlib, json, random, socket, threading, time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import quoteattr, escape
+
+import flickrapi
+import piexif
+
+READ_SIZE = 64*1024
+
+
+class FakePhoto(object):
+    def __init__(self, photoid, title, size, sha1, datetaken, tags=''):
+        self.photoid = photoid
+        self.title = title
+        self.size = size
+        self.sha1 = sha1
+        self.datetaken = datetaken
+        self.tags = tags
+
+    def machine_tags(self):
+        return ' '.join(t for t in self.tags.split() if ':' in t and '=' in t)
+
+    def as_dict(self):
+        return {'id': self.photoid, 'title': self.title, 'datetaken': self.datetaken,
+                'datetakengranularity': '0', 'datetakenunknown': '0', 'isprimary': '0'}
+
+
+class FakePhotoSet(object):
+    def __init__(self, setid, title, primary):
+        self.setid = setid
+        self.title = title
+        self.primary = primary
+        self.photos = [primary]
+
+    def as_dict(self):
+        return {'id': self.setid, 'primary': self.primary, 'title': {'_content': self.title},
+                'description': {'_content': ''}, 'photos': len(self.photos), 'videos': 0}
+
+
+class FlickrFault(Exception):
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+
+
+class FakeFlickrState(object):
+    """ In-memory photo and album store, plus the fault injection bookkeeping
+    """
+
+    def __init__(self, error_rate=0.0, errors=None, seed=0, throttled=0):
+        self.lock = threading.Lock()
+        self.throttled = throttled
+        self.photos = {}
+        self.photosets = {}
+        self.next_id = 10000000000
+        self.error_rate = error_rate
+        self.errors = dict(errors or {})
+        self.rng = random.Random(seed)
+        self.calls = []
+
+    def _new_id(self):
+        self.next_id += 1
+        return str(self.next_id)
+
+    def check_fault(self, method):
+        """ Raise a FlickrFault if this call has been picked to fail """
+        with self.lock:
+            self.calls.append(method)
+            if self.errors.get(method, 0) > 0:
+                self.errors[method] -= 1
+                raise FlickrFault(105, 'Service currently unavailable (injected)')
+            if self.error_rate and self.rng.random() < self.error_rate:
+                raise FlickrFault(105, 'Service currently unavailable (injected)')
+
+    def check_throttle(self):
+        """ Whether this upload is to be turned away with HTTP 429 """
+        with self.lock:
+            if self.throttled > 0:
+                self.throttled -= 1
+                self.calls.append('upload')
+                return True
+            return False
+
+    def call_count(self, method):
+        return self.calls.count(method)
+
+    def add_photo(self, title, size, sha1, datetaken, tags=''):
+        with self.lock:
+            photo = FakePhoto(self._new_id(), title, size, sha1, datetaken, tags)
+            self.photos[photo.photoid] = photo
+            return photo
+
+    def _photo(self, photoid):
+        if photoid not in self.photos:
+            raise FlickrFault(1, 'Photo not found')
+        return self.photos[photoid]
+
+    def _photoset(self, setid):
+        if setid not in self.photosets:
+            raise FlickrFault(1, 'Photoset not found')
+        return self.photosets[setid]
+
+    # REST methods.  Each takes the request params and returns the response payload
+    def photosets_getList(self, params):
+        with self.lock:
+            sets = [s.as_dict() for s in self.photosets.values()]
+        return {'photosets': {'page': 1, 'pages': 1, 'perpage': len(sets), 'total': len(sets), 'photoset': sets}}
+
+    def photosets_getPhotos(self, params):
+        per_page = min(int(params.get('per_page', 500)), 500)
+        page = max(int(params.get('page', 1)), 1)
+        with self.lock:
+            photoset = self._photoset(params['photoset_id'])
+            ids = list(photoset.photos)
+            total = len(ids)
+            photos = [self.photos[i] for i in ids[(page-1)*per_page:page*per_page]]
+        extras = params.get('extras') or ''
+        photos = [dict(p.as_dict(), **({'machine_tags': p.machine_tags()} if 'machine_tags' in extras else {}))
+                  for p in photos]
+        for p in photos:
+            p['isprimary'] = '1' if p['id'] == photoset.primary else '0'
+        return {'photoset': {'id': photoset.setid, 'primary': photoset.primary, 'title': photoset.title,
+                             'page': page, 'per_page': per_page, 'perpage': per_page,
+                             'pages': max((total + per_page - 1)//per_page, 1), 'total': total,
+                             'photo': photos}}
+
+    def photosets_create(self, params):
+        with self.lock:
+            self._photo(params['primary_photo_id'])
+            photoset = FakePhotoSet(self._new_id(), params['title'], params['primary_photo_id'])
+            self.photosets[photoset.setid] = photoset
+        return {'photoset': {'id': photoset.setid, 'url': 'http://localhost/sets/%s/' % photoset.setid}}
+
+    def photosets_getInfo(self, params):
+        with self.lock:
+            return {'photoset': self._photoset(params['photoset_id']).as_dict()}
+
+    def photosets_addPhoto(self, params):
+        with self.lock:
+            photoset = self._photoset(params['photoset_id'])
+            self._photo(params['photo_id'])
+            if params['photo_id'] in photoset.photos:
+                raise FlickrFault(3, 'Photo already in set')
+            photoset.photos.append(params['photo_id'])
+        return {}
+
+    def photosets_editPhotos(self, params):
+        with self.lock:
+            photoset = self._photoset(params['photoset_id'])
+            photo_ids = []
+            for photoid in params['photo_ids'].split(','):
+                self._photo(photoid)
+                if photoid not in photo_ids:
+                    photo_ids.append(photoid)
+            if params['primary_photo_id'] not in photo_ids:
+                raise FlickrFault(2, 'Primary photo not in list')
+            photoset.primary = params['primary_photo_id']
+            photoset.photos = photo_ids
+        return {}
+
+    def photos_search(self, params):
+        """ Only the machine_tags search (in 'any' mode) that photokeeper uses """
+        wanted = set(t for t in params.get('machine_tags', '').split(',') if t)
+        per_page = min(int(params.get('per_page', 100)), 500)
+        page = max(int(params.get('page', 1)), 1)
+        with self.lock:
+            matches = [p for p in self.photos.values() if wanted & set(p.tags.split())]
+        photos = []
+        for p in matches[(page-1)*per_page:page*per_page]:
+            d = p.as_dict()
+            d['machine_tags'] = p.machine_tags()
+            photos.append(d)
+        return {'photos': {'page': page, 'pages': max((len(matches) + per_page - 1)//per_page, 1),
+                           'perpage': per_page, 'total': len(matches), 'photo': photos}}
+
+    def photos_getNotInSet(self, params):
+        per_page = min(int(params.get('per_page', 100)), 500)
+        page = max(int(params.get('page', 1)), 1)
+        with self.lock:
+            in_sets = set(p for s in self.photosets.values() for p in s.photos)
+            matches = [p.as_dict() for p in self.photos.values() if p.photoid not in in_sets]
+        return {'photos': {'page': page, 'pages': max((len(matches) + per_page - 1)//per_page, 1),
+                           'perpage': per_page, 'total': len(matches), 'photo': matches[(page-1)*per_page:page*per_page]}}
+
+    def photos_setDates(self, params):
+        with self.lock:
+            photo = self._photo(params['photo_id'])
+            if 'date_taken' in params:
+                photo.datetaken = params['date_taken']
+        return {}
+
+
+def _exif_datetaken(head):
+    """ Best-effort date taken from the first bytes of an upload, like Flickr does from EXIF """
+    try:
+        tags = piexif.load(bytes(head))
+        for ifd, tag in [('Exif', piexif.ExifIFD.DateTimeOriginal), ('0th', piexif.ImageIFD.DateTime)]:
+            if tag in tags.get(ifd, {}):
+                dt = datetime.datetime.strptime(tags[ifd][tag].decode('ascii'), '%Y:%m:%d %H:%M:%S')
+                return dt.strftime('%Y-%m-%d %H:%M:%S')
+    except Exception:
+        pass
+    return None
+
+
+def _to_xml(tag, value):
+    """ Render a response dict the way Flickr's REST (XML) format does: scalars become
+        attributes, dicts and lists become child elements and '_content' becomes text
+    """
+    if isinstance(value, list):
+        return ''.join(_to_xml(tag, v) for v in value)
+    if not isinstance(value, dict):
+        return '<%s>%s</%s>' % (tag, escape(str(value)), tag)
+    attrs = ''.join(' %s=%s' % (k, quoteattr(str(v))) for k, v in value.items()
+                    if not isinstance(v, (dict, list)) and k != '_content')
+    children = ''.join(_to_xml(k, v) for k, v in value.items() if isinstance(v, (dict, list)))
+    text = escape(str(value.get('_content', '')))
+    return '<%s%s>%s%s</%s>' % (tag, attrs, text, children, tag)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Without this, Nagle and delayed ACKs add ~40ms to every small response
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _send(self, body, content_type):
+        body = body.encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply(self, fmt, payload=None, fault=None):
+        if fmt == 'json':
+            if fault:
+                payload = {'stat': 'fail', 'code': fault.code, 'message': fault.message}
+            else:
+                payload = dict(payload, stat='ok')
+            self._send(json.dumps(payload), 'application/json')
+        else:
+            if fault:
+                xml = '<rsp stat="fail"><err code="%s" msg=%s /></rsp>' % (fault.code, quoteattr(fault.message))
+            else:
+                xml = '<rsp stat="ok">%s</rsp>' % ''.join(_to_xml(k, v) for k, v in payload.items())
+            self._send('<?xml version="1.0" encoding="utf-8" ?>\n' + xml, 'text/xml')
+
+    def _body_chunks(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            chunk = self.rfile.read(min(READ_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        path = urllib.parse.urlparse(self.path).path
+        if path.startswith('/services/upload'):
+            self._do_upload()
+        elif path.startswith('/services/rest'):
+            self._do_rest()
+        else:
+            self.send_error(404)
+
+    def _do_rest(self):
+        params = dict(urllib.parse.parse_qsl(b''.join(self._body_chunks()).decode('utf8')))
+        fmt = params.get('format', 'rest')
+        method = params.get('method', '')
+        handler = getattr(self.state, method[len('flickr.'):].replace('.', '_'), None)
+        try:
+            if handler is None:
+                raise FlickrFault(112, 'Method "%s" not found' % method)
+            self.state.check_fault(method)
+            payload = handler(params)
+        except FlickrFault as fault:
+            return self._reply(fmt, fault=fault)
+        self._reply(fmt, payload)
+
+    def _do_upload(self):
+        body = self._body_chunks()
+        fields, upload = _parse_multipart(body, self.headers.get('Content-Type', ''))
+        for _ in body:  # Drain any epilogue so the connection can be reused
+            pass
+        if self.state.check_throttle():
+            self.send_response(429)
+            self.send_header('Retry-After', str(self.server.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        try:
+            self.state.check_fault('upload')
+            if upload is None:
+                raise FlickrFault(2, 'No photo specified')
+            datetaken = _exif_datetaken(upload['head']) or datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            photo = self.state.add_photo(fields.get('title', ''), upload['size'], upload['sha1'],
+                                         datetaken, fields.get('tags', ''))
+        except FlickrFault as fault:
+            return self._reply('rest', fault=fault)
+        self._reply('rest', {'photoid': photo.photoid})
+
+
+def _parse_multipart(chunks, content_type):
+    """ Stream-parse a multipart/form-data body.
+
+        Small form fields are returned as a dict; the file part is only counted and hashed
+        (keeping the first READ_SIZE bytes for EXIF) so uploads of any size use constant memory.
+
+        :returns: (fields, upload) where upload is a dict with size, sha1 and head, or None
+    """
+    boundary = content_type.partition('boundary=')[2].strip('"').encode('latin-1')
+    delim = b'\r\n--' + boundary
+    buf = bytearray(b'\r\n')  # So the first boundary looks like all the others
+    fields, upload = {}, None
+    state, name, sink = 'preamble', None, None
+
+    def feed(data):
+        if isinstance(sink, bytearray):
+            sink.extend(data)
+        else:
+            sink['size'] += len(data)
+            sink['sha1'].update(data)
+            if len(sink['head']) < READ_SIZE:
+                sink['head'].extend(data[:READ_SIZE-len(sink['head'])])
+
+    chunks = iter(chunks)
+    done = False
+    while not done:
+        progressed = True
+        while progressed:
+            progressed = False
+            if state in ('preamble', 'body'):
+                idx = buf.find(delim)
+                if idx < 0:
+                    if state == 'body' and len(buf) >= len(delim):
+                        keep = len(delim) - 1
+                        feed(bytes(buf[:len(buf)-keep]))
+                        del buf[:len(buf)-keep]
+                    continue
+                if len(buf) < idx + len(delim) + 2:
+                    continue
+                if state == 'body':
+                    feed(bytes(buf[:idx]))
+                    if isinstance(sink, bytearray):
+                        fields[name] = sink.decode('utf8')
+                    else:
+                        upload = dict(sink, sha1=sink['sha1'].hexdigest())
+                trailer = bytes(buf[idx+len(delim):idx+len(delim)+2])
+                del buf[:idx+len(delim)+2]
+                if trailer == b'--':
+                    return fields, upload
+                state, progressed = 'headers', True
+            elif state == 'headers':
+                idx = buf.find(b'\r\n\r\n')
+                if idx < 0:
+                    continue
+                headers = bytes(buf[:idx]).decode('utf8', 'replace')
+                del buf[:idx+4]
+                disposition = [h for h in headers.split('\r\n') if h.lower().startswith('content-disposition')]
+                params = dict(p.strip().split('=', 1) for p in disposition[0].split(';')[1:] if '=' in p)
+                name = params.get('name', '').strip('"')
+                if 'filename' in params:
+                    sink = {'size': 0, 'sha1': hashlib.sha1(), 'head': bytearray(), 'filename': params['filename'].strip('"')}
+                else:
+                    sink = bytearray()
+                state, progressed = 'body', True
+        chunk = next(chunks, None)
+        if chunk is None:
+            done = True
+        else:
+            buf.extend(chunk)
+    return fields, upload
+
+
+class FakeFlickrServer(object):
+    """ Threaded local Flickr API stand-in.
+
+        :param latency: seconds to sleep before answering every request
+        :param error_rate: probability that any call fails with a Flickr error
+        :param errors: dict of method name ('upload' or e.g. 'flickr.photosets.addPhoto') to the
+                       number of upcoming calls of that method that should fail
+        :param seed: seed for the random error injection
+        :param throttled: number of upcoming uploads to turn away with HTTP 429 and a
+                          Retry-After of retry_after seconds
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, errors=None, seed=0, throttled=0, retry_after=1):
+        self.state = FakeFlickrState(error_rate, errors, seed, throttled)
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = self.state
+        self.httpd.latency = latency
+        self.httpd.retry_after = retry_after
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def client(self):
+        """ A flickrapi client that is already 'authenticated' and talks to this server """
+        token = flickrapi.auth.FlickrAccessToken('fake-token', 'fake-secret', 'write')
+        flickr = flickrapi.FlickrAPI('fake-key', 'fake-secret', token=token, store_token=False)
+        flickr.REST_URL = self.url + '/services/rest/'
+        flickr.UPLOAD_URL = self.url + '/services/upload/'
+        return flickr
@@ -0,0 +1,184 @@
+""" A local stand-in for an S3-compatible object store (think MinIO), for tests and benchmarks.
+
+    Path-style requests only: ListObjectsV2, PUT/HEAD/GET object and the multipart upload
+    calls.  Signatures are not checked, but every request must carry one.  Objects are kept in
+    memory, so keep test files small::
+
+        with FakeS3Server(latency=0.01) as server:
+            target = S3(client=server.client())
+"""
+import hashlib, random, socket, threading, time, uuid
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+from photokeeper.s3 import S3Client
+
+NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class FakeS3State(object):
+    def __init__(self, error_rate=0.0, seed=0):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.uploads = {}
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.requests = []
+        self.connections = set()
+
+    def objects(self, bucket):
+        return self.buckets.setdefault(bucket, {})
+
+    def should_fail(self):
+        with self.lock:
+            return bool(self.error_rate) and self.rng.random() < self.error_rate
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _xml(self, tag, inner):
+        return ('<?xml version="1.0" encoding="UTF-8"?><%s xmlns="%s">%s</%s>' % (tag, NS, inner, tag)).encode('utf8')
+
+    def _error(self, status, code):
+        self._send(status, self._xml('Error', '<Code>%s</Code><Message>%s</Message>' % (code, code)))
+
+    def _dispatch(self):
+        time.sleep(self.server.latency)
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        bucket, _, key = urllib.parse.unquote(url.path).lstrip('/').partition('/')
+        body = self._body() if self.command in ('PUT', 'POST') else b''
+        with self.state.lock:
+            self.state.requests.append((self.command, key, sorted(query)))
+            self.state.connections.add(self.client_address)
+        if 'AWS4-HMAC-SHA256' not in self.headers.get('Authorization', ''):
+            return self._error(403, 'AccessDenied')
+        if self.state.should_fail():
+            return self._error(503, 'SlowDown')
+        handler = getattr(self, '_%s_%s' % (self.command.lower(), 'object' if key else 'bucket'))
+        handler(bucket, key, query, body)
+
+    do_GET = do_PUT = do_POST = do_HEAD = do_DELETE = _dispatch
+
+    def _get_bucket(self, bucket, key, query, body):
+        prefix = query.get('prefix', '')
+        max_keys = int(query.get('max-keys', 1000))
+        with self.state.lock:
+            keys = sorted(k for k in self.state.objects(bucket) if k.startswith(prefix))
+            start = query.get('continuation-token', '')
+            keys = [k for k in keys if k > start]
+            page, truncated = keys[:max_keys], len(keys) > max_keys
+            contents = ''.join('<Contents><Key>%s</Key><Size>%d</Size><ETag>"%s"</ETag></Contents>'
+                               % (escape(k), len(self.state.objects(bucket)[k][0]), self.state.objects(bucket)[k][1])
+                               for k in page)
+        inner = '<Name>%s</Name><Prefix>%s</Prefix><KeyCount>%d</KeyCount><IsTruncated>%s</IsTruncated>%s' % (
+            bucket, escape(prefix), len(page), 'true' if truncated else 'false', contents)
+        if truncated:
+            inner += '<NextContinuationToken>%s</NextContinuationToken>' % escape(page[-1])
+        self._send(200, self._xml('ListBucketResult', inner))
+
+    def _head_object(self, bucket, key, query, body):
+        obj = self.state.objects(bucket).get(key)
+        if obj is None:
+            return self._send(404)
+        self.send_response(200)
+        self.send_header('ETag', '"%s"' % obj[1])
+        self.send_header('Content-Length', str(len(obj[0])))
+        self.end_headers()
+
+    def _get_object(self, bucket, key, query, body):
+        obj = self.state.objects(bucket).get(key)
+        if obj is None:
+            return self._error(404, 'NoSuchKey')
+        self._send(200, obj[0], {'ETag': '"%s"' % obj[1]})
+
+    def _put_object(self, bucket, key, query, body):
+        etag = hashlib.md5(body).hexdigest()
+        with self.state.lock:
+            if 'uploadId' in query:
+                upload = self.state.uploads.get(query['uploadId'])
+                if upload is None:
+                    return self._error(404, 'NoSuchUpload')
+                upload['parts'][int(query['partNumber'])] = body
+            else:
+                self.state.objects(bucket)[key] = (body, etag)
+        self._send(200, headers={'ETag': '"%s"' % etag})
+
+    def _post_object(self, bucket, key, query, body):
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with self.state.lock:
+                self.state.uploads[upload_id] = {'bucket': bucket, 'key': key, 'parts': {}}
+            return self._send(200, self._xml('InitiateMultipartUploadResult',
+                                             '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>' % (bucket, escape(key), upload_id)))
+        with self.state.lock:
+            upload = self.state.uploads.pop(query.get('uploadId'), None)
+            if upload is None:
+                return self._error(404, 'NoSuchUpload')
+            parts = [upload['parts'][n] for n in sorted(upload['parts'])]
+            etag = '%s-%d' % (hashlib.md5(b''.join(hashlib.md5(p).digest() for p in parts)).hexdigest(), len(parts))
+            self.state.objects(bucket)[key] = (b''.join(parts), etag)
+        self._send(200, self._xml('CompleteMultipartUploadResult', '<Key>%s</Key><ETag>"%s"</ETag>' % (escape(key), etag)))
+
+    def _delete_object(self, bucket, key, query, body):
+        with self.state.lock:
+            if 'uploadId' in query:
+                self.state.uploads.pop(query['uploadId'], None)
+            else:
+                self.state.objects(bucket).pop(key, None)
+        self._send(204)
+
+
+class FakeS3Server(object):
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.state = FakeS3State(error_rate, seed)
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = self.state
+        self.httpd.latency = latency
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.httpd.server_address
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def client(self, bucket='photos', pool_size=8):
+        return S3Client(self.url, bucket, 'fake-access-key', 'fake-secret-key', pool_size=pool_size)
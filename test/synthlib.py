@@ -0,0 +1,154 @@
+""" Helpers for building synthetic photo libraries on disk for tests and benchmarks
+"""
+import os, io, base64, random, datetime, collections
+import piexif
+
+# Smallest baseline JPEG that decoders (and piexif) will accept: a single grey pixel
+TINY_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQEASABIAAD/2wBDAP//////////////////////////////////////////////////////"
+    "////////////////////////////////wgALCAABAAEBAREA/8QAFBABAAAAAAAAAAAAAAAAAAAAAP/aAAgBAQAB"
+    "PxA=")
+
+
+def jpeg_bytes(datetime_taken=None, padding=0, seed=None, thumbnail=False):
+    """ Return the bytes of a tiny JPEG, with an EXIF DateTime tag if datetime_taken is given.
+        padding adds that many bytes of comment payload so files can be made bigger (and unique);
+        the payload is random, or reproducible if a seed is given.  thumbnail embeds an EXIF
+        thumbnail (the same tiny JPEG) like cameras do
+    """
+    data = TINY_JPEG
+    if datetime_taken is not None:
+        tags = {'0th': {piexif.ImageIFD.DateTime: datetime_taken.strftime('%Y:%m:%d %H:%M:%S').encode('ascii')}}
+        if thumbnail:
+            tags['1st'] = {piexif.ImageIFD.XResolution: (72, 1)}
+            tags['thumbnail'] = TINY_JPEG
+        exif = piexif.dump(tags)
+        out = io.BytesIO()
+        piexif.insert(exif, data, out)
+        data = out.getvalue()
+    if padding:
+        # Stick a COM segment right after SOI; decoders skip over it
+        n = min(padding, 65533)
+        payload = os.urandom(n) if seed is None else random.Random(seed).getrandbits(8*n).to_bytes(n, 'little')
+        data = data[:2] + b'\xff\xfe' + (len(payload)+2).to_bytes(2, 'big') + payload + data[2:]
+    return data
+
+
+def write_jpeg(path, datetime_taken=None, padding=0, seed=None, thumbnail=False):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(jpeg_bytes(datetime_taken, padding, seed, thumbnail))
+    return path
+
+
+def write_video(path, size, mtime=None, sparse=False):
+    """ Write a fake video (random bytes, no EXIF) of the given size.
+        A sparse file is much quicker to create when only the size matters
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        if sparse:
+            f.truncate(size)
+        else:
+            rng = random.Random(path)
+            remaining = size
+            while remaining > 0:
+                n = min(remaining, 1 << 20)
+                f.write(rng.getrandbits(8*n).to_bytes(n, 'little'))
+                remaining -= n
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+class LibrarySpec(object):
+    """ What goes into a synthetic library.  The fractions are of n_files.
+
+        :ivar noexif: files with no EXIF (PNG screenshots, MOV clips), dated by mtime
+        :ivar videos: large sparse fake videos; video_size bytes each
+        :ivar collisions: files reusing a name (IMG_0001.JPG...) already used in another folder
+        :ivar depth: how deeply the card-style folders are nested
+        :ivar per_dir: files per leaf directory
+        :ivar days: number of distinct days the files are spread over
+    """
+    def __init__(self, n_files, noexif=0.1, videos=0.001, video_size=64*1024*1024, collisions=0.2,
+                 depth=4, per_dir=200, days=365, padding=2048, seed=0):
+        self.n_files = n_files
+        self.noexif = noexif
+        self.videos = videos
+        self.video_size = video_size
+        self.collisions = collisions
+        self.depth = depth
+        self.per_dir = per_dir
+        self.days = days
+        self.padding = padding
+        self.seed = seed
+
+
+class _ExifTemplate(object):
+    """ piexif is far too slow to call a million times, so build one EXIF JPEG and patch
+        the date string (always 19 ASCII bytes) in place for each file
+    """
+    placeholder = datetime.datetime(1999, 12, 31, 23, 59, 58)
+
+    def __init__(self):
+        self.data = jpeg_bytes(self.placeholder)
+        self.offset = self.data.index(self.placeholder.strftime('%Y:%m:%d %H:%M:%S').encode('ascii'))
+
+    def render(self, datetime_taken, payload):
+        stamp = datetime_taken.strftime('%Y:%m:%d %H:%M:%S').encode('ascii')
+        data = self.data[:self.offset] + stamp + self.data[self.offset+19:]
+        if payload:
+            data = data[:2] + b'\xff\xfe' + (len(payload)+2).to_bytes(2, 'big') + payload + data[2:]
+        return data
+
+
+def generate_library(root, spec):
+    """ Write a reproducible synthetic photo library under root (same spec, same bytes).
+
+        :returns: dict of counts of what was written
+    """
+    rng = random.Random(spec.seed)
+    template = _ExifTemplate()
+    start = datetime.datetime(2015, 1, 1, 8, 0, 0)
+    counts = collections.Counter()
+    names_used = []
+    current_leaf, names_in_dir = None, set()
+
+    for i in range(spec.n_files):
+        leaf = i // spec.per_dir
+        # e.g. root/card03/DCIM/d1/d2/100CANON
+        parts = ['card%02d' % (leaf % 7), 'DCIM'] + ['d%d' % ((leaf >> (2*k)) % 4) for k in range(max(spec.depth-3, 0))]
+        dirname = os.path.join(root, *parts + ['%03dCANON' % (100 + leaf)])
+        taken = start + datetime.timedelta(days=rng.randrange(spec.days), seconds=rng.randrange(12*3600))
+        roll = rng.random()
+
+        if leaf != current_leaf:
+            current_leaf, names_in_dir = leaf, set()
+        stem = rng.choice(names_used) if names_used and rng.random() < spec.collisions else None
+        if stem is not None and stem not in names_in_dir:
+            counts['collisions'] += 1
+        else:
+            stem = 'IMG_%07d' % i
+            names_used.append(stem)
+        names_in_dir.add(stem)
+
+        if roll < spec.videos:
+            path = write_video(os.path.join(dirname, stem + '.MOV'), spec.video_size, mtime=taken.timestamp(), sparse=True)
+            counts['videos'] += 1
+        elif roll < spec.videos + spec.noexif:
+            path = os.path.join(dirname, stem + '.PNG')
+            os.makedirs(dirname, exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'\x89PNG\r\n\x1a\n' + rng.getrandbits(8*256).to_bytes(256, 'little'))
+            os.utime(path, (taken.timestamp(), taken.timestamp()))
+            counts['noexif'] += 1
+        else:
+            os.makedirs(dirname, exist_ok=True)
+            n = rng.randrange(spec.padding//2, spec.padding+1) if spec.padding else 0
+            payload = rng.getrandbits(8*n).to_bytes(n, 'little') if n else b''
+            with open(os.path.join(dirname, stem + '.JPG'), 'wb') as f:
+                f.write(template.render(taken, payload))
+            counts['jpeg'] += 1
+    counts['files'] = spec.n_files
+    return dict(counts)
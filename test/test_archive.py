@@ -0,0 +1,97 @@
+import photokeeper.photokeeper as P
+import photokeeper.archive as A
+import pytest
+import os, datetime, tarfile
+
+from synthlib import write_jpeg, write_video
+
+
+def make_images(srcdir, tgtdir, n=4, seed=0, padding=700):
+    images = []
+    for i in range(n):
+        dt = datetime.datetime(2016, 6, 24 + i % 2, 10, 12, i)
+        fn = write_jpeg(os.path.join(str(srcdir), 'IMG_%04d.jpg' % i), dt, padding=padding + i, seed=seed + i)
+        images.append(P.ImageFile(str(srcdir), os.path.basename(fn), str(tgtdir), dt.strftime('%Y-%m-%d'), dt))
+    return images
+
+
+class TestDayArchive:
+
+    def test_pack_and_read_back(self, tmpdir):
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        images = make_images(src, tgt)
+        A.DayArchive().execute_copy(images)
+
+        assert sorted(os.listdir(str(tgt))) == ['2016-06-24.tar', '2016-06-24.tar.idx', '2016-06-25.tar', '2016-06-25.tar.idx']
+        # A normal tar, readable by anything
+        with tarfile.open(str(tgt.join('2016-06-24.tar'))) as tar:
+            assert tar.getnames() == ['IMG_0000.jpg', 'IMG_0002.jpg']
+            assert tar.extractfile('IMG_0002.jpg').read() == open(images[2].srcpath, 'rb').read()
+        # Random access through the index
+        day = A.PackedDay(str(tgt.join('2016-06-25.tar')))
+        assert day.open_member('IMG_0003.jpg').read() == open(images[3].srcpath, 'rb').read()
+
+    def test_append_dedupe_and_collisions(self, tmpdir):
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        A.DayArchive().execute_copy(make_images(src, tgt))
+
+        # Same files again: all duplicates
+        images = make_images(src, tgt)
+        target = A.DayArchive()
+        target.check_duplicates(images)
+        assert all(img.archive_dup for img in images)
+
+        # Different photo with the same name, plus a brand new one: appended
+        other = tmpdir.mkdir('other')
+        images = make_images(other, tgt, n=1, seed=50, padding=900)
+        images.append(P.ImageFile(str(src), os.path.basename(write_video(str(src.join('MOV_1.mp4')), 5000)),
+                                  str(tgt), '2016-06-24', datetime.datetime(2016, 6, 24)))
+        target = A.DayArchive()
+        target.check_duplicates(images)
+        assert not any(img.archive_dup for img in images)
+        target.execute_copy(images)
+
+        with tarfile.open(str(tgt.join('2016-06-24.tar'))) as tar:
+            assert tar.getnames() == ['IMG_0000.jpg', 'IMG_0002.jpg', 'IMG_0000_1.jpg', 'MOV_1.mp4']
+        assert A.PackedDay(str(tgt.join('2016-06-24.tar'))).open_member('MOV_1.mp4').read() == open(str(src.join('MOV_1.mp4')), 'rb').read()
+
+    def test_appends_by_other_runs_are_kept(self, tmpdir):
+        """ A long-lived target (serve, watch) sees what other runs packed in the meantime """
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        a, b, c = make_images(src, tgt, n=3)[::2] + make_images(tmpdir.mkdir('other'), tgt, n=1, seed=50, padding=900)
+        warm = A.DayArchive()
+        warm.execute_copy([a])
+        A.DayArchive().execute_copy([b])
+
+        warm.check_duplicates([b, c])
+        assert b.archive_dup and not c.archive_dup
+        warm.execute_copy([b, c])   # c has the same name as a
+        day = A.PackedDay(str(tgt.join('2016-06-24.tar')))
+        assert list(day.entries) == ['IMG_0000.jpg', 'IMG_0002.jpg', 'IMG_0000_1.jpg']
+        for name, img in zip(day.entries, [a, b, c]):
+            assert day.open_member(name).read() == open(img.srcpath, 'rb').read()
+        with tarfile.open(str(tgt.join('2016-06-24.tar'))) as tar:
+            assert tar.getnames() == list(day.entries)
+
+    def test_index_rebuilt_from_tar(self, tmpdir):
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        images = make_images(src, tgt)
+        A.DayArchive().execute_copy(images)
+        os.remove(str(tgt.join('2016-06-24.tar.idx')))
+
+        day = A.PackedDay(str(tgt.join('2016-06-24.tar')))
+        assert list(day.entries) == ['IMG_0000.jpg', 'IMG_0002.jpg']
+        assert day.open_member('IMG_0000.jpg').read() == open(images[0].srcpath, 'rb').read()
+
+    def test_unindexed_tail_is_overwritten(self, tmpdir):
+        """ A crash after writing data but before the index leaves junk that the next append replaces """
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        A.DayArchive().execute_copy(make_images(src, tgt, n=1))
+        with open(str(tgt.join('2016-06-24.tar')), 'ab') as f:
+            f.write(b'junk' * 1000)
+        images = make_images(tmpdir.mkdir('more'), tgt, n=1, seed=9)
+        images[0].filename = 'IMG_0001.jpg'
+        os.rename(os.path.join(images[0].srcdir, 'IMG_0000.jpg'), images[0].srcpath)
+        A.DayArchive().execute_copy(images)
+        with tarfile.open(str(tgt.join('2016-06-24.tar'))) as tar:
+            assert tar.getnames() == ['IMG_0000.jpg', 'IMG_0001.jpg']
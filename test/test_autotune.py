@@ -0,0 +1,154 @@
+import photokeeper.autotune as A
+import photokeeper.photokeeper as P
+from photokeeper.filecopy import FileCopy
+import pytest
+import os, time, datetime, threading, email.utils
+
+from synthlib import write_jpeg
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def drive(controller, clock, capacity, windows=60, base_latency=0.01, nbytes=1000):
+    """ Feed the controller a target that gets faster up to capacity operations at once,
+        and after that just makes each one wait longer
+    """
+    for _ in range(windows):
+        limit = controller.limit
+        latency = base_latency * max(1.0, limit / capacity)
+        per_op = latency / limit   # limit operations finish every latency seconds
+        for _ in range(max(controller.window, 2*limit)):
+            clock.now += per_op
+            controller.success(nbytes, latency)
+    return controller
+
+
+class TestController:
+
+    @pytest.mark.parametrize('capacity', [3, 6, 12])
+    def test_settles_near_capacity(self, capacity):
+        clock = FakeClock()
+        c = drive(A.AIMDController('t', maximum=16, clock=clock), clock, capacity)
+        assert capacity - 1 <= c.limit <= capacity + 2
+        assert c.peak[1] >= capacity
+
+    def test_stays_at_maximum(self):
+        clock = FakeClock()
+        c = drive(A.AIMDController('t', maximum=5, clock=clock), clock, 100)
+        assert c.limit == 5
+
+    def test_errors_halve_the_limit(self):
+        c = A.AIMDController('t', initial=8, minimum=1)
+        c.failure()
+        assert c.limit == 4
+        c.failure(); c.failure(); c.failure()
+        assert c.limit == 1
+        assert c.errors == 4
+        assert 'errors' in c.summary()
+
+
+class TestRunAdaptive:
+
+    def test_results_in_order_and_in_flight_bounded(self):
+        c = A.AIMDController('t', initial=3, maximum=3)
+        lock = threading.Lock()
+        running = [0, 0]   # now, most at once
+
+        def work(i):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.001 * (i % 4))
+            with lock:
+                running[0] -= 1
+            return 1, i*i
+        got = []
+        A.run_adaptive(range(50), work, c, done=lambda i, r: got.append((i, r)))
+        assert got == [(i, i*i) for i in range(50)]
+        assert running[1] <= 3
+
+    def test_retries_then_gives_up(self):
+        c = A.AIMDController('t', initial=4)
+        attempts = {}
+
+        def work(i):
+            attempts[i] = attempts.get(i, 0) + 1
+            if i == 3 and attempts[i] <= 2:
+                raise IOError('busy')
+            return 1, i
+        got = []
+        A.run_adaptive(range(6), work, c, done=lambda i, r: got.append(r), retryable=lambda e: True, retries=2, backoff=0)
+        assert got == list(range(6))
+        assert attempts[3] == 3
+        assert c.errors == 2
+
+    def test_retries_back_off(self):
+        c = A.AIMDController('t', initial=1)
+        started = []
+
+        def work(i):
+            started.append(time.perf_counter())
+            if len(started) < 3:
+                raise IOError('busy')
+            return 1, i
+        A.run_adaptive([0], work, c, retryable=lambda e: True, retries=2, backoff=0.1)
+        assert started[1] - started[0] >= 0.1
+        assert started[2] - started[1] >= 0.2
+
+    def test_retry_after_is_honored(self):
+        c = A.AIMDController('t', initial=1)
+        started = []
+
+        def work(i):
+            started.append(time.perf_counter())
+            if len(started) == 1:
+                e = IOError('throttled')
+                e.retry_after = 0.3
+                raise e
+            return 1, i
+        A.run_adaptive([0], work, c, retryable=lambda e: True, backoff=0.01)
+        assert started[1] - started[0] >= 0.3
+
+    def test_retry_after_header(self):
+        assert A.retry_after_seconds('120') == 120
+        assert A.retry_after_seconds(None) is None
+        assert A.retry_after_seconds('soon') is None
+        later = email.utils.format_datetime(datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30))
+        assert 25 < A.retry_after_seconds(later) <= 30
+        assert A.retry_after_seconds('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+
+    def test_fatal_error_after_delivering_earlier_results(self):
+        c = A.AIMDController('t', initial=1)
+
+        def work(i):
+            if i == 2:
+                raise ValueError('bad file')
+            return 1, i
+        got = []
+        with pytest.raises(ValueError):
+            A.run_adaptive(range(10), work, c, done=lambda i, r: got.append(r))
+        assert got[:2] == [0, 1]
+        assert 2 not in got
+
+
+def test_file_copy_names_are_unique(tmpdir):
+    """ Files with the same name on the same day, copied at the same time, must not overwrite each other """
+    images = []
+    dt = datetime.datetime(2016, 6, 24, 10, 12, 0)
+    for i in range(20):
+        src = tmpdir.mkdir('card%d' % i)
+        write_jpeg(os.path.join(str(src), 'IMG_0001.jpg'), dt, padding=i)
+        images.append(P.ImageFile(str(src), 'IMG_0001.jpg', str(tmpdir.join('target')), '2016-06-24', dt))
+    target = FileCopy()
+    target.controller = A.AIMDController('file', initial=8, maximum=8)
+    target.execute_copy(images)
+    copied = os.listdir(str(tmpdir.join('target', '2016-06-24')))
+    assert len(copied) == 20
+    assert sorted(os.path.getsize(str(tmpdir.join('target', '2016-06-24', f))) for f in copied) == \
+        sorted(os.path.getsize(img.srcpath) for img in images)
@@ -0,0 +1,94 @@
+import photokeeper.photokeeper as P
+import photokeeper.catalog as C
+import pytest
+import os, datetime
+
+from synthlib import write_jpeg, write_video
+
+
+def make_library(src):
+    write_jpeg(str(src.join('a', 'IMG_1.jpg')), datetime.datetime(2016, 6, 24, 10, 0, 0), padding=100, seed=1)
+    write_jpeg(str(src.join('b', 'IMG_1.jpg')), datetime.datetime(2016, 6, 24, 10, 0, 0), padding=100, seed=1)
+    write_jpeg(str(src.join('a', 'IMG_2.jpg')), datetime.datetime(2016, 6, 25, 10, 0, 0), padding=200, seed=2)
+    write_jpeg(str(src.join('a', 'IMG_3.jpg')), datetime.datetime(2016, 7, 1, 10, 0, 0), padding=300, seed=3)
+    write_video(str(src.join('a', 'MOV_1.mp4')), 1000, mtime=datetime.datetime(2016, 7, 2, 9, 0).timestamp())
+
+
+class TestCatalog:
+
+    def test_queries_after_a_copy(self, tmpdir, capsys):
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        make_library(src)
+        db = str(tmpdir.join('catalog.db'))
+        P.PhotoKeeper().go([str(src), str(tgt), 'dedupe', 'file', '--catalog=' + db])
+
+        catalog = C.Catalog(db)
+        headings, rows = catalog.query('days')
+        assert [(d, n) for d, n, size in rows] == [('2016-06-24', 2), ('2016-06-25', 1), ('2016-07-01', 1), ('2016-07-02', 1)]
+        assert [(m, n) for m, n, size in catalog.query('months')[1]] == [('2016-06', 3), ('2016-07', 2)]
+        assert catalog.query('noexif')[1] == [(str(src.join('a', 'MOV_1.mp4')), '2016-07-02')]
+        (n, size, paths), = catalog.query('dupes')[1]
+        assert n == 2 and sorted(paths.split()) == [str(src.join('a', 'IMG_1.jpg')), str(src.join('b', 'IMG_1.jpg'))]
+        albums = catalog.query('albums')[1]
+        assert [(t, d, n) for t, d, n, size in albums][:2] == [('file', '2016-06-24', 2), ('file', '2016-06-25', 1)]
+        assert sum(size for t, d, n, size in albums) == sum(os.path.getsize(p) for p in src.visit(fil=lambda p: p.isfile()))
+
+        capsys.readouterr()
+        keeper = P.PhotoKeeper()
+        keeper.go(['query', 'months', '--catalog=' + db])
+        out = capsys.readouterr().out.splitlines()
+        with pytest.raises(C.sqlite3.ProgrammingError):   # Closed when done
+            keeper.catalog.query('months')
+        assert out[0].split() == ['month', 'files', 'bytes']
+        assert [l.split()[:2] for l in out[1:]] == [['2016-06', '3'], ['2016-07', '2']]
+
+    def test_rescan_keeps_hashes_of_unchanged_files(self, tmpdir):
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        make_library(src)
+        db = str(tmpdir.join('catalog.db'))
+        P.PhotoKeeper().go([str(src), str(tgt), 'preview', '--catalog=' + db])   # Hashes all the photos
+        # Hashed files are told apart by content now, not name and size
+        assert C.Catalog(db).query('dupes')[1][0][0] == 2
+
+        write_jpeg(str(src.join('a', 'IMG_2.jpg')), datetime.datetime(2016, 6, 25, 10, 0, 0), padding=50)
+        P.PhotoKeeper().go([str(src), 'examine', '--catalog=' + db])
+        hashes = dict(C.Catalog(db).db.execute('SELECT filename, sha1 FROM files WHERE path LIKE ?', ('%/a/%',)))
+        assert hashes['IMG_2.jpg'] is None
+        assert all(hashes[f] for f in ('IMG_1.jpg', 'IMG_3.jpg'))
+
+    def test_totals_follow_changes(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        make_library(src)
+        p = P.PhotoKeeper()
+        p.tgt_dir, p.readers = None, 1
+        p.examine_files(str(src))
+        catalog = C.Catalog(str(tmpdir.join('catalog.db')))
+        catalog.record_scan(p.images)
+        catalog.record_copies('file', p.images[:3])
+        catalog.record_copies('flickr', p.images)
+        catalog.record_copies('flickr', p.images)   # Again: no double counting
+
+        # A file is rewritten with another date and size, and another gets hashed
+        write_jpeg(str(src.join('a', 'IMG_3.jpg')), datetime.datetime(2016, 6, 24, 11, 0, 0), padding=900)
+        p.images = []
+        p.examine_files(str(src))
+        p.images[0]._sha1 = 'f' * 40
+        catalog.record_scan(p.images)
+
+        db = catalog.db
+        assert catalog.query('days')[1] == db.execute("SELECT day, COUNT(*), SUM(size) FROM files GROUP BY day ORDER BY day").fetchall()
+        assert catalog.query('albums')[1] == db.execute(
+            "SELECT target, day, COUNT(*), SUM(size) FROM copies JOIN files USING (path) GROUP BY target, day ORDER BY target, day").fetchall()
+        assert sorted(catalog.query('dupes')[1]) == sorted(db.execute(
+            "SELECT COUNT(*), SUM(size), group_concat(path, ' ') FROM files GROUP BY dupkey HAVING COUNT(*) > 1").fetchall())
+
+    @pytest.mark.parametrize('name', list(C.QUERIES))
+    def test_queries_do_not_scan_files(self, tmpdir, name):
+        """ Queries read the small totals tables, or the files table only through an index,
+            so they stay quick with millions of files
+        """
+        catalog = C.Catalog(str(tmpdir.join('catalog.db')))
+        plan = [row[-1].split() for row in catalog.db.execute('EXPLAIN QUERY PLAN ' + C.QUERIES[name][2])]
+        scans = [step for step in plan if step[0] in ('SCAN', 'SEARCH')]
+        assert scans
+        assert not [step for step in scans if step[1] in ('files', 'f', 'copies', 'c') and 'INDEX' not in step]
@@ -0,0 +1,148 @@
+import photokeeper.photokeeper as P
+import photokeeper.flickr as F
+import photokeeper.daemon as D
+import pytest
+import os, io, time, stat, logging, threading, datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_flickr import FakeFlickrServer
+from synthlib import write_jpeg
+
+
+def make_card(srcdir, day, n=3):
+    for i in range(n):
+        write_jpeg(os.path.join(srcdir, 'IMG_%d.jpg' % i), datetime.datetime(2016, 6, day, 10, 0, i), padding=100, seed=day*10+i)
+
+
+class TestDaemon:
+
+    def setup_method(self):
+        self.server = FakeFlickrServer().start()
+
+    def teardown_method(self):
+        self.server.stop()
+
+    def start(self, tmpdir, jobs=2):
+        self.socket_path = str(tmpdir.join('pk.sock'))
+        daemon = D.Daemon(self.socket_path, jobs)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=daemon.serve_forever, args=(self.stop,))
+        self.thread.start()
+        deadline = time.time() + 10
+        while not os.path.exists(self.socket_path):
+            assert self.thread.is_alive() and time.time() < deadline, 'The daemon did not start'
+            time.sleep(0.01)
+        return daemon
+
+    def submit(self, argv):
+        out = io.StringIO()
+        code = D.submit(argv, self.socket_path, out)
+        return code, out.getvalue()
+
+    def shutdown(self):
+        self.stop.set()
+        self.thread.join()
+
+    def test_jobs_share_the_targets(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(P, 'Flickr', lambda title_dedupe: F.Flickr(self.server.client(), title_dedupe=title_dedupe))
+        cards = [tmpdir.mkdir('card%d' % i) for i in range(3)]
+        for i, card in enumerate(cards):
+            make_card(str(card), 20 + i)
+        tgt = tmpdir.mkdir('tgt')
+        self.start(tmpdir)
+        try:
+            with ThreadPoolExecutor(3) as pool:
+                results = list(pool.map(self.submit, [[str(card), str(tgt), 'dedupe', 'file', 'flickr'] for card in cards]))
+        finally:
+            self.shutdown()
+        assert [code for code, out in results] == [0, 0, 0]
+        for i, (code, out) in enumerate(results):
+            assert 'Examining' in out and str(cards[i]) in out
+        assert sorted(os.listdir(str(tgt))) == ['2016-06-20', '2016-06-21', '2016-06-22']
+        assert len(self.server.state.photos) == 9
+        # Logged in and listed the albums once, for all three jobs
+        assert self.server.state.call_count('flickr.photosets.getList') == 1
+
+    def test_relative_paths_and_errors(self, tmpdir, monkeypatch):
+        card, tgt = tmpdir.mkdir('card'), tmpdir.mkdir('tgt')
+        make_card(str(card), 24)
+        self.start(tmpdir)
+        try:
+            monkeypatch.chdir(str(tmpdir))
+            code, out = self.submit(['card', 'tgt', 'file'])
+            assert code == 0
+            assert len(os.listdir(str(tgt.join('2016-06-24')))) == 3
+            code, out = self.submit(['missing', 'tgt', 'file'])
+            assert code == 1 and 'Source directory does not exist' in out
+            code, out = self.submit(['card', 'tgt', 'file', 'watch'])
+            assert code == 2
+            code, out = self.submit(['card', 'tgt', 'file', '--profile'])
+            assert code == 2 and '--profile' in out
+        finally:
+            self.shutdown()
+        assert not os.path.exists(self.socket_path)
+
+    def test_worker_output_goes_to_the_client(self, tmpdir, monkeypatch):
+        card, tgt = tmpdir.mkdir('card'), tmpdir.mkdir('tgt')
+        make_card(str(card), 24)
+        real_copy = P.FileCopy._copy_file
+        def noisy_copy(target, job):
+            print('Copying {} in a worker'.format(os.path.basename(job[0])))
+            logging.warning('Logged from a worker')
+            return real_copy(target, job)
+        monkeypatch.setattr(P.FileCopy, '_copy_file', noisy_copy)
+        handler = logging.StreamHandler(P.sys.stderr)
+        logging.getLogger().addHandler(handler)
+        start = threading.Thread.start
+        self.start(tmpdir)
+        try:
+            assert stat.S_IMODE(os.stat(self.socket_path).st_mode) == 0o600
+            assert threading.Thread.start is start
+            code, out = self.submit([str(card), str(tgt), 'file', '--readers', '2'])
+        finally:
+            self.shutdown()
+            logging.getLogger().removeHandler(handler)
+        assert code == 0
+        assert 'Copying IMG_0.jpg in a worker' in out
+        assert 'Logged from a worker' in out
+        assert '100%' in out   # tqdm
+
+    def test_home_is_the_clients(self, monkeypatch):
+        monkeypatch.setenv('HOME', '/home/client')
+        assert D.expand_user(['~/card:~/card2', '--catalog=~/c.db', '~user', 'file', '--spool', '~/sp', '--remap', '~a=b']) == \
+            ['/home/client/card:/home/client/card2', '--catalog=/home/client/c.db', os.path.expanduser('~user'), 'file',
+             '--spool', '/home/client/sp', '--remap', '~a=b']
+
+    def test_jobs_output_stays_apart(self, tmpdir):
+        """ Work handed to photokeeper's pools writes to the client of the job that handed it over """
+        from photokeeper.utils import ContextPool
+        streams = [io.StringIO(), io.StringIO()]
+        out = D._ThreadOutput(io.StringIO())
+        def job(stream, name):
+            D.JOB_STREAM.set(stream)
+            with ContextPool(2) as pool:
+                list(pool.map(lambda i: out.write('{}{} '.format(name, i)), range(4)))
+        with ThreadPoolExecutor(2) as jobs:
+            list(jobs.map(job, streams, 'ab'))
+        assert sorted(streams[0].getvalue().split()) == ['a0', 'a1', 'a2', 'a3']
+        assert sorted(streams[1].getvalue().split()) == ['b0', 'b1', 'b2', 'b3']
+        assert out.default.getvalue() == ''
+
+
+def test_absolute_args():
+    argv = ['a:/b', 'tgt', 'dedupe', 'file', '--catalog', 'c.db', '--spool=sp', '--readers=4', 'query']
+    assert D.absolute_args(argv, '/home/me') == \
+        ['/home/me/a:/b', '/home/me/tgt', 'dedupe', 'file', '--catalog', '/home/me/c.db', '--spool=/home/me/sp', '--readers=4', 'query']
+
+
+def test_option_values_after_a_space():
+    argv = ['card', '--io-order', 'inode', '--readers', '4', 'tgt', '--date-pol', 'name', '-v', '--cat', 'c.db', 'file']
+    assert D.absolute_args(argv, '/home/me') == \
+        ['/home/me/card', '--io-order', 'inode', '--readers', '4', '/home/me/tgt', '--date-pol', 'name', '-v',
+         '--cat', '/home/me/c.db', 'file']
+
+
+def test_value_options_match_the_usage():
+    from docopt import parse_defaults
+    assert sorted(D.VALUE_OPTIONS) == sorted(o.long for o in parse_defaults(P.__doc__) if o.argcount)
+    assert set(D.PATH_OPTIONS) <= set(D.VALUE_OPTIONS)
@@ -0,0 +1,69 @@
+import photokeeper.photokeeper as P
+import photokeeper.duplicates as D
+from photokeeper.utils import file_hash
+import pytest
+import os, shutil, datetime
+
+from synthlib import write_jpeg
+
+
+def image(path):
+    dt = datetime.datetime(2016, 6, 24, 10, 0, 0)
+    return P.ImageFile(os.path.dirname(path), os.path.basename(path), None, dt.strftime('%Y-%m-%d'), dt)
+
+
+class TestFindDuplicates:
+
+    def test_groups_identical_files(self, tmpdir):
+        a = write_jpeg(str(tmpdir.join('dump1', 'IMG_0001.jpg')), padding=1000, seed=1)
+        b = write_jpeg(str(tmpdir.join('dump1', 'IMG_0002.jpg')), padding=1000, seed=2)   # Same size
+        c = write_jpeg(str(tmpdir.join('dump1', 'IMG_0003.jpg')), padding=2000, seed=3)
+        tmpdir.mkdir('dump2')
+        a2 = shutil.copy(a, str(tmpdir.join('dump2', 'IMG_0001.jpg')))
+        a3 = shutil.copy(a, str(tmpdir.join('dump2', 'renamed.jpg')))
+        images = [image(p) for p in (a, b, c, a2, a3)]
+        groups = D.find_duplicates(images)
+        assert [[img.srcpath for img in g] for g in groups] == [[a, a2, a3]]
+        assert all(img._sha1 == file_hash(a) for img in groups[0])
+
+    def test_only_colliding_sizes_are_read(self, tmpdir, monkeypatch):
+        paths = [write_jpeg(str(tmpdir.join('IMG_%d.jpg' % i)), padding=100*i, seed=i) for i in range(5)]
+        read = []
+        monkeypatch.setattr(D, 'head_hash', lambda fn: read.append(fn))
+        monkeypatch.setattr(D, 'file_hash', lambda fn: read.append(fn))
+        assert D.find_duplicates([image(p) for p in paths]) == []
+        assert read == []
+
+    def test_head_match_is_hashed_whole(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(D, 'HEAD_BYTES', 1024)
+        a = write_jpeg(str(tmpdir.join('a.jpg')), padding=5000, seed=1)
+        with open(a, 'rb') as f:
+            data = bytearray(f.read())
+        data[-10] ^= 0xff   # Same start, different end
+        b = str(tmpdir.join('b.jpg'))
+        with open(b, 'wb') as f:
+            f.write(data)
+        c = shutil.copy(a, str(tmpdir.join('c.jpg')))
+        images = [image(p) for p in (a, b, c)]
+        groups = D.find_duplicates(images)
+        assert [[img.srcpath for img in g] for g in groups] == [[a, c]]
+        assert images[1]._sha1 == file_hash(b)
+
+    def test_known_hashes_are_reused(self, tmpdir, monkeypatch):
+        a = write_jpeg(str(tmpdir.join('a.jpg')), padding=1000, seed=1)
+        b = shutil.copy(a, str(tmpdir.join('b.jpg')))
+        images = [image(a), image(b)]
+        for img in images:
+            img._sha1 = file_hash(a)
+        monkeypatch.setattr(D, 'head_hash', lambda fn: pytest.fail('read ' + fn))
+        assert len(D.find_duplicates(images)) == 1
+
+
+def test_duplicates_in_the_source_are_copied_once(tmpdir):
+    src = tmpdir.mkdir('src')
+    for i in range(3):
+        write_jpeg(str(src.join('dump1', 'IMG_%d.jpg' % i)), datetime.datetime(2016, 6, 24, 10, 0, i), padding=100, seed=i)
+    shutil.copytree(str(src.join('dump1')), str(src.join('dump2')))
+    tgt = tmpdir.mkdir('tgt')
+    P.PhotoKeeper().go([str(src), str(tgt), 'dedupe', 'file'])
+    assert sorted(os.listdir(str(tgt.join('2016-06-24')))) == ['IMG_0.jpg', 'IMG_1.jpg', 'IMG_2.jpg']
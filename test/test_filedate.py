@@ -0,0 +1,94 @@
+import photokeeper.photokeeper as P
+import photokeeper.filedate as FD
+from photokeeper.metrics import Metrics
+import pytest
+import os, datetime
+
+from synthlib import write_jpeg, write_video
+
+
+class TestFilenameDater:
+
+    @pytest.mark.parametrize('name, expected', [
+        ('IMG_20160624_101202.jpg', datetime.datetime(2016, 6, 24, 10, 12, 2)),
+        ('PXL_20160624_101202123.jpg', datetime.datetime(2016, 6, 24, 10, 12, 2)),
+        ('PXL_20160624_101202123.MP.jpg', datetime.datetime(2016, 6, 24, 10, 12, 2)),
+        ('20160624_101202.mp4', datetime.datetime(2016, 6, 24, 10, 12, 2)),
+        ('Screenshot_20160624-101202.png', datetime.datetime(2016, 6, 24, 10, 12, 2)),
+        ('2016-06-24 10.12.02.jpg', datetime.datetime(2016, 6, 24, 10, 12, 2)),
+        ('signal-2016-06-24-101202.jpg', datetime.datetime(2016, 6, 24, 10, 12, 2)),
+        ('IMG-20160624-WA0001.jpg', datetime.datetime(2016, 6, 24)),
+        ('DSC_0001.JPG', None),
+        ('IMG_20161324_101202.jpg', None),   # No month 13
+        ('P1020160624_101202.jpg', None),
+    ])
+    def test_builtin_patterns(self, name, expected):
+        assert FD.FilenameDater().date(name) == expected
+
+    def test_extra_patterns_come_first(self, tmpdir):
+        conf = tmpdir.join('patterns.txt')
+        conf.write('# DJI\n\nDJI_(?P<Y>\\d{4})(?P<m>\\d\\d)(?P<d>\\d\\d)(?P<H>\\d\\d)(?P<M>\\d\\d)(?P<S>\\d\\d)\n')
+        dater = FD.FilenameDater(FD.load_patterns(str(conf)))
+        assert dater.date('DJI_20160624101202_0001.JPG') == datetime.datetime(2016, 6, 24, 10, 12, 2)
+        assert dater.date('IMG_20160624_101202.jpg') == datetime.datetime(2016, 6, 24, 10, 12, 2)
+
+    @pytest.mark.parametrize('line', ['IMG_(?P<Y>\\d{4})', 'IMG_(?P<Y>'])
+    def test_bad_patterns(self, tmpdir, line):
+        conf = tmpdir.join('patterns.txt')
+        conf.write('\n' + line + '\n')
+        with pytest.raises(ValueError, match='patterns.txt:2'):
+            FD.load_patterns(str(conf))
+
+
+class TestDatePolicy:
+
+    def keeper(self, policy):
+        p = P.PhotoKeeper()
+        p.tgt_dir, p.date_policy, p.metrics = None, policy, Metrics()
+        return p
+
+    def test_name_policy_does_not_open_the_file(self, tmpdir, monkeypatch):
+        fn = write_jpeg(str(tmpdir.join('IMG_20160624_101202.jpg')), datetime.datetime(2016, 6, 25, 8, 0, 0))
+        monkeypatch.setattr(P.piexif, 'load', lambda f: pytest.fail('EXIF read for ' + f))
+        img = self.keeper('name').examine_file(fn)
+        assert img.tgtdatedir == '2016-06-24'
+        assert img.datetime_taken == datetime.datetime(2016, 6, 24, 10, 12, 2)
+        assert img.exif_timestamp_missing   # So that Flickr is told the date
+
+    def test_name_policy_falls_back_to_exif(self, tmpdir):
+        fn = write_jpeg(str(tmpdir.join('DSC_0001.jpg')), datetime.datetime(2016, 6, 25, 8, 0, 0))
+        img = self.keeper('name').examine_file(fn)
+        assert img.tgtdatedir == '2016-06-25'
+        assert not img.exif_timestamp_missing
+
+    def test_exif_policy_prefers_exif_then_name_then_mtime(self, tmpdir):
+        p = self.keeper('exif')
+        fn = write_jpeg(str(tmpdir.join('IMG_20160624_101202.jpg')), datetime.datetime(2016, 6, 25, 8, 0, 0))
+        assert p.examine_file(fn).tgtdatedir == '2016-06-25'
+        mtime = datetime.datetime(2016, 7, 1).timestamp()
+        fn = write_video(str(tmpdir.join('VID_20160624_101202.mp4')), 100, mtime=mtime)
+        img = p.examine_file(fn)
+        assert img.tgtdatedir == '2016-06-24'
+        assert img.exif_timestamp_missing
+        fn = write_video(str(tmpdir.join('MOV_0001.mp4')), 100, mtime=mtime)
+        assert p.examine_file(fn).tgtdatedir == '2016-07-01'
+
+    def test_verify_policy_reports_mismatches(self, tmpdir):
+        p = self.keeper('verify')
+        fn = write_jpeg(str(tmpdir.join('IMG_20160624_101202.jpg')), datetime.datetime(2016, 6, 25, 8, 0, 0))
+        assert p.examine_file(fn).tgtdatedir == '2016-06-25'
+        fn = write_jpeg(str(tmpdir.join('IMG_20160624_111111.jpg')), datetime.datetime(2016, 6, 24, 11, 11, 11))
+        assert p.examine_file(fn).tgtdatedir == '2016-06-24'
+        assert p.metrics.counters['examine.name_mismatch'] == 1
+
+    def test_options(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        with pytest.raises(SystemExit):
+            P.PhotoKeeper().get_options([str(src), 'examine', '--date-policy=guess'])
+        conf = tmpdir.join('patterns.txt')
+        conf.write('(?P<Y>\\d{4})\n')
+        with pytest.raises(SystemExit):
+            P.PhotoKeeper().get_options([str(src), 'examine', '--date-patterns=%s' % conf])
+        p = P.PhotoKeeper()
+        p.get_options([str(src), 'examine', '--date-policy=name'])
+        assert p.date_policy == 'name'
@@ -0,0 +1,272 @@
+import photokeeper.flickr as F
+import photokeeper.photokeeper as P
+import pytest
+import os, sys, time, datetime, subprocess
+
+from fake_flickr import FakeFlickrServer
+from synthlib import write_jpeg, write_video
+
+
+def make_images(tmpdir, n_photos=3, n_videos=1):
+    """ Write some small files, and return the ImageFiles the examine step would have created """
+    images = []
+    for i in range(n_photos):
+        dt = datetime.datetime(2016, 6, 24, 10, 12, i)
+        fn = write_jpeg(os.path.join(str(tmpdir), 'IMG_%04d.jpg' % i), dt)
+        images.append(P.ImageFile(str(tmpdir), os.path.basename(fn), None, dt.strftime('%Y-%m-%d'), dt))
+    for i in range(n_videos):
+        dt = datetime.datetime(2016, 6, 25, 8, 0, i)
+        fn = write_video(os.path.join(str(tmpdir), 'MOV_%04d.mp4' % i), 4096, mtime=dt.timestamp())
+        images.append(P.ImageFile(str(tmpdir), os.path.basename(fn), None, dt.strftime('%Y-%m-%d'), dt, True))
+    return images
+
+
+class TestFlickr:
+
+    def setup_method(self):
+        self.server = FakeFlickrServer().start()
+
+    def teardown_method(self):
+        self.server.stop()
+
+    def test_upload_creates_albums(self, tmpdir):
+        images = make_images(tmpdir)
+        f = F.Flickr(self.server.client())
+        f.execute_copy(images)
+
+        state = self.server.state
+        assert len(state.photos) == 4
+        albums = {s.title: s for s in state.photosets.values()}
+        assert sorted(albums) == ['2016-06-24', '2016-06-25']
+        assert len(albums['2016-06-24'].photos) == 3
+        # The video has no EXIF, so its date must have been set explicitly
+        video = state.photos[albums['2016-06-25'].photos[0]]
+        assert video.datetaken == '2016-06-25 08:00:00'
+
+    def test_second_run_finds_duplicates(self, tmpdir):
+        images = make_images(tmpdir)
+        F.Flickr(self.server.client()).execute_copy(images)
+
+        images = make_images(tmpdir)
+        f = F.Flickr(self.server.client())
+        f.check_duplicates(images)
+        assert all(img.flickr_dup for img in images)
+        f.execute_copy(images)
+        assert len(self.server.state.photos) == 4
+        # Found by hash, without listing any albums
+        assert self.server.state.call_count('flickr.photosets.getPhotos') == 0
+        assert self.server.state.call_count('flickr.photos.search') == 1
+
+    def test_dedupe_by_content_not_name(self, tmpdir):
+        images = make_images(tmpdir)
+        F.Flickr(self.server.client()).execute_copy(images)
+
+        # Same name, different photo
+        other = tmpdir.mkdir('other')
+        images = make_images(other, 1, 0)
+        write_jpeg(images[0].srcpath, datetime.datetime(2016, 6, 24, 10, 12, 0), padding=10)
+        # Same photo, filed on another day (album) under another name
+        moved = P.ImageFile(str(tmpdir), 'IMG_0001.jpg', None, '2016-07-01', datetime.datetime(2016, 7, 1))
+        f = F.Flickr(self.server.client(), title_dedupe=False)   # Same title and date would match
+        f.check_duplicates([images[0], moved])
+        assert not images[0].flickr_dup
+        assert moved.flickr_dup
+
+    def test_title_dedupe_for_untagged_photos(self, tmpdir):
+        images = make_images(tmpdir, 2, 0)
+        f = F.Flickr(self.server.client())
+        f._hash_tag = lambda sha1: None  # Upload like older versions did
+        f.execute_copy(images)
+
+        images = make_images(tmpdir, 2, 0)
+        F.Flickr(self.server.client(), title_dedupe=False).check_duplicates(images)
+        assert not any(img.flickr_dup for img in images)
+        F.Flickr(self.server.client()).check_duplicates(images)
+        assert all(img.flickr_dup for img in images)
+
+    def test_title_dedupe_skips_tagged_photos(self, tmpdir):
+        images = make_images(tmpdir, 2, 0)
+        F.Flickr(self.server.client()).execute_copy(images)
+
+        # Same name and date, different photo: the one on Flickr has a hash tag that doesn't match
+        other = tmpdir.mkdir('other')
+        first = make_images(other, 1, 0)
+        write_jpeg(first[0].srcpath, datetime.datetime(2016, 6, 24, 10, 12, 0), padding=10)
+        f = F.Flickr(self.server.client())
+        f.check_duplicates(first)
+        assert not first[0].flickr_dup
+        # Nothing untagged in the album, so it isn't listed again
+        second = make_images(other, 1, 0)
+        write_jpeg(second[0].srcpath, datetime.datetime(2016, 6, 24, 10, 12, 0), padding=20)
+        f.check_duplicates(second)
+        assert not second[0].flickr_dup
+        assert self.server.state.call_count('flickr.photosets.getPhotos') == 1
+
+    def test_interrupted_upload_is_put_in_its_album(self, tmpdir, monkeypatch):
+        images = make_images(tmpdir, 3, 1)
+        f = F.Flickr(self.server.client())
+        monkeypatch.setattr(f, '_flush_pending', lambda: (_ for _ in ()).throw(KeyboardInterrupt))
+        with pytest.raises(KeyboardInterrupt):   # Killed before the album additions went out
+            f.execute_copy(images)
+        albums = {s.title: s for s in self.server.state.photosets.values()}
+        assert len(albums['2016-06-24'].photos) == 1
+
+        images = make_images(tmpdir, 3, 1)
+        f = F.Flickr(self.server.client())
+        f.check_duplicates(images)
+        assert all(img.flickr_dup for img in images)
+        f.execute_copy(images)
+        assert len(self.server.state.photos) == 4
+        assert len(albums['2016-06-24'].photos) == 3
+        assert self.server.state.call_count('flickr.photos.getNotInSet') == 1
+
+    def test_photos_moved_to_another_album_stay_there(self, tmpdir):
+        images = make_images(tmpdir, 2, 0)
+        F.Flickr(self.server.client()).execute_copy(images)
+        state = self.server.state
+        album = [s for s in state.photosets.values() if s.title == '2016-06-24'][0]
+        state.photosets_create({'title': 'Holiday', 'primary_photo_id': album.photos.pop()})
+
+        images = make_images(tmpdir, 2, 0)
+        f = F.Flickr(self.server.client())
+        f.check_duplicates(images)
+        f.execute_copy(images)
+        assert len(album.photos) == 1
+
+    def test_injected_errors_surface(self, tmpdir):
+        # More failures in a row than the upload is retried
+        server = FakeFlickrServer(errors={'upload': F.Flickr.upload_retries+1}).start()
+        try:
+            f = F.Flickr(server.client())
+            f.retry_backoff = 0.01
+            with pytest.raises(F.flickrapi.FlickrError):
+                f.execute_copy(make_images(tmpdir, 1, 0))
+        finally:
+            server.stop()
+
+    def test_transient_errors_are_retried(self, tmpdir):
+        server = FakeFlickrServer(errors={'upload': 2}).start()
+        try:
+            f = F.Flickr(server.client())
+            f.retry_backoff = 0.01
+            f.execute_copy(make_images(tmpdir, 6, 0))
+            assert server.state.call_count('upload') == 8
+            album = list(server.state.photosets.values())[0]
+            assert len(album.photos) == 6
+            assert f.controller.errors == 2
+        finally:
+            server.stop()
+
+    def test_throttled_upload_waits_for_retry_after(self, tmpdir):
+        server = FakeFlickrServer(throttled=1, retry_after=1).start()
+        try:
+            f = F.Flickr(server.client())
+            f.retry_backoff = 0.01
+            real_upload = f._upload_file
+            started = []
+            def timed_upload(filename, tags=None):
+                started.append(time.time())
+                return real_upload(filename, tags)
+            f._upload_file = timed_upload
+            f.controller.limit = 1
+            f.execute_copy(make_images(tmpdir, 1, 0))
+            assert len(server.state.photos) == 1
+            assert started[1] - started[0] >= 1
+        finally:
+            server.stop()
+
+    def test_album_membership_is_batched(self, tmpdir):
+        images = make_images(tmpdir, 20, 1)
+        F.Flickr(self.server.client()).execute_copy(images)
+
+        state = self.server.state
+        assert state.call_count('upload') == 21
+        assert state.call_count('flickr.photosets.addPhoto') == 0
+        assert state.call_count('flickr.photosets.editPhotos') == 1
+        albums = {s.title: s for s in state.photosets.values()}
+        titles = [state.photos[i].title for i in albums['2016-06-24'].photos]
+        assert titles == ['IMG_%04d.jpg' % i for i in range(20)]
+
+    def test_batch_keeps_existing_album_photos(self, tmpdir):
+        state = self.server.state
+        primary = state.add_photo('old.jpg', 1, '', '2016-06-24 00:00:00')
+        state.photosets_create({'title': '2016-06-24', 'primary_photo_id': primary.photoid})
+        album = list(state.photosets.values())[0]
+        for i in range(600):  # More than one page of getPhotos
+            album.photos.append(state.add_photo('old%d.jpg' % i, 1, '', '2016-06-24 00:00:00').photoid)
+
+        F.Flickr(self.server.client()).execute_copy(make_images(tmpdir, 3, 0))
+        assert len(album.photos) == 604
+        assert album.primary == primary.photoid
+
+    def test_failed_batch_falls_back_to_single_adds(self, tmpdir):
+        server = FakeFlickrServer(errors={'flickr.photosets.editPhotos': 1}).start()
+        try:
+            F.Flickr(server.client()).execute_copy(make_images(tmpdir, 5, 0))
+            album = list(server.state.photosets.values())[0]
+            assert len(album.photos) == 5
+            assert server.state.call_count('flickr.photosets.addPhoto') == 4
+        finally:
+            server.stop()
+
+    def test_failures_in_a_full_batch_are_reported(self, tmpdir):
+        server = FakeFlickrServer(errors={'flickr.photosets.editPhotos': 1, 'flickr.photosets.addPhoto': 2}).start()
+        try:
+            f = F.Flickr(server.client())
+            f.album_batch_size = 2   # The first batch is flushed while uploading, and fails
+            with pytest.raises(F.flickrapi.FlickrError) as e:
+                f.execute_copy(make_images(tmpdir, 5, 0))
+            album = list(server.state.photosets.values())[0]
+            assert len(album.photos) == 3
+            left_out = [p for p in server.state.photos if p not in album.photos]
+            assert sorted(str(e.value).split(': ')[-1].split(',')) == sorted(left_out)
+            assert not f.failed_album_adds
+        finally:
+            server.stop()
+
+    def test_uploads_are_added_to_albums_when_a_later_upload_fails(self, tmpdir):
+        f = F.Flickr(self.server.client())
+        real_upload = f._upload_file
+        uploads = []
+        def flaky_upload(filename, tags=None):
+            if len(uploads) == 3:
+                raise F.flickrapi.FlickrError('boom')
+            uploads.append(filename)
+            return real_upload(filename, tags)
+        f._upload_file = flaky_upload
+        with pytest.raises(F.flickrapi.FlickrError):
+            f.execute_copy(make_images(tmpdir, 5, 0))
+        album = list(self.server.state.photosets.values())[0]
+        assert len(album.photos) == 3
+
+
+UPLOAD_RSS_SCRIPT = """
+import os, sys, resource, datetime
+sys.path[:0] = [{root!r}, {testdir!r}]
+from fake_flickr import FakeFlickrServer
+from synthlib import write_video
+import photokeeper.flickr as F
+import photokeeper.photokeeper as P
+
+fn = write_video({path!r}, {size}, sparse=True)
+img = P.ImageFile(os.path.dirname(fn), os.path.basename(fn), None, '2016-06-24', datetime.datetime(2016, 6, 24), True)
+img._sha1 = 'x'  # Hashing isn't what's being measured
+with FakeFlickrServer() as server:
+    f = F.Flickr(server.client())
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    f.execute_copy([img])
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    assert list(server.state.photos.values())[0].size == {size}
+print(before, after)
+"""
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='ru_maxrss is in kB on Linux only')
+def test_large_upload_memory_is_bounded(tmpdir):
+    """ Upload a 512MB file in a fresh process; peak RSS must not grow with the file size """
+    size = 512*1024*1024
+    script = UPLOAD_RSS_SCRIPT.format(root=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                      testdir=os.path.dirname(os.path.abspath(__file__)),
+                                      path=os.path.join(str(tmpdir), 'big.mp4'), size=size)
+    out = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.DEVNULL)
+    before, after = [int(x) for x in out.split()[-2:]]
+    assert (after - before)*1024 < 32*1024*1024
@@ -0,0 +1,83 @@
+import photokeeper.photokeeper as P
+import photokeeper.ingest as I
+import pytest
+import os, time, datetime, threading
+from collections import Counter
+
+from synthlib import write_jpeg
+
+
+class TestDeviceScheduler:
+
+    def test_concurrency_is_per_device(self):
+        lock = threading.Lock()
+        running, peak = Counter(), Counter()
+        def read(device):
+            with lock:
+                running[device] += 1
+                running['all'] += 1
+                peak[device] = max(peak[device], running[device])
+                peak['all'] = max(peak['all'], running['all'])
+            time.sleep(0.02)
+            with lock:
+                running[device] -= 1
+                running['all'] -= 1
+
+        with I.DeviceScheduler(readers=2) as scheduler:
+            futures = [scheduler.submit(dev, read, dev) for i in range(10) for dev in ('sda', 'sdb', 'sdc')]
+            for f in futures:
+                f.result()
+        assert peak['sda'] == peak['sdb'] == peak['sdc'] == 2
+        assert peak['all'] > 2   # The devices were read at the same time
+
+    def test_device_of_a_directory(self, tmpdir):
+        scheduler = I.DeviceScheduler()
+        sub = tmpdir.mkdir('sub')
+        assert scheduler.device(str(tmpdir)) == scheduler.device(str(sub))
+
+
+class TestMultipleSources:
+
+    def make_card(self, tmpdir, name, day, n):
+        card = tmpdir.mkdir(name)
+        for i in range(n):
+            # Padded differently, so cards shot on the same day don't hold identical files
+            write_jpeg(os.path.join(str(card), 'DCIM', '%s_%d.jpg' % (name, i)), datetime.datetime(2016, 6, day, 10, 0, i),
+                       padding=16, seed=name+str(i))
+        return card
+
+    def test_sources_are_merged_in_order(self, tmpdir):
+        cards = [self.make_card(tmpdir, 'card%d' % i, 20 + i, 5) for i in range(3)]
+        p = P.PhotoKeeper()
+        p.tgt_dir, p.readers = None, 2
+        p.examine_files([str(c) for c in cards])
+        # Grouped by source, in the order given (within a source, in directory order)
+        assert [img.filename.split('_')[0] for img in p.images] == ['card0']*5 + ['card1']*5 + ['card2']*5
+        assert sorted(img.filename for img in p.images) == ['card%d_%d.jpg' % (c, i) for c in range(3) for i in range(5)]
+        assert [img.tgtdatedir for img in p.images[::5]] == ['2016-06-20', '2016-06-21', '2016-06-22']
+
+    def test_copy_from_several_sources(self, tmpdir):
+        cards = [self.make_card(tmpdir, 'card%d' % i, 24, 3) for i in range(2)]
+        tgt = tmpdir.mkdir('tgt')
+        P.PhotoKeeper().go([os.pathsep.join(str(c) for c in cards), str(tgt), 'dedupe', 'file'])
+        assert sorted(os.listdir(str(tgt.join('2016-06-24')))) == ['card%d_%d.jpg' % (c, i) for c in range(2) for i in range(3)]
+
+    def test_missing_source_is_an_error(self, tmpdir):
+        card = self.make_card(tmpdir, 'card', 24, 1)
+        with pytest.raises(SystemExit):
+            P.PhotoKeeper().get_options([os.pathsep.join([str(card), str(tmpdir.join('nope'))]), 'examine'])
+
+    @pytest.mark.parametrize('option', ['--readers=0', '--readers=two', '--jobs=0', '--spool-size=-1',
+                                        '--debounce=0', '--poll=x'])
+    def test_bad_numbers_are_an_error(self, tmpdir, option):
+        card = self.make_card(tmpdir, 'card', 24, 1)
+        with pytest.raises(SystemExit) as e:
+            P.PhotoKeeper().get_options([str(card), 'examine', option])
+        assert str(e.value.code).startswith(option.split('=')[0] + ' must be')
+
+    def test_numbers_are_converted(self, tmpdir):
+        card = self.make_card(tmpdir, 'card', 24, 1)
+        p = P.PhotoKeeper()
+        p.get_options([str(card), 'examine', '--readers=3', '--poll=0.5'])
+        assert p.readers == 3
+        assert p.args['--poll'] == 0.5 and p.args['--debounce'] == 2.0 and p.args['--spool-size'] == 4096
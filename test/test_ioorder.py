@@ -0,0 +1,61 @@
+import photokeeper.photokeeper as P
+import photokeeper.ioorder as O
+import pytest
+import os, random, datetime
+
+from synthlib import write_jpeg
+
+
+def make_files(tmpdir, n=30):
+    """ Files created in a shuffled order across directories, so walk order != disk order """
+    names = [str(tmpdir.join('d%d' % (i % 3), 'IMG_%03d.jpg' % i)) for i in range(n)]
+    random.Random(1).shuffle(names)
+    for i, name in enumerate(names):
+        write_jpeg(name, datetime.datetime(2016, 6, 24, 10, 0, i % 60), padding=5000, seed=i)
+    return names
+
+
+class TestIOOrder:
+
+    def test_inode_order(self, tmpdir):
+        make_files(tmpdir)
+        p = P.PhotoKeeper()
+        p.io_order = 'inode'
+        files = p.list_files(str(tmpdir))
+        inodes = [os.stat(f).st_ino for f in files]
+        assert inodes == sorted(inodes) and len(files) == 30
+
+    def test_disk_order(self, tmpdir):
+        names = make_files(tmpdir)
+        os.sync()
+        if O.first_extent(names[0]) is None:
+            pytest.skip('no FIEMAP on this filesystem')
+        ordered = O.physical_order(reversed(names), 'disk')
+        offsets = [O.first_extent(f) for f in ordered]
+        assert offsets == sorted(offsets)
+
+    def test_unmapped_files_go_last_by_inode(self, tmpdir, monkeypatch):
+        names = make_files(tmpdir, 6)
+        extents = {names[4]: 100, names[1]: 50}
+        monkeypatch.setattr(O, 'first_extent', lambda path: extents.get(path))
+        ordered = O.physical_order(names, 'disk')
+        assert ordered[:2] == [names[1], names[4]]
+        rest = [os.stat(f).st_ino for f in ordered[2:]]
+        assert rest == sorted(rest)
+
+    def test_examine_and_copy_follow_the_order(self, tmpdir, monkeypatch):
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        make_files(src, 12)
+        copied = []
+        monkeypatch.setattr(P.FileCopy, 'execute_copy', lambda self, images: copied.extend(img.srcpath for img in images))
+        p = P.PhotoKeeper()
+        p.go([str(src), str(tgt), 'file', '--io-order=inode', '--readers=1'])
+        inodes = [os.stat(img.srcpath).st_ino for img in p.images]
+        assert inodes == sorted(inodes)
+        assert copied == [img.srcpath for img in p.images]
+
+    def test_bad_order(self, tmpdir):
+        with pytest.raises(ValueError):
+            O.physical_order([], 'random')
+        with pytest.raises(SystemExit):
+            P.PhotoKeeper().get_options([str(tmpdir), 'examine', '--io-order=random'])
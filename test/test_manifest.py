@@ -0,0 +1,55 @@
+import photokeeper.photokeeper as P
+import photokeeper.manifest as M
+import pytest
+import os, gzip, json, datetime
+
+from synthlib import write_jpeg, write_video
+
+
+def make_card(card):
+    for i in range(3):
+        write_jpeg(os.path.join(str(card), 'DCIM', 'IMG_%d.jpg' % i), datetime.datetime(2016, 6, 24, 10, 0, i))
+    write_video(os.path.join(str(card), 'DCIM', 'MOV_1.mp4'), 2048, mtime=datetime.datetime(2016, 6, 25, 9, 0).timestamp())
+
+
+class TestManifest:
+
+    def test_examine_on_one_host_copy_on_another(self, tmpdir, monkeypatch):
+        card, tgt = tmpdir.mkdir('card'), tmpdir.mkdir('tgt')
+        make_card(card)
+        manifest = str(tmpdir.join('scan.jsonl.gz'))
+        P.PhotoKeeper().go([str(card), 'examine', '--save-manifest=' + manifest, '--manifest-hashes'])
+
+        with gzip.open(manifest, 'rt') as f:
+            lines = [json.loads(l) for l in f]
+        assert lines[0]['photokeeper_manifest'] == 1
+        assert sorted(r['day'] for r in lines[1:]) == ['2016-06-24']*3 + ['2016-06-25']
+        assert all(len(r['sha1']) == 40 for r in lines[1:])
+        assert [r.get('no_exif', False) for r in lines[1:] if r['path'].endswith('.mp4')] == [True]
+
+        # The "other host" sees the card's files under a different path, and doesn't read EXIF
+        os.rename(str(card), str(tmpdir.join('nas_copy')))
+        def no_exif(filename):
+            raise AssertionError('examined ' + filename)
+        monkeypatch.setattr(P.piexif, 'load', no_exif)
+        p = P.PhotoKeeper()
+        p.go([manifest, str(tgt), 'dedupe', 'file', '--remap=%s=%s' % (card, tmpdir.join('nas_copy'))])
+        assert sorted(os.listdir(str(tgt.join('2016-06-24')))) == ['IMG_0.jpg', 'IMG_1.jpg', 'IMG_2.jpg']
+        assert os.listdir(str(tgt.join('2016-06-25'))) == ['MOV_1.mp4']
+        video = [img for img in p.images if img.filename == 'MOV_1.mp4'][0]
+        assert video.exif_timestamp_missing
+        assert video._sha1 is not None   # Hashes come along, so they aren't computed again
+
+    def test_remap(self):
+        remaps = M.parse_remap(os.pathsep.join(['/media=/mnt/edge', '/media/card2=/srv/card2/']))
+        assert M.remap_path('/media/card1/a.jpg', remaps) == '/mnt/edge/card1/a.jpg'
+        assert M.remap_path('/media/card2/a.jpg', remaps) == '/srv/card2/a.jpg'
+        assert M.remap_path('/mediax/a.jpg', remaps) == '/mediax/a.jpg'
+        with pytest.raises(M.ManifestError):
+            M.parse_remap('/media')
+
+    def test_not_a_manifest(self, tmpdir):
+        bogus = tmpdir.join('photo.jpg')
+        bogus.write('not json')
+        with pytest.raises(M.ManifestError):
+            list(M.read_manifest(str(bogus), P.ImageFile))
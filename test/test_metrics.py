@@ -0,0 +1,76 @@
+import photokeeper.photokeeper as P
+from photokeeper.metrics import Metrics, NO_METRICS
+import json, os, threading, datetime
+
+from synthlib import write_jpeg, write_video
+
+
+class TestMetrics:
+
+    def test_percentiles(self):
+        s = [float(i) for i in range(1, 101)]
+        assert Metrics.percentile(s, 50) == 50.0
+        assert Metrics.percentile(s, 99) == 99.0
+        assert Metrics.percentile(s, 100) == 100.0
+        assert Metrics.percentile([], 50) is None
+
+    def test_disabled_records_nothing(self):
+        with NO_METRICS.stage('x'), NO_METRICS.timer('parse'):
+            NO_METRICS.count('files')
+        assert NO_METRICS.report()['stages'] == []
+        assert not NO_METRICS.samples and not NO_METRICS.counters
+
+    def test_profiled_stage(self):
+        m = Metrics(profile=True)
+        with m.stage('work'):
+            sorted(range(1000))
+        stage = m.report()['stages'][0]
+        assert stage['name'] == 'work'
+        assert any('sorted' in row['function'] for row in stage['profile'])
+
+    def test_profiled_stage_includes_worker_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        def in_worker(n):
+            return sorted(range(n), reverse=True)
+        m = Metrics(profile=True)
+        with m.stage('work'):
+            with ThreadPoolExecutor(2) as pool:
+                list(pool.map(in_worker, [1000]*4))
+        stage = m.report()['stages'][0]
+        assert any('in_worker' in row['function'] for row in stage['profile'])
+
+    def test_profiled_pool_finishes(self):
+        """ On 3.12+ only one profiler may be enabled; profiling each worker too hung the pool """
+        from concurrent.futures import ThreadPoolExecutor
+        m = Metrics(profile=True)
+        def run():
+            with m.stage('work'):
+                with ThreadPoolExecutor(4) as pool:
+                    list(pool.map(sorted, [range(1000)]*8))
+        t = threading.Thread(target=run, daemon=True)
+        t.start()
+        t.join(10)
+        assert not t.is_alive()
+        assert m.report()['stages'][0]['profile']
+
+    def test_nested_profiled_stages(self):
+        m = Metrics(profile=True)
+        with m.stage('outer'):
+            with m.stage('inner'):
+                sorted(range(1000))
+        assert [s['name'] for s in m.report()['stages']] == ['inner', 'outer']
+
+    def test_run_writes_report(self, tmpdir):
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        for i in range(5):
+            write_jpeg(os.path.join(str(src), 'IMG_%d.jpg' % i), datetime.datetime(2016, 6, 24, 10, 0, i))
+        write_video(os.path.join(str(src), 'MOV_1.mp4'), 100)
+        report_file = str(tmpdir.join('metrics.json'))
+
+        P.PhotoKeeper().go([str(src), str(tgt), 'dedupe', 'file', '--metrics=%s' % report_file])
+        report = json.load(open(report_file))
+        assert [s['name'] for s in report['stages']] == ['examine', 'dedupe:source', 'file:setup', 'file:dedupe', 'file']
+        assert report['latency']['parse']['count'] == 6
+        assert report['latency']['copy']['count'] == 6
+        assert report['counters']['examine.exif_missing'] == 1
+        assert report['flow'] == ['dedupe', 'file']
@@ -0,0 +1,84 @@
+import photokeeper.photokeeper as P
+import photokeeper.preview as V
+import pytest
+import os, hashlib, datetime
+
+import piexif
+from synthlib import write_jpeg, write_video
+
+
+def sha1_of(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class TestPreviews:
+
+    def test_thumbnails_are_extracted_by_content(self, tmpdir):
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        dt = datetime.datetime(2016, 6, 24, 10, 0, 0)
+        a = write_jpeg(str(src.join('IMG_1.jpg')), dt, padding=100, seed=1, thumbnail=True)
+        b = write_jpeg(str(src.join('IMG_2.jpg')), dt, padding=100, seed=2, thumbnail=True)
+        write_jpeg(str(src.join('copy', 'IMG_1.jpg')), dt, padding=100, seed=1, thumbnail=True)  # Same photo twice
+        plain = write_jpeg(str(src.join('IMG_3.jpg')), dt)
+        write_video(str(src.join('MOV_1.mp4')), 1000)
+
+        p = P.PhotoKeeper()
+        p.go([str(src), str(tgt), 'preview', 'dedupe', 'file'])
+
+        cache = V.PreviewCache(str(tgt))
+        previews = [os.path.join(d, f) for d, _, files in os.walk(cache.cache_dir) for f in files]
+        assert sorted(previews) == sorted([cache.path(sha1_of(a)), cache.path(sha1_of(b))])
+        with open(cache.path(sha1_of(a)), 'rb') as f:
+            assert f.read() == piexif.load(a)['thumbnail']
+        # Hashes of the photos were computed on the way; the video wasn't read
+        assert len(p.images) == 5
+        assert all(img._sha1 == sha1_of(img.srcpath) for img in p.images if img.filename.endswith('.jpg'))
+        assert cache.get(sha1_of(a), a) == cache.path(sha1_of(a))
+
+    def test_target_previews_are_not_photos(self, tmpdir):
+        tgt = tmpdir.mkdir('tgt')
+        write_jpeg(str(tgt.join('2016-06-24', 'IMG_1.jpg')), datetime.datetime(2016, 6, 24), thumbnail=True)
+        P.PhotoKeeper().go([str(tgt), str(tmpdir.mkdir('other')), 'preview'])
+        p = P.PhotoKeeper()
+        p.go([str(tgt), 'examine'])
+        assert [img.filename for img in p.images] == ['IMG_1.jpg']
+
+    def test_missing_thumbnails_are_made_lazily(self, tmpdir, monkeypatch):
+        plain = write_jpeg(str(tmpdir.join('IMG_3.jpg')), datetime.datetime(2016, 6, 24))
+        assert V.extract_preview(plain, str(tmpdir)) == (sha1_of(plain), 'missing')
+
+        decoded = []
+        def fake_decode(srcpath):
+            decoded.append(srcpath)
+            return b'preview'
+        monkeypatch.setattr(V, 'decode_preview', fake_decode)
+        cache = V.PreviewCache(str(tmpdir))
+        path = cache.get(sha1_of(plain), plain)
+        assert open(path, 'rb').read() == b'preview'
+        assert cache.get(sha1_of(plain), plain) == path
+        assert decoded == [plain]
+
+    def test_bad_files_dont_stop_the_step(self, tmpdir):
+        truncated = str(tmpdir.join('IMG_1.jpg'))
+        with open(truncated, 'wb') as f:
+            f.write(b'\xff\xd8\xff\xe1\x10')
+        assert V.extract_preview(truncated, str(tmpdir)) == (sha1_of(truncated), 'missing')
+        assert V.extract_preview(str(tmpdir.join('IMG_gone.jpg')), str(tmpdir)) == (None, 'failed')
+        assert V.extract_preview(write_video(str(tmpdir.join('MOV_1.mp4')), 1000), str(tmpdir)) == (None, 'skipped')
+
+    def test_only_the_head_is_parsed(self, tmpdir, monkeypatch):
+        fn = write_jpeg(str(tmpdir.join('IMG_1.jpg')), datetime.datetime(2016, 6, 24), padding=1000000, seed=1, thumbnail=True)
+        parsed = []
+        real_load = V.piexif.load
+        monkeypatch.setattr(V.piexif, 'load', lambda data: parsed.append(len(data)) or real_load(data))
+        assert V.extract_preview(fn, str(tmpdir))[1] == 'extracted'
+        assert parsed == [min(V.EXIF_HEAD_BYTES, os.path.getsize(fn))]
+
+    def test_decode_with_pillow(self, tmpdir):
+        Image = pytest.importorskip('PIL.Image')
+        plain = str(tmpdir.join('IMG_3.jpg'))
+        Image.new('RGB', (1600, 1200), (200, 100, 50)).save(plain)
+        with Image.open(V.io.BytesIO(V.decode_preview(plain))) as im:
+            assert im.size == (160, 120)
+        assert V.decode_preview(write_video(str(tmpdir.join('MOV.mp4')), 100)) is None
@@ -0,0 +1,85 @@
+import photokeeper.photokeeper as P
+import photokeeper.shots as S
+import pytest
+import os, datetime
+
+from synthlib import write_jpeg, write_video
+
+
+def make_shot(srcdir, stem='DSC_0001', dt=datetime.datetime(2016, 6, 24, 10, 12, 2)):
+    """ A RAW (without a date piexif can read), its JPEG and two sidecars, all with another mtime """
+    mtime = datetime.datetime(2016, 7, 1).timestamp()
+    paths = [write_video(os.path.join(srcdir, stem + '.NEF'), 2048, mtime=mtime),
+             write_jpeg(os.path.join(srcdir, stem + '.JPG'), dt, padding=100),
+             write_video(os.path.join(srcdir, stem + '.xmp'), 100, mtime=mtime),
+             write_video(os.path.join(srcdir, stem + '.NEF.pp3'), 100, mtime=mtime)]
+    return paths
+
+
+class TestShots:
+
+    @pytest.mark.parametrize('a, b, same', [
+        ('d/DSC_0001.NEF', 'd/DSC_0001.JPG', True),
+        ('d/DSC_0001.NEF', 'd/dsc_0001.xmp', True),
+        ('d/DSC_0001.NEF', 'd/DSC_0001.NEF.xmp', True),
+        ('d/DSC_0001.NEF', 'e/DSC_0001.JPG', False),
+        ('d/DSC_0001.NEF', 'd/DSC_0002.NEF', False),
+        ('d/2016-06-24 10.12.02.jpg', 'd/2016-06-24 10.12.03.xmp', False),
+    ])
+    def test_shot_key(self, a, b, same):
+        assert (S.shot_key(a) == S.shot_key(b)) == same
+
+    def test_group_shots_keeps_order(self):
+        files = ['d/B.JPG', 'd/A.NEF', 'd/B.NEF', 'd/C.MOV', 'd/A.JPG']
+        assert S.group_shots(files) == [['d/B.JPG', 'd/B.NEF'], ['d/A.NEF', 'd/A.JPG'], ['d/C.MOV']]
+
+    def test_cheapest_first(self):
+        assert S.exif_candidates(['x.xmp', 'x.NEF', 'x.MOV', 'x.JPG']) == ['x.JPG', 'x.NEF']
+
+    def test_primary_member(self):
+        assert S.primary_member(['x.xmp', 'x.JPG', 'x.CR3']) == 'x.CR3'
+        assert S.primary_member(['x.xmp', 'x.MOV']) == 'x.MOV'
+        assert S.primary_member(['x.NEF.pp3', 'x.xmp']) == 'x.NEF.pp3'
+
+    @pytest.mark.parametrize('order', [1, -1])
+    def test_sidecar_edits_dont_date_the_shot(self, tmpdir, order):
+        """ No EXIF anywhere: the RAW's modification time counts, not the (newer) sidecar's """
+        taken, edited = datetime.datetime(2016, 6, 24, 10, 0), datetime.datetime(2020, 1, 1, 12, 0)
+        raw = write_video(str(tmpdir.join('IMG_0001.CR3')), 2048, mtime=taken.timestamp())
+        xmp = write_video(str(tmpdir.join('IMG_0001.xmp')), 100, mtime=edited.timestamp())
+        p = P.PhotoKeeper()
+        p.tgt_dir = None
+        images = p.examine_shot([raw, xmp][::order])
+        assert {img.tgtdatedir for img in images} == {'2016-06-24'}
+
+    def test_shot_is_dated_once(self, tmpdir, monkeypatch):
+        make_shot(str(tmpdir))
+        loads = []
+        real_load = P.piexif.load
+        monkeypatch.setattr(P.piexif, 'load', lambda f: loads.append(f) or real_load(f))
+        p = P.PhotoKeeper()
+        p.tgt_dir = None
+        p.examine_files(str(tmpdir))
+        assert len(p.images) == 4
+        assert {img.tgtdatedir for img in p.images} == {'2016-06-24'}
+        assert not any(img.exif_timestamp_missing for img in p.images)
+        assert [os.path.basename(f) for f in loads] == ['DSC_0001.JPG']
+        assert all(img.shot is p.images[0].shot for img in p.images)
+
+    def test_shot_is_copied_with_one_suffix(self, tmpdir):
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        make_shot(str(src))
+        write_jpeg(str(tgt.join('2016-06-24', 'DSC_0001.JPG')), padding=5000)   # Another camera's DSC_0001
+        P.PhotoKeeper().go([str(src), str(tgt), 'dedupe', 'file'])
+        assert sorted(os.listdir(str(tgt.join('2016-06-24')))) == \
+            ['DSC_0001.JPG', 'DSC_0001_1.JPG', 'DSC_0001_1.NEF', 'DSC_0001_1.NEF.pp3', 'DSC_0001_1.xmp']
+
+    def test_shot_keeps_names_next_to_earlier_copies(self, tmpdir):
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        make_shot(str(src))
+        P.PhotoKeeper().go([str(src), str(tgt), 'dedupe', 'file'])
+        # Edited since: only the sidecar is copied again, next to the RAW it belongs to
+        write_video(str(src.join('DSC_0001.xmp')), 200)
+        P.PhotoKeeper().go([str(src), str(tgt), 'dedupe', 'file'])
+        assert sorted(os.listdir(str(tgt.join('2016-06-24')))) == \
+            ['DSC_0001.JPG', 'DSC_0001.NEF', 'DSC_0001.NEF.pp3', 'DSC_0001.xmp', 'DSC_0001_1.xmp']
@@ -0,0 +1,125 @@
+import photokeeper.photokeeper as P
+import photokeeper.spool as SP
+import pytest
+import os, json, time, datetime
+
+from synthlib import write_jpeg, write_video
+
+
+def make_source(tmpdir, n=6, size=10000):
+    src = tmpdir.mkdir('src')
+    for i in range(n):
+        write_video(str(src.join('MOV_%d.mp4' % i)), size + i)
+    return src
+
+
+class TestSpool:
+
+    def test_staged_files_reach_the_target(self, tmpdir):
+        src, tgt = make_source(tmpdir), tmpdir.mkdir('tgt')
+        spool = SP.Spool(str(tmpdir.join('spool')), 1 << 20)
+        spool.recover()
+        for fn in sorted(os.listdir(str(src))):
+            spool.stage(str(src.join(fn)), str(tgt.join('day', fn)))
+        spool.finish()
+        assert sorted(os.listdir(str(tgt.join('day')))) == sorted(os.listdir(str(src)))
+        assert os.listdir(spool.spool_dir) == [SP.JOURNAL]
+        assert os.path.getsize(os.path.join(spool.spool_dir, SP.JOURNAL)) == 0
+        assert spool.written == 6
+
+    def test_staging_waits_for_room(self, tmpdir, monkeypatch):
+        src, tgt = make_source(tmpdir, 8), tmpdir.mkdir('tgt')
+        spool = SP.Spool(str(tmpdir.join('spool')), 25000)
+        spool.recover()
+        real_flush = spool._flush_one
+        def slow_flush(entry):
+            time.sleep(0.02)
+            return real_flush(entry)
+        spool._flush_one = slow_flush
+        most = 0
+        for fn in sorted(os.listdir(str(src))):
+            spool.stage(str(src.join(fn)), str(tgt.join(fn)))
+            most = max(most, spool.used)
+        spool.finish()
+        assert most <= 25000
+        assert len(os.listdir(str(tgt))) == 8
+
+    def test_failed_writes_stay_in_the_spool(self, tmpdir, monkeypatch):
+        src, tgt = make_source(tmpdir, 3), tmpdir.mkdir('tgt')
+        spool_dir = str(tmpdir.join('spool'))
+        spool = SP.Spool(spool_dir, 1 << 20)
+        spool.retry_backoff = 0
+        spool.recover()
+        real_copy = SP._fsync_copy
+        def failing_copy(src, dst):
+            if dst.endswith('.spool'):   # Writing to the target
+                raise OSError('share went away')
+            return real_copy(src, dst)
+        monkeypatch.setattr(SP, '_fsync_copy', failing_copy)
+        for fn in sorted(os.listdir(str(src))):
+            try:
+                spool.stage(str(src.join(fn)), str(tgt.join(fn)))
+            except SP.SpoolError:
+                break
+        with pytest.raises(SP.SpoolError):
+            spool.finish()
+        spool.close()
+        assert os.listdir(str(tgt)) == []
+        monkeypatch.undo()
+
+        # The next run writes out what was staged
+        spool = SP.Spool(spool_dir, 1 << 20)
+        n = spool.recover()
+        assert n >= 1
+        assert len(os.listdir(str(tgt))) == n
+        assert os.listdir(spool.spool_dir) == [SP.JOURNAL]
+
+    def test_recovery_after_a_crash(self, tmpdir):
+        """ Lay out what a crash could leave behind, by hand """
+        spool_dir, tgt = tmpdir.mkdir('spool').mkdir(SP.SUBDIR), tmpdir.mkdir('tgt')
+        write_video(str(spool_dir.join('00000000')), 100)    # Staged, not written
+        write_video(str(spool_dir.join('00000001')), 200)    # Staged and written, not yet removed
+        write_video(str(spool_dir.join('00000002.tmp')), 50)   # Half staged
+        write_video(str(tgt.join('b.mp4')), 300)   # Written, but the crash came before 'done'
+        write_video(str(spool_dir.join('00000003')), 300)
+        records = [{'op': 'staged', 'id': 0, 'tgt': str(tgt.join('a.mp4')), 'size': 100},
+                   {'op': 'staged', 'id': 1, 'tgt': str(tgt.join('x.mp4')), 'size': 200},
+                   {'op': 'done', 'id': 1},
+                   {'op': 'staged', 'id': 3, 'tgt': str(tgt.join('b.mp4')), 'size': 300}]
+        with open(str(spool_dir.join(SP.JOURNAL)), 'w') as f:
+            f.write(''.join(json.dumps(r) + '\n' for r in records) + '{"op": "sta')   # Torn last line
+        spool = SP.Spool(str(tmpdir.join('spool')), 1 << 20)
+        assert spool.recover() == 2
+        assert sorted(os.listdir(str(tgt))) == ['a.mp4', 'b.mp4']
+        assert os.path.getsize(str(tgt.join('a.mp4'))) == 100
+        assert os.listdir(str(spool_dir)) == [SP.JOURNAL]
+
+
+def test_copy_through_the_spool(tmpdir, capsys):
+    src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+    for i in range(5):
+        write_jpeg(str(src.join('IMG_%d.jpg' % i)), datetime.datetime(2016, 6, 24, 10, 0, i), padding=100, seed=i)
+    spool_dir = str(tmpdir.join('spool'))
+    P.PhotoKeeper().go([str(src), str(tgt), 'dedupe', 'file', '--spool=%s' % spool_dir, '--spool-size=1'])
+    out = capsys.readouterr().out
+    assert sorted(os.listdir(str(tgt.join('2016-06-24')))) == ['IMG_%d.jpg' % i for i in range(5)]
+    assert out.index('can be ejected') < out.index('Copied 5 files from the spool')
+    assert os.listdir(os.path.join(spool_dir, SP.SUBDIR)) == [SP.JOURNAL]
+
+
+def test_spool_leaves_other_files_alone(tmpdir):
+    """ --spool pointed at a directory that has other things in it, like /tmp """
+    src, tgt, scratch = make_source(tmpdir, 2), tmpdir.mkdir('tgt'), tmpdir.mkdir('scratch')
+    scratch.join('notes.txt').write('mine')
+    scratch.join('00000000').write('also mine')
+    scratch.mkdir('project').join('data').write('x')
+    for _ in range(2):
+        spool = SP.Spool(str(scratch), 1 << 20)
+        spool.recover()
+        for fn in sorted(os.listdir(str(src))):
+            spool.stage(str(src.join(fn)), str(tgt.join(fn)))
+        spool.finish()
+        spool.close()
+    assert sorted(os.listdir(str(scratch))) == sorted(['00000000', 'notes.txt', 'project', SP.SUBDIR])
+    assert scratch.join('project', 'data').read() == 'x'
+    assert len(os.listdir(str(tgt))) == 2
@@ -0,0 +1,89 @@
+import photokeeper.photokeeper as P
+import photokeeper.walk as W
+import pytest
+import os, time, threading, datetime
+
+from synthlib import write_jpeg, write_video
+
+
+def make_tree(top):
+    for d in ['a', 'a/b', 'a/b/c', 'b', 'c/d', '.previews/x', 'c/.hidden']:
+        os.makedirs(os.path.join(top, d), exist_ok=True)
+    for i, d in enumerate(['', 'a', 'a/b/c', 'b', 'b', 'c/d', '.previews/x', 'c/.hidden']):
+        write_video(os.path.join(top, d, 'MOV_%d.mp4' % i), 100 + i)
+    write_video(os.path.join(top, 'a', '.DS_Store'), 10)
+    os.symlink(os.path.join(top, 'a'), os.path.join(top, 'link'))
+
+
+def os_walk(top):
+    result = []
+    for root, dirs, files in os.walk(top):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        result.append((root, sorted(f for f in files if not f.startswith('.'))))
+    return result
+
+
+class TestWalk:
+
+    def test_same_as_os_walk(self, tmpdir):
+        make_tree(str(tmpdir))
+        walked = [(root, sorted(e.name for e in files)) for root, files in W.walk_files(str(tmpdir), workers=4)]
+        assert walked == os_walk(str(tmpdir))
+
+    def test_stats_come_with_the_entries(self, tmpdir):
+        make_tree(str(tmpdir))
+        for root, files in W.walk_files(str(tmpdir)):
+            for entry in files:
+                assert entry.stat().st_size == os.path.getsize(entry.path)
+
+    def test_directories_are_listed_at_once(self, tmpdir, monkeypatch):
+        for i in range(8):
+            tmpdir.mkdir('d%d' % i).join('f.mp4').write('x')
+        busy, most = [0], [0]
+        lock = threading.Lock()
+        real_scan = W._scan_dir
+        def slow_scan(path, hidden):
+            with lock:
+                busy[0] += 1
+                most[0] = max(most[0], busy[0])
+            time.sleep(0.05)
+            with lock:
+                busy[0] -= 1
+            return real_scan(path, hidden)
+        monkeypatch.setattr(W, '_scan_dir', slow_scan)
+        walked = [root for root, files in W.walk_files(str(tmpdir), workers=4)]
+        assert walked == [root for root, files in os_walk(str(tmpdir))]
+        assert most[0] == 4
+
+    def test_stopping_early(self, tmpdir):
+        make_tree(str(tmpdir))
+        walk = W.walk_files(str(tmpdir))
+        next(walk)
+        walk.close()
+
+
+def test_examine_starts_before_the_walk_ends(tmpdir, monkeypatch):
+    for d in ['a', 'a/z']:   # a/z is listed after a, whatever the order in a directory
+        for i in range(2):
+            write_jpeg(str(tmpdir.join(d, 'IMG_%d.jpg' % i)), datetime.datetime(2016, 6, 24, 10, 0, i), padding=10, seed=d+str(i))
+    real_scan = W._scan_dir
+    finished = {}
+    def slow_scan(path, hidden):
+        if path.endswith('z'):
+            time.sleep(0.3)
+        result = real_scan(path, hidden)
+        finished[path] = time.time()
+        return result
+    monkeypatch.setattr(W, '_scan_dir', slow_scan)
+    p = P.PhotoKeeper()
+    p.tgt_dir = None
+    real_examine = p.examine_shot
+    examined = []
+    def examine_shot(shot, stats=None):
+        examined.append(time.time())
+        return real_examine(shot, stats)
+    p.examine_shot = examine_shot
+    p.examine_files(str(tmpdir))
+    assert min(examined) < finished[str(tmpdir.join('a', 'z'))]
+    assert [img.filename for img in p.images] == ['IMG_0.jpg', 'IMG_1.jpg'] * 2
+    assert all(img._stat is not None for img in p.images)
@@ -0,0 +1,124 @@
+import photokeeper.photokeeper as P
+import photokeeper.watch as W
+import pytest
+import os, time, datetime, threading
+
+from synthlib import write_jpeg
+
+
+def wait_for(watcher, n, timeout=5.0):
+    found = []
+    deadline = time.time() + timeout
+    while len(found) < n and time.time() < deadline:
+        found.extend(watcher.poll(0.1))
+    return found
+
+
+class TestWatchers:
+
+    def test_polling_waits_for_stable_files(self, tmpdir):
+        write_jpeg(str(tmpdir.join('old.jpg')))
+        w = W.PollingWatcher(str(tmpdir), interval=0.05)
+        fn = write_jpeg(str(tmpdir.join('sub', 'new.jpg')))
+        write_jpeg(str(tmpdir.join('.hidden.jpg')))
+        assert wait_for(w, 1) == [fn]
+        assert wait_for(w, 1, timeout=0.3) == []
+
+    def test_polling_several_roots(self, tmpdir):
+        a, b = tmpdir.mkdir('a'), tmpdir.mkdir('b')
+        w = W.PollingWatcher([str(a), str(b)], interval=0.05)
+        fa = write_jpeg(str(a.join('1.jpg')))
+        fb = write_jpeg(str(b.join('2.jpg')))
+        assert sorted(wait_for(w, 2)) == [fa, fb]
+
+    @pytest.mark.skipif(not hasattr(os, 'O_CLOEXEC') or not os.path.exists('/proc/sys/fs/inotify'), reason='needs inotify')
+    def test_inotify_reports_closed_files_and_new_dirs(self, tmpdir):
+        w = W.InotifyWatcher(str(tmpdir))
+        try:
+            f = open(str(tmpdir.join('partial.jpg')), 'wb')
+            f.write(b'x')
+            assert w.poll(0.2) == []   # Still being written
+            f.close()
+            assert wait_for(w, 1) == [str(tmpdir.join('partial.jpg'))]
+
+            fn = write_jpeg(str(tmpdir.join('DCIM', '100CANON', 'IMG_1.jpg')))
+            assert fn in wait_for(w, 1)
+            fn = write_jpeg(str(tmpdir.join('DCIM', '100CANON', 'IMG_2.jpg')))
+            assert wait_for(w, 1) == [fn]
+        finally:
+            w.close()
+
+    @pytest.mark.skipif(not hasattr(os, 'O_CLOEXEC') or not os.path.exists('/proc/sys/fs/inotify'), reason='needs inotify')
+    def test_inotify_waits_for_files_in_new_dirs_to_settle(self, tmpdir):
+        root, outside = tmpdir.mkdir('root'), tmpdir.mkdir('outside')
+        done = write_jpeg(str(outside.join('card', 'IMG_1.jpg')))
+        f = open(str(outside.join('card', 'IMG_2.jpg')), 'wb')
+        w = W.InotifyWatcher(str(root))
+        w.settle = 0.3
+        try:
+            os.rename(str(outside.join('card')), str(root.join('card')))   # Like cp -r, partway through
+            found = []
+            for i in range(6):
+                f.write(b'x' * 1000)
+                f.flush()
+                found.extend(w.poll(0.1))
+            assert found == [str(root.join('card', 'IMG_1.jpg'))]
+            f.close()
+            assert wait_for(w, 1) == [str(root.join('card', 'IMG_2.jpg'))]
+            assert wait_for(w, 1, timeout=0.5) == []
+        finally:
+            w.close()
+
+    def test_empty_batches_are_dropped(self):
+        class FakeWatcher(object):
+            def poll(self, timeout):
+                time.sleep(0.01)
+                return ['/gone/IMG_1.jpg']
+        batches = []
+        stop = threading.Event()
+        threading.Timer(0.3, stop.set).start()
+        W.watch(FakeWatcher(), batches.append, debounce=0.05, stop=stop)
+        assert batches == []
+
+    def test_debounce_groups_a_burst(self, monkeypatch):
+        class FakeWatcher(object):
+            def __init__(self):
+                self.events = [['a'], ['b'], [], ['a', 'c']]
+            def poll(self, timeout):
+                time.sleep(0.01)
+                return self.events.pop(0) if self.events else []
+
+        batches = []
+        stop = threading.Event()
+        def handle(batch):
+            batches.append(batch)
+            stop.set()
+        monkeypatch.setattr(W.os.path, 'isfile', lambda p: True)
+        W.watch(FakeWatcher(), handle, debounce=0.1, stop=stop)
+        assert batches == [['a', 'b', 'c']]
+
+
+class TestWatchMode:
+
+    def test_new_files_are_copied(self, tmpdir):
+        src, tgt = tmpdir.mkdir('src'), tmpdir.mkdir('tgt')
+        p = P.PhotoKeeper()
+        p.get_options([str(src), str(tgt), 'dedupe', 'file', 'watch', '--poll=0.05', '--debounce=0.1'])
+        stop = threading.Event()
+        t = threading.Thread(target=p.run_watch, args=(stop,))
+        t.start()
+        try:
+            time.sleep(0.2)
+            write_jpeg(os.path.join(str(src), 'IMG_1.jpg'), datetime.datetime(2016, 6, 24, 10, 0, 0))
+            copied = os.path.join(str(tgt), '2016-06-24', 'IMG_1.jpg')
+            deadline = time.time() + 5
+            while not os.path.exists(copied) and time.time() < deadline:
+                time.sleep(0.05)
+            assert os.path.exists(copied)
+        finally:
+            stop.set()
+            t.join()
+
+
+def test_file_target_takes_an_empty_batch():
+    P.FileCopy().check_duplicates([])